@@ -4,9 +4,9 @@ calculations for---low-coverage adsorption sites whose predicted 4 electron
 onset potentials are near a specified target. Sites are chosen with Gaussian
 noise.
 
-We submit continuously to try and hit our target queue size. If we actually hit
-our queue size, then pause for an hour before checking back for more
-submissions.
+We submit continuously to try and hit our target queue size. Whenever the queue
+drains to the low-water mark, we top it back up to the quota. How often we
+check the queue adapts to how quickly it drains.
 
 Args:
     user        A string indicating which FireWorks user you are.  This helps
@@ -14,6 +14,8 @@ Args:
                 to your Linux user name.
     quota       The number of rockets you want either ready or running for a
                 given user.
+    low_water   The queue size at or below which we top the queue back up to
+                the quota. Defaults to one less than the quota.
     adsorbate   A string indicating which adsorbate you want to do calculations
                 for.
     target      A float indicating the onset potential you're targeting
@@ -22,50 +24,64 @@ Args:
     stdev       We select sites around the target using Gaussian noise. This
                 argument sets the standard deviation of that Gaussian noise in
                 eV.
+    budget      [optional] The number of core-hours that each top-up may
+                spend. If you set it, then cheaper sites are favored, using a
+                cost model that is fit to your completed FireWorks (and
+                refit at most once a day).
+    once        If set, then we top up the queue once and exit instead of
+                running continuously, which is what you want from cron. We
+                check the queue before loading anything else and exit right
+                away if it has no room.
 '''
 
 __author__ = 'Kevin Tran'
 __email__ = 'ktran@andrew.cmu.edu'
 
 import os
-import time
+import sys
 import argparse
-from gaspy.tasks import schedule_tasks
-from gaspy_feedback import get_n_jobs_to_submit, orr_sites_with_gaussian_noise
+from gaspy_feedback import has_room_in_queue
 
 
 # Set defaults for arguments and create command-line parser for them
 parser = argparse.ArgumentParser()
 parser.add_argument('--user', type=str, default=os.getlogin())
 parser.add_argument('--quota', type=int, default=300)
+parser.add_argument('--low_water', type=int, default=None)
 parser.add_argument('--adsorbate', type=str, default='OH')
 parser.add_argument('--target', type=float, default=1.23)
 parser.add_argument('--model', type=str, default='model0')
 parser.add_argument('--stdev', type=float, default=0.2)
+parser.add_argument('--budget', type=float, default=None)
+parser.add_argument('--once', action='store_true')
 # Fetch the arguments
 args = parser.parse_args()
 user = args.user
 quota = args.quota
+low_water = args.low_water
 adsorbate = args.adsorbate
 target = args.target
 model = args.model
 stdev = args.stdev
+budget = args.budget
+once = args.once
 
 
-def build_rockets():
-    n_calcs = get_n_jobs_to_submit(user, quota)
-    tasks = orr_sites_with_gaussian_noise(adsorbate=adsorbate,
-                                          orr_target=target,
-                                          stdev=stdev,
-                                          n_calcs=n_calcs,
-                                          model_tag=model)
-    for task in tasks:
-        schedule_tasks([task])
+# Cron runs should not pay for importing anything else when the queue is
+# already full
+if once and not has_room_in_queue(user, quota=quota, low_water=low_water):
+    sys.exit(0)
+from gaspy_feedback import FeedbackDaemon, orr_sites_with_gaussian_noise, get_cost_model  # noqa: E402
 
-
-# Run continuously with a 1 hour pause if we are actually above quota.
-while True:
-    if get_n_jobs_to_submit(user, quota) > 0:
-        build_rockets()
-    else:
-        time.sleep(3600)
+# Run continuously (or just once), topping up the queue whenever it drains
+selector_kwargs = {'adsorbate': adsorbate,
+                   'orr_target': target,
+                   'stdev': stdev,
+                   'model_tag': model}
+if budget is not None:
+    selector_kwargs['budget'] = budget
+    selector_kwargs['cost_model'] = get_cost_model(user_name=user)
+daemon = FeedbackDaemon(orr_sites_with_gaussian_noise,
+                        user_name=user, quota=quota, low_water=low_water,
+                        selector_kwargs=selector_kwargs)
+daemon.run(n_ticks=1 if once else None)
@@ -2,9 +2,9 @@
 This is an example script is used to make FireWorks rockets---i.e., submit
 calculations for---random adsorption sites in our catalog.
 
-We submit continuously to try and hit our target queue size. If we actually hit
-our queue size, then pause for an hour before checking back for more
-submissions.
+We submit continuously to try and hit our target queue size. Whenever the queue
+drains to the low-water mark, we top it back up to the quota. How often we
+check the queue adapts to how quickly it drains.
 
 Args:
     user        A string indicating which FireWorks user you are. This helps
@@ -12,18 +12,29 @@ Args:
                 to your Linux user name.
     quota       The number of rockets you want either ready or running for a
                 given user.
+    low_water   The queue size at or below which we top the queue back up to
+                the quota. Defaults to one less than the quota.
     adsorbate   A string indicating which adsorbate you want to do calculations
                 for.
+    budget      [optional] The number of core-hours that each top-up may
+                spend. If you set it, then cheaper sites are favored, using a
+                cost model that is fit to your completed FireWorks (and
+                refit at most once a day).
+    stream      If set, then we sample random sites straight off of Mongo
+                instead of collecting every unsimulated site first.
+    once        If set, then we top up the queue once and exit instead of
+                running continuously, which is what you want from cron. We
+                check the queue before loading anything else and exit right
+                away if it has no room.
 '''
 
 __author__ = 'Kevin Tran'
 __email__ = 'ktran@andrew.cmu.edu'
 
 import os
-import time
+import sys
 import argparse
-from gaspy.tasks import schedule_tasks
-from gaspy_feedback import get_n_jobs_to_submit, randomly
+from gaspy_feedback import has_room_in_queue
 
 
 # Set defaults for arguments and create command-line parser for them
@@ -31,23 +42,35 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--user', type=str, default=os.getlogin())
 parser.add_argument('--adsorbate', type=str, default='CO')
 parser.add_argument('--quota', type=int, default=300)
+parser.add_argument('--low_water', type=int, default=None)
+parser.add_argument('--budget', type=float, default=None)
+parser.add_argument('--stream', action='store_true')
+parser.add_argument('--once', action='store_true')
 # Fetch the arguments
 args = parser.parse_args()
 user = args.user
 adsorbate = args.adsorbate
 quota = args.quota
+low_water = args.low_water
+budget = args.budget
+stream = args.stream
+once = args.once
 
 
-def build_rockets():
-    n_calcs = get_n_jobs_to_submit(user, quota)
-    tasks = randomly(adsorbate, n_calcs=n_calcs)
-    for task in tasks:
-        schedule_tasks([task])
+# Cron runs should not pay for importing anything else when the queue is
+# already full
+if once and not has_room_in_queue(user, quota=quota, low_water=low_water):
+    sys.exit(0)
+from gaspy_feedback import FeedbackDaemon, randomly, get_cost_model  # noqa: E402
 
-
-# Run continuously with a 1 hour pause if we are actually above quota.
-while True:
-    if get_n_jobs_to_submit(user, quota) > 0:
-        build_rockets()
-    else:
-        time.sleep(3600)
+# Run continuously (or just once), topping up the queue whenever it drains
+selector_kwargs = {'adsorbate': adsorbate}
+if budget is not None:
+    selector_kwargs['budget'] = budget
+    selector_kwargs['cost_model'] = get_cost_model(user_name=user)
+if stream:
+    selector_kwargs['stream'] = True
+daemon = FeedbackDaemon(randomly,
+                        user_name=user, quota=quota, low_water=low_water,
+                        selector_kwargs=selector_kwargs)
+daemon.run(n_ticks=1 if once else None)
@@ -0,0 +1,88 @@
+'''
+This is an example script that compares selection strategies offline by
+replaying them against adsorption energies that we have already calculated.
+It replays random selection and low-coverage selection with Gaussian noise
+at several standard deviations, and then prints how many hits (results near
+the target) each strategy found per simulated core-hour.
+
+Args:
+    data        A string indicating the directory of the replay data
+    export      If set, then we first export fresh replay data from our
+                databases into `data`
+    adsorbate   A string indicating which adsorbate you want to replay
+    target      A float indicating the adsorption energy you're targeting
+    tolerance   A float indicating how close to the target (in eV) a result
+                has to be to count as a hit
+    model       A string for the model that you want to use; see the notebooks
+                in GASpy_regressions
+    stdevs      The standard deviations (in eV) of the Gaussian noise to try
+    ticks       The number of feedback ticks to simulate
+    quota       The number of calculations to choose on each tick
+    seeds       The number of random seeds to replay each strategy with
+    workers     [optional] The number of processes to replay with. Defaults
+                to one per CPU.
+'''
+
+__author__ = 'Kevin Tran'
+__email__ = 'ktran@andrew.cmu.edu'
+
+import argparse
+from gaspy_feedback import (randomly,
+                            low_cov_ads_energies_with_gaussian_noise,
+                            export_replay_data,
+                            make_replay_grid,
+                            replay_grid)
+
+
+# Set defaults for arguments and create command-line parser for them
+parser = argparse.ArgumentParser()
+parser.add_argument('--data', type=str, default='replay_data')
+parser.add_argument('--export', action='store_true')
+parser.add_argument('--adsorbate', type=str, default='CO')
+parser.add_argument('--target', type=float, default=-0.67)
+parser.add_argument('--tolerance', type=float, default=0.1)
+parser.add_argument('--model', type=str, default='model0')
+parser.add_argument('--stdevs', type=float, nargs='+', default=[0.05, 0.1, 0.2, 0.4])
+parser.add_argument('--ticks', type=int, default=20)
+parser.add_argument('--quota', type=int, default=50)
+parser.add_argument('--seeds', type=int, default=3)
+parser.add_argument('--workers', type=int, default=None)
+# Fetch the arguments
+args = parser.parse_args()
+data = args.data
+export = args.export
+adsorbate = args.adsorbate
+target = args.target
+tolerance = args.tolerance
+model = args.model
+stdevs = args.stdevs
+ticks = args.ticks
+quota = args.quota
+seeds = range(args.seeds)
+workers = args.workers
+
+
+if export:
+    export_replay_data(data, adsorbate,
+                       prediction_fields=['adsorption_energy.%s.%s' % (adsorbate, model)])
+
+# Replay every strategy and seed in parallel
+runs = (make_replay_grid(randomly, seeds=seeds)
+        + make_replay_grid(low_cov_ads_energies_with_gaussian_noise, seeds=seeds,
+                           energy_target=[target], stdev=stdevs, model_tag=[model]))
+results = replay_grid(data, runs, hit_target=target, hit_tolerance=tolerance,
+                      n_ticks=ticks, quota=quota, n_workers=workers)
+
+# Report the strategies from most to least efficient
+print('%-45s %8s %8s %12s %14s %12s' % ('strategy', 'seed', 'hits', 'core-hours',
+                                        'hits/core-hour', 'latency [s]'))
+for result in sorted(results, key=lambda result: -result['hits_per_core_hour']):
+    strategy = result['selector']
+    if 'stdev' in result['selector_kwargs']:
+        strategy += ' (stdev=%g)' % result['selector_kwargs']['stdev']
+    print('%-45s %8i %8i %12.1f %14.4f %12.3f' % (strategy,
+                                                  result['seed'],
+                                                  result['n_hits'],
+                                                  result['core_hours'],
+                                                  result['hits_per_core_hour'],
+                                                  result['mean_latency']))
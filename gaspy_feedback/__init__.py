@@ -1,14 +1,82 @@
 '''
 This package is meant to be a submodule to GASpy. It creates specific targets for
 GASpy to simulate. This is the "active learning" part of the whole GASpy workflow.
+
+Our submodules are imported the first time that one of their names is used,
+so `import gaspy_feedback` stays cheap for cron-launched runs that may only
+need to check the queue (see `gaspy_feedback.has_room_in_queue`).
 '''
 
 __author__ = 'Kevin Tran'
 __email__ = 'ktran@andrew.cmu.edu'
 
-# flake8: noqa
+import importlib
+
+
+# Which submodule each of our public names lives in
+_SUBMODULE_NAMES = {'quota': ['get_n_jobs_to_submit',
+                              'count_jobs_in_queue',
+                              'has_room_in_queue'],
+                    'core': ['randomly',
+                             'low_cov_ads_energies_with_gaussian_noise',
+                             'orr_sites_with_gaussian_noise'],
+                    'sampling': ['gaussian_log_weights',
+                                 'gumbel_keys',
+                                 'top_k',
+                                 'weighted_sample',
+                                 'counter_gumbel_keys',
+                                 'reservoir_sample'],
+                    'fingerprints': ['fingerprint_doc',
+                                     'hash_doc',
+                                     'hash_site',
+                                     'hash_task',
+                                     'get_attempted_fingerprints',
+                                     'get_in_flight_sites',
+                                     'isin_sorted'],
+                    'sites': ['SiteTable'],
+                    'catalog': ['get_catalog_snapshot',
+                                'get_catalog_predictions',
+                                'lookup_predictions',
+                                'get_snapshot_doc',
+                                'iter_catalog_docs',
+                                'sample_catalog_docs'],
+                    'parallel': ['sharded_gaussian_sample'],
+                    'cost': ['CostModel', 'get_historical_costs', 'fit_cost_model', 'get_cost_model'],
+                    'candidate_queue': ['CandidateQueue'],
+                    'acquisition': ['get_spec_fields',
+                                    'score_specs',
+                                    'combine_log_weights',
+                                    'multi_target_sites_with_gaussian_noise'],
+                    'replay': ['ReplayDatabase',
+                               'export_replay_data',
+                               'save_replay_data',
+                               'load_replay_data',
+                               'replay_selector',
+                               'make_replay_grid',
+                               'replay_grid'],
+                    'submission': ['submit_tasks'],
+                    'daemon': ['FeedbackDaemon', 'create_fireworks_indexes'],
+                    'campaigns': ['CampaignScheduler', 'split_slots'],
+                    'instrumentation': ['add_metrics_sink',
+                                        'remove_metrics_sink',
+                                        'collecting_metrics',
+                                        'JSONLinesSink',
+                                        'PrometheusTextSink']}
+_NAME_TO_SUBMODULE = {name: submodule
+                      for submodule, names in _SUBMODULE_NAMES.items()
+                      for name in names}
+__all__ = sorted(_NAME_TO_SUBMODULE)
+
+
+def __getattr__(name):
+    ''' Imports the submodule that a public name lives in when it is first used '''
+    submodule = _NAME_TO_SUBMODULE.get(name)
+    if submodule is None:
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+    value = getattr(importlib.import_module('.' + submodule, __name__), name)
+    globals()[name] = value
+    return value
+
 
-from .core import (get_n_jobs_to_submit,
-                   randomly,
-                   low_cov_ads_energies_with_gaussian_noise,
-                   orr_sites_with_gaussian_noise)
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
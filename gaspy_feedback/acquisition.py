@@ -0,0 +1,294 @@
+'''
+This submodule scores catalog sites against several targets and surrogate
+models at once. Instead of calling a selector once per model and target---and
+fetching, joining, and weighting the whole catalog each time---we load one
+catalog snapshot with every prediction column we need, stack those columns
+into a single prediction matrix, and then weight every site for every "spec"
+in one vectorized pass.
+
+Each spec is a dictionary with these keys:
+
+    target      A float indicating the prediction that you're targeting
+    stdev       A float indicating the standard deviation of the Gaussian
+                noise you want to add to the selection
+    prediction  [optional] A string indicating which prediction inside the
+                `predictions` field of the catalog to target, without the
+                model tag, e.g., 'adsorption_energy.CO'. Defaults to
+                'orr_onset_potential_4e'.
+    model_tag   [optional] A string or a list of strings indicating which
+                surrogate model(s) to use. If you give several, then we use
+                the mean of their predictions. Defaults to
+                `gaspy.defaults.model()`.
+    ensemble    [optional] Either 'mean' (the default) or 'spread'. With
+                'spread', the Gaussian is widened by how much the models
+                disagree, so sites that the models are unsure about are more
+                likely to be explored.
+    n_calcs     [optional] An integer indicating how many calculations to
+                choose for this spec. Defaults to the `n_calcs` of the call.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+import numpy as np
+from .catalog import get_catalog_snapshot
+from .core import _get_unattempted_snapshot_rows
+from .fingerprints import get_in_flight_sites, hash_site
+from .instrumentation import start_metrics
+from .sampling import gaussian_log_weights, gumbel_keys, top_k
+from .utils import lazy_import
+
+
+defaults = lazy_import('gaspy.defaults')
+CalculateAdsorptionEnergy = lazy_import('gaspy.tasks.metadata_calculators',
+                                        'CalculateAdsorptionEnergy')
+
+ENSEMBLE_RULES = ('mean', 'spread')
+COMBINE_RULES = ('any', 'all')
+
+
+def get_spec_fields(specs):
+    '''
+    Finds the catalog prediction fields that some specs need.
+
+    Args:
+        specs   A list of spec dictionaries; see this submodule's docstring
+    Returns:
+        prediction_fields   A sorted list of strings, e.g.,
+                            'orr_onset_potential_4e.model0', which can be
+                            passed to
+                            `gaspy_feedback.catalog.get_catalog_snapshot`
+    '''
+    return sorted({field for spec in specs for field in _get_fields(spec)})
+
+
+def score_specs(catalog, specs, rows=None):
+    '''
+    Calculates the Gaussian log-weight of every site for every spec. All of
+    the prediction columns are stacked into one matrix, and each spec's
+    ensemble mean and variance are matrix products with an averaging matrix,
+    so the work does not grow with the number of specs beyond a few
+    vectorized operations.
+
+    Args:
+        catalog     A `gaspy_feedback.sites.SiteTable` (e.g., the output of
+                    `gaspy_feedback.catalog.get_catalog_snapshot`) that has a
+                    column for each of `get_spec_fields(specs)`
+        specs       A list of spec dictionaries; see this submodule's docstring
+        rows        [optional] A sequence of integers indicating which rows of
+                    `catalog` to score. Defaults to all of them.
+    Returns:
+        log_weights     A `numpy.ndarray` of floats with one row per spec and
+                        one column per scored site. Sites that are missing a
+                        prediction from any of a spec's models get `-inf`
+                        for that spec.
+    '''
+    fields = get_spec_fields(specs)
+    field_indices = {field: i for i, field in enumerate(fields)}
+    n_rows = len(catalog) if rows is None else len(rows)
+
+    # Stack every prediction column we need into one matrix
+    predictions = np.empty((len(fields), n_rows))
+    for i, field in enumerate(fields):
+        predictions[i] = catalog[field] if rows is None else catalog[field][rows]
+    is_missing = np.isnan(predictions)
+    predictions[is_missing] = 0.
+
+    # Each row of the averaging matrix takes the mean over one spec's models
+    averaging = np.zeros((len(specs), len(fields)))
+    for i, spec in enumerate(specs):
+        spec_fields = _get_fields(spec)
+        averaging[i, [field_indices[field] for field in spec_fields]] = 1. / len(spec_fields)
+    means = averaging.dot(predictions)
+    means[(averaging > 0).astype(float).dot(is_missing) > 0] = np.nan
+
+    # Widen the Gaussians of the 'spread' specs by the models' disagreement.
+    # We keep the normalization of the Gaussian so that wider ones do not get
+    # more weight in total.
+    targets = np.array([[spec['target']] for spec in specs], dtype=float)
+    stdevs = np.array([[spec['stdev']] for spec in specs], dtype=float)
+    is_spread = np.array([[_get_ensemble(spec) == 'spread'] for spec in specs])
+    variances = np.maximum(averaging.dot(np.square(predictions)) - np.square(np.nan_to_num(means)), 0.)
+    widths = np.sqrt(np.square(stdevs) + np.where(is_spread, variances, 0.))
+    return gaussian_log_weights(means, targets, widths) - np.log(widths / stdevs)
+
+
+def combine_log_weights(log_weights, rule='any'):
+    '''
+    Combines the log-weights of several specs into one acquisition score.
+
+    Args:
+        log_weights     The output of `score_specs`
+        rule            Either 'any', which is an equal mixture of the specs
+                        (i.e., sites near any of the targets), or 'all', which
+                        is their product (i.e., sites near all of the targets
+                        at once)
+    Returns:
+        log_weights     A one-dimensional `numpy.ndarray` of floats with one
+                        value per scored site
+    '''
+    if rule == 'any':
+        return np.logaddexp.reduce(log_weights, axis=0) - np.log(len(log_weights))
+    elif rule == 'all':
+        return log_weights.sum(axis=0)
+    raise ValueError('Unknown combine rule %r; use one of %s' % (rule, COMBINE_RULES))
+
+
+def multi_target_sites_with_gaussian_noise(adsorbate, specs, n_calcs=50, combine=None,
+                                           rotations=None, max_atoms=80, vasp_settings=None,
+                                           catalog=None, catalog_max_age=3600.,
+                                           exclude=None, lpad=None):
+    '''
+    This task function will use GASpy to calculate adsorption energies for
+    sites near several targets and/or according to several surrogate models,
+    while fetching and filtering the catalog only once. We choose sites for
+    each spec using Gaussian noise, like `orr_sites_with_gaussian_noise`
+    does, or for one acquisition score that combines all of the specs.
+
+    Args:
+        adsorbate       A string indicating the adsorbate that you want to
+                        calculate an adsorption energy for
+        specs           A list of spec dictionaries; see this submodule's
+                        docstring
+        n_calcs         A positive integer indicating how many adsorption
+                        energy calculations you want GASpy to perform for each
+                        spec, or in total if you `combine` them
+        combine         [optional] If `None`, then we choose sites for each
+                        spec separately. Otherwise, a string indicating how to
+                        combine the specs into one score; see
+                        `combine_log_weights`. Daemons and campaigns expect
+                        one list of tasks, so they need a `combine` rule.
+        rotations       A list containing the angles (in degrees) in which to
+                        rotate the adsorbate after it is placed at the
+                        adsorption site. These values will be used for 'phi' in
+                        the rotation dictionary.
+        max_atoms       A positive integer indicating the maximum number of
+                        atoms that you want in the calculations you want to
+                        perform
+        vasp_settings   [optional] An OrderedDict containing the VASP
+                        settings; see `gaspy.defaults.adslab_settings()['vasp']`
+        catalog         [optional] A catalog snapshot from
+                        `gaspy_feedback.catalog.get_catalog_snapshot` that has
+                        every column in `get_spec_fields(specs)`. If `None`,
+                        then we load one.
+        catalog_max_age A float indicating how old (in seconds) the catalog
+                        snapshot we load is allowed to be
+        exclude         [optional] A set of `hash_site` integers (see
+                        `gaspy_feedback.fingerprints`) of sites that should not
+                        be chosen
+        lpad            [optional] A FireWorks LaunchPad to reuse when we
+                        check which sites are already in flight; see
+                        `gaspy_feedback.fingerprints.get_in_flight_sites`
+    Returns:
+        tasks   If `combine` is `None`, then a list with one list of
+                `CalculateAdsorptionEnergy` tasks per spec. No site is chosen
+                for more than one spec. Otherwise, a list of the tasks that we
+                chose for the combined score.
+    '''
+    # Python doesn't like mutable default arguments
+    if rotations is None:
+        rotations = [0., 90., 180., 270.]
+    if vasp_settings is None:
+        vasp_settings = defaults.adslab_settings()['vasp']
+    if exclude is None:
+        exclude = set()
+    if combine is not None and combine not in COMBINE_RULES:
+        raise ValueError('Unknown combine rule %r; use one of %s' % (combine, COMBINE_RULES))
+    specs = [_resolve_spec(spec) for spec in specs]
+
+    metrics = start_metrics('multi_target_sites_with_gaussian_noise')
+
+    # Never choose sites that are already waiting or running in FireWorks
+    with metrics.stage('in_flight'):
+        exclude = exclude | set(get_in_flight_sites(adsorbate, lpad=lpad).tolist())
+    metrics.count('in_flight', len(exclude))
+
+    with metrics.stage('fetch'):
+        if catalog is None:
+            catalog = get_catalog_snapshot(get_spec_fields(specs), max_age=catalog_max_age)
+    metrics.count('fetch', len(catalog))
+    with metrics.stage('filter'):
+        rows = _get_unattempted_snapshot_rows(catalog, adsorbate, vasp_settings, max_atoms)
+    metrics.count('filter', len(rows))
+
+    # Weight every site for every spec in one pass
+    with metrics.stage('weight'):
+        log_weights = score_specs(catalog, specs, rows=rows)
+        if combine is None:
+            spec_n_calcs = [spec.get('n_calcs', n_calcs) for spec in specs]
+        else:
+            log_weights = combine_log_weights(log_weights, combine)[np.newaxis]
+            spec_n_calcs = [n_calcs]
+
+    # Every site is a candidate at every rotation. Candidate `i` is rotation
+    # `i % n_rotations` of row `rows[i // n_rotations]`.
+    rotation_list = [{'phi': rot, 'theta': 0., 'psi': 0.} for rot in rotations]
+    n_rotations = len(rotation_list)
+    with metrics.stage('sample'):
+        keys = gumbel_keys(np.repeat(log_weights, n_rotations, axis=1))
+        selections = []
+        chosen_sites = set(exclude)
+        for spec_keys, n_spec_calcs in zip(keys, spec_n_calcs):
+            # Each site we skip could take up every one of its rotations
+            n_candidates = n_spec_calcs + n_rotations * len(chosen_sites)
+            docs = []
+            for candidate in top_k(spec_keys, n_candidates):
+                if len(docs) >= n_spec_calcs:
+                    break
+                doc = catalog.get_doc(rows[candidate // n_rotations])
+                if hash_site(doc) in chosen_sites:
+                    continue
+                doc['adsorbate_rotation'] = rotation_list[candidate % n_rotations]
+                docs.append(doc)
+            chosen_sites.update(hash_site(doc) for doc in docs)
+            selections.append(docs)
+    metrics.count('sample', sum(len(docs) for docs in selections))
+
+    # Make the GASpy tasks to do the calculations
+    with metrics.stage('make_tasks'):
+        selections = [_make_tasks(docs, adsorbate, vasp_settings) for docs in selections]
+    metrics.finish()
+    if combine is None:
+        return selections
+    return selections[0]
+
+
+def _resolve_spec(spec):
+    ''' Checks a spec and fills in its defaults, without modifying it '''
+    spec = dict(spec)
+    spec.setdefault('prediction', 'orr_onset_potential_4e')
+    if spec.get('model_tag') is None:
+        spec['model_tag'] = defaults.model()
+    if _get_ensemble(spec) not in ENSEMBLE_RULES:
+        raise ValueError('Unknown ensemble rule %r; use one of %s'
+                         % (spec['ensemble'], ENSEMBLE_RULES))
+    return spec
+
+
+def _get_fields(spec):
+    ''' The catalog prediction fields of each model in a spec '''
+    model_tags = spec.get('model_tag') or defaults.model()
+    if isinstance(model_tags, str):
+        model_tags = [model_tags]
+    prediction = spec.get('prediction', 'orr_onset_potential_4e')
+    return ['%s.%s' % (prediction, model_tag) for model_tag in model_tags]
+
+
+def _get_ensemble(spec):
+    return spec.get('ensemble', 'mean')
+
+
+def _make_tasks(docs, adsorbate, vasp_settings):
+    ''' Turns catalog documents into `CalculateAdsorptionEnergy` tasks '''
+    tasks = []
+    for doc in docs:
+        task = CalculateAdsorptionEnergy(adsorbate_name=adsorbate,
+                                         adsorption_site=doc['adsorption_site'],
+                                         rotation=doc['adsorbate_rotation'],
+                                         mpid=doc['mpid'],
+                                         miller_indices=doc['miller'],
+                                         shift=doc['shift'],
+                                         top=doc['top'],
+                                         adslab_vasp_settings=vasp_settings)
+        tasks.append(task)
+    return tasks
@@ -0,0 +1,134 @@
+'''
+This submodule lets us run several selection campaigns---e.g., different
+adsorbates, targets, or selectors---out of one process and one FireWorks
+queue. Each tick loads the catalog and the attempted sites once, splits the
+open queue slots among the campaigns according to their shares, and makes
+sure that no two campaigns choose the same site.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+import numpy as np
+from .acquisition import get_spec_fields, multi_target_sites_with_gaussian_noise
+from .core import orr_sites_with_gaussian_noise
+from .catalog import get_catalog_snapshot
+from .daemon import FeedbackDaemon, check_selector, check_tasks
+from .fingerprints import hash_task, sharing_attempted_fingerprints
+from .utils import accepts_argument, lazy_import
+
+
+defaults = lazy_import('gaspy.defaults')
+
+
+def split_slots(n_slots, shares):
+    '''
+    Splits a number of queue slots into integers that are proportional to
+    some shares, using the largest-remainder method so that the integers
+    always add up to `n_slots`.
+
+    Args:
+        n_slots     A non-negative integer indicating how many slots there are
+        shares      A sequence of non-negative floats
+    Returns:
+        slots   A list of integers, one per share
+    '''
+    shares = np.asarray(shares, dtype=float)
+    if n_slots <= 0 or shares.sum() <= 0:
+        return [0] * len(shares)
+    quotas = n_slots * shares / shares.sum()
+    slots = np.floor(quotas).astype(int)
+    n_left = n_slots - slots.sum()
+    slots[np.argsort(-(quotas - slots), kind='stable')[:n_left]] += 1
+    return slots.tolist()
+
+
+class CampaignScheduler(FeedbackDaemon):
+    '''
+    A `FeedbackDaemon` that fills one user's queue from several campaigns.
+    Each campaign is a dictionary with a 'selector' key (e.g.,
+    `gaspy_feedback.randomly`), an optional 'share' key (defaults to 1), and
+    any other keys are passed to the selector as arguments. For example:
+
+        campaigns = [{'selector': randomly, 'share': 1, 'adsorbate': 'CO'},
+                     {'selector': orr_sites_with_gaussian_noise, 'share': 3,
+                      'adsorbate': 'OH', 'orr_target': 1.23, 'stdev': 0.2}]
+    '''
+    def __init__(self, campaigns, user_name, quota=300, low_water=None,
+                 catalog_max_age=3600., **daemon_kwargs):
+        '''
+        Args:
+            campaigns       A list of campaign dictionaries; see above
+            user_name       String indicating your user name in FireWorks
+            quota           Integer indicating the number of jobs you want to
+                            have running/ready in FireWorks at a given time
+            low_water       [optional] An integer indicating the queue size at
+                            or below which we top the queue back up
+            catalog_max_age A float indicating how old (in seconds) the shared
+                            catalog snapshot is allowed to be; see
+                            `gaspy_feedback.catalog.get_catalog_snapshot`
+            daemon_kwargs   Any other arguments for `FeedbackDaemon`
+        '''
+        for campaign in campaigns:
+            check_selector(campaign['selector'], {key: value for key, value in campaign.items()
+                                                  if key not in ('selector', 'share')})
+        super(CampaignScheduler, self).__init__(selector=None,
+                                                user_name=user_name,
+                                                quota=quota,
+                                                low_water=low_water,
+                                                **daemon_kwargs)
+        self.campaigns = campaigns
+        self.catalog_max_age = catalog_max_age
+
+    def select(self, n_calcs):
+        '''
+        Splits `n_calcs` among the campaigns and then runs each one's selector
+        against the same catalog snapshot and the same attempted sites.
+
+        Args:
+            n_calcs     An integer indicating how many calculations to choose
+        Returns:
+            tasks   A list of tasks to submit
+        '''
+        slots = split_slots(n_calcs, [campaign.get('share', 1.) for campaign in self.campaigns])
+
+        tasks = []
+        chosen_sites = set()
+        with sharing_attempted_fingerprints():
+            catalog = self._get_shared_catalog()
+            for campaign, n_campaign_calcs in zip(self.campaigns, slots):
+                if n_campaign_calcs <= 0:
+                    continue
+                selector = campaign['selector']
+                selector_kwargs = {key: value for key, value in campaign.items()
+                                   if key not in ('selector', 'share')}
+                if catalog is not None and accepts_argument(selector, 'catalog'):
+                    selector_kwargs['catalog'] = catalog
+                if accepts_argument(selector, 'lpad'):
+                    selector_kwargs['lpad'] = self.lpad
+                campaign_tasks = check_tasks(selector(n_calcs=n_campaign_calcs,
+                                                      exclude=chosen_sites,
+                                                      **selector_kwargs), selector)
+                chosen_sites.update(hash_task(task) for task in campaign_tasks)
+                tasks.extend(campaign_tasks)
+        return tasks
+
+    def _get_shared_catalog(self):
+        '''
+        Loads one catalog snapshot with all of the prediction columns that the
+        campaigns need, or `None` if none of them can use a snapshot.
+        '''
+        campaigns = [campaign for campaign in self.campaigns
+                     if accepts_argument(campaign['selector'], 'catalog')]
+        if not campaigns:
+            return None
+
+        prediction_fields = set()
+        for campaign in campaigns:
+            if campaign['selector'] is orr_sites_with_gaussian_noise:
+                model_tag = campaign.get('model_tag') or defaults.model()
+                prediction_fields.add('orr_onset_potential_4e.%s' % model_tag)
+            elif campaign['selector'] is multi_target_sites_with_gaussian_noise:
+                prediction_fields.update(get_spec_fields(campaign['specs']))
+        return get_catalog_snapshot(prediction_fields=sorted(prediction_fields),
+                                    max_age=self.catalog_max_age)
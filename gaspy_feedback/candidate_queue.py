@@ -0,0 +1,247 @@
+'''
+This submodule contains `CandidateQueue`, a stateful alternative to
+`gaspy_feedback.core.orr_sites_with_gaussian_noise` for daemons that top up
+their queues a few calculations at a time. Instead of re-weighting and
+re-sampling the whole catalog on every call, it draws every candidate's
+random key once, saves the candidates to disk in key order, and then pops
+them off the front on each call.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+import os
+import json
+import numpy as np
+from .catalog import get_catalog_snapshot
+from .core import _get_unattempted_snapshot_rows
+from .fingerprints import get_attempted_fingerprints, get_in_flight_sites, hash_site, isin_sorted
+from .instrumentation import start_metrics
+from .sampling import gaussian_log_weights, gumbel_keys, top_k
+from .utils import atomic_path, get_cache_dir, make_cache_key, lazy_import
+
+
+defaults = lazy_import('gaspy.defaults')
+CalculateAdsorptionEnergy = lazy_import('gaspy.tasks.metadata_calculators',
+                                        'CalculateAdsorptionEnergy')
+
+
+class CandidateQueue(object):
+    '''
+    A priority queue of catalog sites (at each adsorbate rotation) whose
+    priorities are Gumbel keys of Gaussian weights centered at a target
+    prediction. Popping the first `k` candidates is the same as drawing `k`
+    without replacement from what is left, so repeated small pops give the
+    same distribution as one big draw.
+
+    The queue is built once per adsorbate, prediction, target, standard
+    deviation, set of rotations, `max_atoms`, and VASP settings. It is rebuilt
+    only when the predictions in the catalog snapshot change (e.g., because a
+    model was retrained or sites were added) or when it runs dry. Otherwise,
+    each call costs time proportional to the number of candidates popped, not
+    to the size of the catalog.
+
+    Instances are callable like our other selectors, so they can be handed to
+    `gaspy_feedback.daemon.FeedbackDaemon`.
+    '''
+    def __init__(self, adsorbate, target, stdev, prediction='orr_onset_potential_4e',
+                 model_tag=None, rotations=None, max_atoms=80, vasp_settings=None,
+                 catalog_max_age=3600., cache_dir=None):
+        '''
+        Args:
+            adsorbate       A string indicating the adsorbate that you want
+                            to calculate adsorption energies for
+            target          A float indicating the prediction that you're
+                            trying to target
+            stdev           A float indicating the standard deviation of the
+                            Gaussian noise you want to add to the selection
+            prediction      A string indicating which prediction inside the
+                            `predictions` field of the catalog to target,
+                            without the model tag
+            model_tag       [optional] A string indicating which surrogate
+                            model's predictions to use. Defaults to
+                            `gaspy.defaults.model()`.
+            rotations       A list containing the angles (in degrees) in which
+                            to rotate the adsorbate after it is placed at the
+                            adsorption site. These values will be used for
+                            'phi' in the rotation dictionary.
+            max_atoms       A positive integer indicating the maximum number
+                            of atoms that you want in the calculations
+            vasp_settings   [optional] An OrderedDict containing the VASP
+                            settings; see
+                            `gaspy.defaults.adslab_settings()['vasp']`
+            catalog_max_age A float indicating how old (in seconds) the
+                            catalog snapshot is allowed to be; see
+                            `gaspy_feedback.catalog.get_catalog_snapshot`
+            cache_dir       [optional] A string indicating where to save the
+                            queue, along with the catalog snapshot and the
+                            indices that it reads. See
+                            `gaspy_feedback.utils.get_cache_dir`.
+        '''
+        # Python doesn't like mutable default arguments
+        if model_tag is None:
+            model_tag = defaults.model()
+        if rotations is None:
+            rotations = [0., 90., 180., 270.]
+        if vasp_settings is None:
+            vasp_settings = defaults.adslab_settings()['vasp']
+
+        self.adsorbate = adsorbate
+        self.target = target
+        self.stdev = stdev
+        self.prediction_field = '%s.%s' % (prediction, model_tag)
+        self.rotation_list = [{'phi': rot, 'theta': 0., 'psi': 0.} for rot in rotations]
+        self.max_atoms = max_atoms
+        self.vasp_settings = vasp_settings
+        self.catalog_max_age = catalog_max_age
+        self.cache_dir = cache_dir
+
+        key = make_cache_key(adsorbate, self.prediction_field, target, stdev,
+                             rotations, max_atoms, vasp_settings)
+        self.queue_dir = os.path.join(get_cache_dir(cache_dir), 'queue_%s' % key)
+
+    def __call__(self, n_calcs=50, exclude=None, lpad=None):
+        '''
+        Pops the next candidates that we have not attempted yet.
+
+        Args:
+            n_calcs     A positive integer indicating how many adsorption
+                        energy calculations you want GASpy to perform
+            exclude     [optional] A set of `hash_site` integers (see
+                        `gaspy_feedback.fingerprints`) of sites that should
+                        not be chosen. They are skipped and dropped from the
+                        queue, as are sites that are already in flight in
+                        FireWorks.
+            lpad        [optional] A FireWorks LaunchPad to reuse when we
+                        check which sites are in flight; see
+                        `gaspy_feedback.fingerprints.get_in_flight_sites`
+        Returns:
+            tasks   A list of the `CalculateAdsorptionEnergy` tasks that we
+                    chose
+        '''
+        if exclude is None:
+            exclude = set()
+
+        metrics = start_metrics('CandidateQueue')
+        with metrics.stage('in_flight'):
+            exclude = exclude | set(get_in_flight_sites(self.adsorbate, lpad=lpad,
+                                                        cache_dir=self.cache_dir).tolist())
+
+        # Rebuild the queue if the predictions changed since we built it
+        with metrics.stage('load'):
+            catalog = get_catalog_snapshot([self.prediction_field], max_age=self.catalog_max_age,
+                                           cache_dir=self.cache_dir)
+            digest = catalog.metadata['prediction_digests'][self.prediction_field]
+            candidates, state = self._load()
+        is_fresh = candidates is None or state['digest'] != digest
+        if is_fresh:
+            with metrics.stage('build'):
+                candidates, state = self._build(catalog, digest)
+            metrics.count('build', len(candidates))
+
+        # Pop candidates off the front, skipping ones that were attempted or
+        # excluded since we built the queue
+        with metrics.stage('pop'):
+            attempted_fingerprints = get_attempted_fingerprints(self.adsorbate, self.vasp_settings,
+                                                                cache_dir=self.cache_dir)
+            docs_to_run, state['cursor'] = self._pop(catalog, candidates, state['cursor'],
+                                                     n_calcs, attempted_fingerprints, exclude)
+
+            # If an old queue ran dry, then start over with fresh keys for
+            # whatever has not been attempted yet
+            if (len(docs_to_run) < n_calcs and state['cursor'] >= len(candidates)
+                    and not is_fresh):
+                candidates, state = self._build(catalog, digest)
+                more_docs, state['cursor'] = self._pop(catalog, candidates, state['cursor'],
+                                                       n_calcs - len(docs_to_run),
+                                                       attempted_fingerprints,
+                                                       exclude | set(hash_site(doc) for doc in docs_to_run))
+                docs_to_run.extend(more_docs)
+            self._save_state(state)
+        metrics.count('pop', len(docs_to_run))
+
+        # Make the GASpy tasks to do the calculations
+        with metrics.stage('make_tasks'):
+            tasks = []
+            for doc in docs_to_run:
+                task = CalculateAdsorptionEnergy(adsorbate_name=self.adsorbate,
+                                                 adsorption_site=doc['adsorption_site'],
+                                                 rotation=doc['adsorbate_rotation'],
+                                                 mpid=doc['mpid'],
+                                                 miller_indices=doc['miller'],
+                                                 shift=doc['shift'],
+                                                 top=doc['top'],
+                                                 adslab_vasp_settings=self.vasp_settings)
+                tasks.append(task)
+        metrics.finish()
+        return tasks
+
+    def __len__(self):
+        ''' The number of candidates left in the queue as of its last call '''
+        candidates, state = self._load()
+        if candidates is None:
+            return 0
+        return len(candidates) - state['cursor']
+
+    def _build(self, catalog, digest):
+        '''
+        Weights every unattempted candidate, draws its key, and saves the
+        candidates in key order. Candidate `i` is rotation `i % n_rotations`
+        of snapshot row `i // n_rotations`.
+        '''
+        n_rotations = len(self.rotation_list)
+        rows = _get_unattempted_snapshot_rows(catalog, self.adsorbate, self.vasp_settings,
+                                              self.max_atoms, cache_dir=self.cache_dir)
+        candidates = (rows[:, np.newaxis] * n_rotations + np.arange(n_rotations)).ravel()
+        log_weights = gaussian_log_weights(catalog[self.prediction_field][candidates // n_rotations],
+                                           self.target, self.stdev)
+        keys = gumbel_keys(log_weights)
+        candidates = candidates[top_k(keys, len(keys))]
+
+        os.makedirs(self.queue_dir, exist_ok=True)
+        with atomic_path(os.path.join(self.queue_dir, 'candidates.npy')) as temp_path:
+            np.save(temp_path, candidates)
+        state = {'digest': digest, 'cursor': 0}
+        self._save_state(state)
+        return np.load(os.path.join(self.queue_dir, 'candidates.npy'), mmap_mode='r'), state
+
+    def _pop(self, catalog, candidates, cursor, n_calcs, attempted_fingerprints, exclude):
+        '''
+        Walks the queue from `cursor` until we have `n_calcs` documents or run
+        out of candidates.
+
+        Returns:
+            docs    A list of the chosen documents
+            cursor  An integer indicating where the next pop should start
+        '''
+        n_rotations = len(self.rotation_list)
+        docs = []
+        while len(docs) < n_calcs and cursor < len(candidates):
+            candidate = int(candidates[cursor])
+            cursor += 1
+            row = candidate // n_rotations
+            if isin_sorted(catalog['fingerprint'][row], attempted_fingerprints):
+                continue
+            doc = catalog.get_doc(row)
+            if exclude and hash_site(doc) in exclude:
+                continue
+            doc['adsorbate_rotation'] = self.rotation_list[candidate % n_rotations]
+            docs.append(doc)
+        return docs, cursor
+
+    def _load(self):
+        ''' Reads the saved queue, or returns `(None, None)` if there is none '''
+        candidates_path = os.path.join(self.queue_dir, 'candidates.npy')
+        state_path = os.path.join(self.queue_dir, 'state.json')
+        if not (os.path.isfile(candidates_path) and os.path.isfile(state_path)):
+            return None, None
+        with open(state_path) as file_handle:
+            state = json.load(file_handle)
+        return np.load(candidates_path, mmap_mode='r'), state
+
+    def _save_state(self, state):
+        ''' Atomically saves where the queue is and what it was built from '''
+        state_path = os.path.join(self.queue_dir, 'state.json')
+        with atomic_path(state_path) as temp_path:
+            with open(temp_path, 'w') as file_handle:
+                json.dump(state, file_handle)
@@ -0,0 +1,360 @@
+'''
+This submodule keeps a local, columnar snapshot of our catalog of adsorption
+sites so that selectors do not need to re-download the whole catalog every
+time they are called. Each column is saved as its own `.npy` file and then
+memory-mapped when loaded. Refreshes are only partly incremental:  we only
+fetch the whole documents that were added since the last refresh, but we
+re-read the prediction fields of every document we already have. The catalog
+has no marker of which documents' predictions changed (predictions may be
+saved as bare numbers without timestamps), so refreshing the predictions
+scans the whole collection, albeit with a projection onto the prediction
+fields. Use `max_age` to decide how often that is worth doing.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+import os
+import time
+import hashlib
+from array import array
+import numpy as np
+from bson import ObjectId
+from .sites import SiteTable
+from .utils import get_cache_dir, get_overlap_id, make_cache_key, lazy_import
+
+
+defaults = lazy_import('gaspy.defaults')
+get_mongo_collection = lazy_import('gaspy.gasdb', 'get_mongo_collection')
+
+
+# Where each of our catalog columns lives inside the `catalog` collection
+CATALOG_FIELDS = {'mpid': 'mpid',
+                  'miller': 'miller',
+                  'shift': 'shift',
+                  'top': 'top',
+                  'adsorption_site': 'adsorption_site',
+                  'natoms': 'natoms',
+                  'coordination': 'coordination',
+                  'neighborcoord': 'neighborcoord'}
+
+# Bump this whenever the layout of the saved snapshots changes so that old
+# snapshots get rebuilt instead of misread
+_SNAPSHOT_VERSION = 3
+
+
+def get_catalog_snapshot(prediction_fields=None, max_age=3600., cache_dir=None):
+    '''
+    Gets a local, columnar snapshot of the catalog. If the snapshot on disk is
+    older than `max_age`, then it is refreshed before it is returned. Each
+    refresh fetches the new documents and re-reads the prediction fields of
+    every document in the catalog.
+
+    Args:
+        prediction_fields   [optional] A list of strings indicating which
+                            predictions you want columns for. Each one should
+                            be a path inside the `predictions` field of the
+                            catalog documents, e.g.,
+                            'orr_onset_potential_4e.model0'. Defaults to the
+                            4e ORR onset potential of the default model.
+        max_age             A float indicating how old (in seconds) the
+                            snapshot is allowed to be before we refresh it
+        cache_dir           [optional] A string indicating the directory to
+                            store the snapshot in. See
+                            `gaspy_feedback.utils.get_cache_dir`.
+    Returns:
+        snapshot    A `gaspy_feedback.sites.SiteTable` whose columns are
+                    read-only, memory-mapped `numpy.ndarray`s with one row per
+                    catalog site, sorted by `_id`. On top of the usual columns,
+                    it has the 'mongo_id' and 'fingerprint' (see
+                    `gaspy_feedback.fingerprints.hash_doc`) columns and one
+                    float column per prediction field (NaN where missing).
+                    Its `metadata` holds when it was 'updated' and the
+                    'prediction_digests' of each prediction column, which
+                    change whenever any prediction does.
+    '''
+    if prediction_fields is None:
+        prediction_fields = ['orr_onset_potential_4e.%s' % defaults.model()]
+    prediction_fields = sorted(prediction_fields)
+    snapshot_dir = os.path.join(get_cache_dir(cache_dir),
+                                'catalog_%s' % make_cache_key(prediction_fields))
+
+    snapshot = SiteTable.load(snapshot_dir, mmap_mode='r')
+    if snapshot is None or snapshot.metadata.get('version') != _SNAPSHOT_VERSION:
+        table = _fetch_catalog_table(prediction_fields)
+        _save_snapshot(snapshot_dir, table, prediction_fields)
+    elif time.time() - snapshot.metadata['updated'] > max_age:
+        table = _refresh_table(SiteTable.load(snapshot_dir), prediction_fields)
+        _save_snapshot(snapshot_dir, table, prediction_fields)
+    else:
+        return snapshot
+    return SiteTable.load(snapshot_dir, mmap_mode='r')
+
+
+def get_snapshot_doc(snapshot, index):
+    '''
+    Turns a row of a catalog snapshot back into a document that looks like the
+    ones that `gaspy.gasdb` gives us, so that we can make tasks out of it.
+
+    Args:
+        snapshot    The output of `get_catalog_snapshot`
+        index       An integer indicating which row you want
+    Returns:
+        doc     A dictionary with the 'mongo_id', 'mpid', 'miller', 'shift',
+                'top', 'adsorption_site', 'natoms', and 'fingerprint' keys,
+                plus one key per prediction field
+    '''
+    return snapshot.get_doc(index)
+
+
+def iter_catalog_docs(max_atoms=None, mpids=None, fields=None):
+    '''
+    Streams catalog documents one at a time straight off of a Mongo cursor, so
+    that callers can make a single pass over the catalog without holding it in
+    memory.
+
+    Args:
+        max_atoms   [optional] An integer indicating the maximum number of
+                    atoms that a site may have. This filter is applied by
+                    Mongo.
+        mpids       [optional] A sequence of strings indicating which bulks
+                    to stream the sites of. If `None`, then we stream every
+                    bulk's.
+        fields      [optional] A sequence of the keys in `CATALOG_FIELDS`
+                    that you need, so that Mongo only sends those. If `None`,
+                    then we send all of them.
+    Yields:
+        doc     A dictionary with the 'mongo_id' key and the keys in `fields`
+    '''
+    query = {}
+    if max_atoms is not None:
+        query[CATALOG_FIELDS['natoms']] = {'$lte': max_atoms}
+    if mpids is not None:
+        query[CATALOG_FIELDS['mpid']] = {'$in': list(mpids)}
+    if fields is None:
+        fields = CATALOG_FIELDS
+    projection = {CATALOG_FIELDS[key]: 1 for key in fields}
+    with get_mongo_collection('catalog') as collection:
+        for raw_doc in collection.find(query, projection):
+            yield _flatten_catalog_doc(raw_doc, [], fields)
+
+
+def sample_catalog_docs(n_docs, max_atoms=None):
+    '''
+    Has Mongo draw catalog documents uniformly at random with `$sample`, so
+    that only the chosen documents are sent to us.
+
+    Args:
+        n_docs      A positive integer indicating how many documents to draw
+        max_atoms   [optional] An integer indicating the maximum number of
+                    atoms that a site may have
+    Returns:
+        docs        A list of at most `n_docs` unique dictionaries like the
+                    ones from `iter_catalog_docs`, or `None` if the database
+                    does not support `$sample`
+        is_complete A Boolean indicating whether fewer than `n_docs`
+                    documents matched, in which case `docs` holds all of them
+    '''
+    query = {}
+    if max_atoms is not None:
+        query[CATALOG_FIELDS['natoms']] = {'$lte': max_atoms}
+    projection = {path: 1 for path in CATALOG_FIELDS.values()}
+    pipeline = [{'$match': query},
+                {'$sample': {'size': int(n_docs)}},
+                {'$project': projection}]
+    from pymongo.errors import OperationFailure  # Imported here to keep our import cheap
+    try:
+        with get_mongo_collection('catalog') as collection:
+            raw_docs = list(collection.aggregate(pipeline, allowDiskUse=True))
+    except (OperationFailure, NotImplementedError):
+        return None, False
+
+    # `$sample` may return a document more than once
+    docs = {raw_doc['_id']: _flatten_catalog_doc(raw_doc, []) for raw_doc in raw_docs}
+    return list(docs.values()), len(raw_docs) < n_docs
+
+
+def get_catalog_predictions(prediction_field, max_atoms=None):
+    '''
+    Streams one prediction out of the catalog without pulling whole catalog
+    documents. Only the `_id` and the requested prediction are projected, and
+    the `natoms` filter is applied by Mongo.
+
+    Args:
+        prediction_field    A string indicating a path inside the
+                            `predictions` field of the catalog documents, e.g.,
+                            'orr_onset_potential_4e.model0'
+        max_atoms           [optional] An integer indicating the maximum
+                            number of atoms that a site may have
+    Returns:
+        mongo_ids   A sorted `numpy.ndarray` of 12-byte strings, each of which
+                    is the binary form of a catalog document's `_id`
+        predictions A `numpy.ndarray` of floats that are parallel to
+                    `mongo_ids`. Missing predictions are NaN.
+    '''
+    query = {}
+    if max_atoms is not None:
+        query[CATALOG_FIELDS['natoms']] = {'$lte': max_atoms}
+    projection = {'_id': 1, 'predictions.%s' % prediction_field: 1}
+
+    id_bytes = bytearray()
+    predictions = array('d')
+    with get_mongo_collection('catalog') as collection:
+        for raw_doc in collection.find(query, projection):
+            id_bytes += raw_doc['_id'].binary
+            predictions.append(_latest_prediction(_get_field(raw_doc, 'predictions.' + prediction_field)))
+    mongo_ids = np.frombuffer(bytes(id_bytes), dtype='S12')
+    predictions = np.frombuffer(predictions, dtype=float) if predictions else np.array([], dtype=float)
+
+    order = np.argsort(mongo_ids, kind='stable')
+    return mongo_ids[order], predictions[order]
+
+
+def lookup_predictions(doc_ids, mongo_ids, predictions):
+    '''
+    Joins site IDs (e.g., the 'mongo_id' column of a
+    `gaspy_feedback.sites.SiteTable`) to the output of
+    `get_catalog_predictions`.
+
+    Args:
+        doc_ids     A `numpy.ndarray` of 12-byte strings of the IDs you want
+                    predictions for
+        mongo_ids   The sorted IDs from `get_catalog_predictions`
+        predictions The predictions from `get_catalog_predictions`
+    Returns:
+        is_matched  A Boolean `numpy.ndarray` indicating which of the
+                    `doc_ids` were found. Sites can go missing if, e.g., they
+                    were too big.
+        values      A `numpy.ndarray` of floats that is parallel to `doc_ids`
+                    and that holds their predictions (NaN where not found)
+    '''
+    values = np.full(len(doc_ids), np.nan)
+    if len(mongo_ids) == 0 or len(doc_ids) == 0:
+        return np.zeros(len(doc_ids), dtype=bool), values
+    rows = np.minimum(np.searchsorted(mongo_ids, doc_ids), len(mongo_ids) - 1)
+    is_matched = mongo_ids[rows] == doc_ids
+    values[is_matched] = predictions[rows[is_matched]]
+    return is_matched, values
+
+
+def _fetch_catalog_table(prediction_fields, since=None):
+    '''
+    Streams catalog documents (optionally only the ones whose `_id` is at
+    least `since`) straight into a `SiteTable`, sorted by `_id`.
+    '''
+    query = {}
+    if since is not None:
+        query['_id'] = {'$gte': ObjectId(since)}
+    projection = {path: 1 for path in CATALOG_FIELDS.values()}
+    for field in prediction_fields:
+        projection['predictions.%s' % field] = 1
+
+    with get_mongo_collection('catalog') as collection:
+        cursor = collection.find(query, projection).sort('_id', 1)
+        docs = (_flatten_catalog_doc(raw_doc, prediction_fields) for raw_doc in cursor)
+        table = SiteTable.from_docs(docs,
+                                    extra_fields={field: float for field in prediction_fields},
+                                    fingerprints=True)
+    return table
+
+
+def _flatten_catalog_doc(raw_doc, prediction_fields, fields=CATALOG_FIELDS):
+    ''' Pulls the fields we keep out of a raw catalog document '''
+    doc = {key: _get_field(raw_doc, CATALOG_FIELDS[key]) for key in fields}
+    doc['mongo_id'] = raw_doc['_id']
+    for field in prediction_fields:
+        doc[field] = _latest_prediction(_get_field(raw_doc, 'predictions.' + field))
+    return doc
+
+
+def _fetch_predictions(prediction_fields, high_water):
+    '''
+    Fetches only the prediction fields of the catalog documents whose `_id` is
+    less than or equal to `high_water`. Since we cannot tell which of them
+    changed, this reads every one of them. The IDs are returned as 12-byte
+    strings.
+    '''
+    query = {'_id': {'$lte': ObjectId(high_water)}}
+    projection = {'predictions.%s' % field: 1 for field in prediction_fields}
+
+    id_bytes = bytearray()
+    predictions = {field: array('d') for field in prediction_fields}
+    with get_mongo_collection('catalog') as collection:
+        for raw_doc in collection.find(query, projection):
+            id_bytes += raw_doc['_id'].binary
+            for field in prediction_fields:
+                predictions[field].append(_latest_prediction(_get_field(raw_doc, 'predictions.' + field)))
+    mongo_ids = np.frombuffer(bytes(id_bytes), dtype='S12')
+    predictions = {field: np.array(values, dtype=float) for field, values in predictions.items()}
+    return mongo_ids, predictions
+
+
+def _refresh_table(table, prediction_fields):
+    '''
+    Appends the catalog sites that were added since the snapshot was made and
+    updates the predictions of the sites that were already in it. The sites
+    are fetched incrementally, but the predictions of every site are
+    re-read; see `_fetch_predictions`.
+    '''
+    if len(table) == 0:
+        return _fetch_catalog_table(prediction_fields)
+    high_water = ObjectId(bytes(table['mongo_id'][-1]).ljust(12, b'\x00'))
+
+    # Sites themselves never change, but their predictions do, and nothing
+    # tells us which ones did, so we re-read all of them
+    mongo_ids, predictions = _fetch_predictions(prediction_fields, high_water)
+    rows = np.searchsorted(table['mongo_id'], mongo_ids)
+    rows = np.minimum(rows, len(table) - 1)
+    matched = table['mongo_id'][rows] == mongo_ids
+    for field in prediction_fields:
+        table[field][rows[matched]] = predictions[field][matched]
+
+    # Add the new sites. Sites can land after ones with larger IDs, so we
+    # start a little before the newest ID we have and skip the ones we have.
+    new_table = _fetch_catalog_table(prediction_fields, since=get_overlap_id(high_water))
+    is_new = ~np.isin(new_table['mongo_id'], table['mongo_id'])
+    if not is_new.any():
+        return table
+    table = SiteTable.concatenate([table, new_table.take(is_new)])
+    return table.take(np.argsort(table['mongo_id'], kind='stable'))
+
+
+def _get_field(doc, path):
+    ''' Gets a value out of nested dictionaries using a dotted path '''
+    for key in path.split('.'):
+        if not isinstance(doc, dict) or key not in doc:
+            return None
+        doc = doc[key]
+    return doc
+
+
+def _latest_prediction(value):
+    '''
+    Predictions may be saved either as a single number or as a history of
+    `(time, prediction)` pairs. This function returns the latest prediction as
+    a float, or NaN if there is none.
+    '''
+    while isinstance(value, (list, tuple)):
+        if len(value) == 0:
+            return np.nan
+        value = value[-1]
+    if value is None:
+        return np.nan
+    return float(value)
+
+
+def _save_snapshot(snapshot_dir, table, prediction_fields):
+    '''
+    Saves a snapshot along with when it was made and a digest of each of its
+    prediction columns, so that users of the snapshot (e.g.,
+    `gaspy_feedback.candidate_queue.CandidateQueue`) can tell cheaply whether
+    any prediction changed.
+    '''
+    digests = {field: hashlib.blake2b(np.ascontiguousarray(table[field]).tobytes(),
+                                      digest_size=8).hexdigest()
+               for field in prediction_fields}
+    table.metadata = {'version': _SNAPSHOT_VERSION,
+                      'updated': time.time(),
+                      'prediction_fields': prediction_fields,
+                      'prediction_digests': digests}
+    table.save(snapshot_dir)
@@ -10,40 +10,33 @@ execute them yourself using either `gaspy.tasks.run_task` or
 __authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
 __emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
 
+from functools import partial
 import numpy as np
-from scipy.stats import norm
-from gaspy import defaults
-from gaspy.gasdb import (get_low_coverage_docs,
-                         get_catalog_docs_with_predictions,
-                         get_unsimulated_catalog_docs,
-                         _get_attempted_adsorption_docs)
-from gaspy.tasks.metadata_calculators import CalculateAdsorptionEnergy
-from gaspy.fireworks_helper_scripts import get_launchpad
+from .catalog import (get_catalog_predictions, lookup_predictions,
+                      iter_catalog_docs, sample_catalog_docs)
+from .cost import CostModel
+from .fingerprints import (get_attempted_fingerprints, get_in_flight_sites, hash_doc, hash_site,
+                           isin_sorted)
+from .instrumentation import start_metrics
+from .parallel import sharded_gaussian_sample
+from .sampling import gaussian_log_weights, reservoir_sample, weighted_sample
+from .quota import get_n_jobs_to_submit, count_jobs_in_queue  # noqa: F401
+from .sites import SiteTable
+from .utils import fetch_concurrently, lazy_import
 
 
-def get_n_jobs_to_submit(user_name, quota=300):
-    '''
-    This function helps you figure out how many jobs you should submit by
-    calculating the difference between your quota of jobs in queue and the
-    number of jobs you actually have in queue.
-
-    Args:
-        user_name   String indicating your user name in FireWorks
-        quota       Integer indicating the number of jobs you want to
-                    have running/ready in FireWorks at a given time.
-    Returns:
-        n_jobs_to_submit    The integer difference between the number of jobs
-                            you have running and the number you want running.
-    '''
-    lpad = get_launchpad()
-    query = {'name.user': user_name, 'state': {'$in': ['READY', 'RUNNING']}}
-    n_jobs_running = lpad.fireworks.find(query).count()
-
-    n_jobs_to_submit = quota - n_jobs_running
-    return n_jobs_to_submit
+# GASpy's task machinery pulls in luigi and FireWorks, so we only import it
+# once we actually need it
+defaults = lazy_import('gaspy.defaults')
+get_low_coverage_docs = lazy_import('gaspy.gasdb', 'get_low_coverage_docs')
+get_unsimulated_catalog_docs = lazy_import('gaspy.gasdb', 'get_unsimulated_catalog_docs')
+CalculateAdsorptionEnergy = lazy_import('gaspy.tasks.metadata_calculators',
+                                        'CalculateAdsorptionEnergy')
 
 
-def randomly(adsorbate, n_calcs=50, max_atoms=80, vasp_settings=None):
+def randomly(adsorbate, n_calcs=50, max_atoms=80, vasp_settings=None,
+             catalog=None, exclude=None, budget=None, cost_model=None, lpad=None,
+             stream=False):
     '''
     This function will pick random, unsimulated sites from our catalog and then
     sumbit adsorption energy calculations.
@@ -65,38 +58,104 @@ def randomly(adsorbate, n_calcs=50, max_atoms=80, vasp_settings=None):
                         should be obtained (and modified, if necessary) from
                         `gaspy.defaults.adslab_settings()['vasp']`. If `None`,
                         then pulls default settings.
+        catalog         [optional] A catalog snapshot from
+                        `gaspy_feedback.catalog.get_catalog_snapshot`. If you
+                        pass one, then we select sites from it instead of
+                        querying the catalog in Mongo, and we use the
+                        attempted sites in
+                        `gaspy_feedback.fingerprints.get_attempted_fingerprints`
+                        to decide which sites are unsimulated.
+        exclude         [optional] A set of `hash_site` integers (see
+                        `gaspy_feedback.fingerprints`) of sites that should not
+                        be chosen, e.g., because another campaign already chose
+                        them.
+        budget          [optional] A float indicating how many core-hours the
+                        chosen calculations may cost in total. If you pass
+                        one, then each site's weight is divided by its
+                        estimated cost and we keep drawing sites (up to
+                        `n_calcs` of them) until the budget is spent.
+                        `max_atoms` is still a hard limit.
+        cost_model      [optional] A function that turns numbers of atoms into
+                        estimated core-hours, e.g., a
+                        `gaspy_feedback.cost.CostModel`. Only used with a
+                        `budget`. Defaults to `CostModel()`.
+        lpad            [optional] A FireWorks LaunchPad to reuse when we
+                        check which sites are already in flight; see
+                        `gaspy_feedback.fingerprints.get_in_flight_sites`. If
+                        `None`, then we open one.
+        stream          A Boolean indicating whether to sample without ever
+                        holding the unsimulated sites in memory. If `True`,
+                        then we have Mongo draw the sites with `$sample` when
+                        it can, and otherwise we make one pass over the
+                        catalog with reservoir sampling. Either way, memory
+                        grows with `n_calcs` instead of with the catalog.
+                        Cannot be used with a `catalog` or a `budget`.
     Returns:
-        tasks   A list of the `CalculateAdsorptionEnergy` tasks that we chose
+        tasks   A list of the `CalculateAdsorptionEnergy` tasks that we chose.
+                If fewer than `n_calcs` sites are left, then we choose all of
+                them.
     '''
     # Python doesn't like mutable default arguments
     if vasp_settings is None:
         vasp_settings = defaults.adslab_settings()['vasp']
+    if exclude is None:
+        exclude = set()
+    if cost_model is None:
+        cost_model = CostModel()
+    if stream and (catalog is not None or budget is not None):
+        raise ValueError('Streaming cannot be combined with a catalog snapshot or a budget.')
+
+    metrics = start_metrics('randomly')
+
+    # Never choose sites that are already waiting or running in FireWorks
+    with metrics.stage('in_flight'):
+        exclude = exclude | set(get_in_flight_sites(adsorbate, lpad=lpad).tolist())
+    metrics.count('in_flight', len(exclude))
+
+    # Pick random sites straight off of Mongo without collecting them first
+    if stream:
+        with metrics.stage('stream'):
+            docs_to_run = _stream_random_docs(adsorbate, n_calcs, max_atoms,
+                                              vasp_settings, exclude)
+        metrics.count('stream', len(docs_to_run))
+        return _finish_random_tasks(docs_to_run, adsorbate, vasp_settings, metrics)
 
     # Find unsimulated sites, take out ones that are too big, then pick some at
-    # random.
-    catalog_docs = get_unsimulated_catalog_docs(adsorbate, vasp_settings=vasp_settings)
-    catalog_docs = [doc for doc in catalog_docs if doc['natoms'] <= max_atoms]
-    docs_to_run = np.random.choice(catalog_docs, size=n_calcs, replace=False)
-
-    # Parse the catalog documents into calculation tasks
-    tasks = []
-    for doc in docs_to_run:
-        task = CalculateAdsorptionEnergy(adsorbate_name=adsorbate,
-                                         adsorption_site=doc['adsorption_site'],
-                                         mpid=doc['mpid'],
-                                         miller_indices=doc['miller'],
-                                         shift=doc['shift'],
-                                         top=doc['top'],
-                                         adslab_vasp_settings=vasp_settings)
-        tasks.append(task)
-    return tasks
+    # random. We draw extras to make up for any excluded sites we might draw.
+    if catalog is None:
+        with metrics.stage('fetch'):
+            sites = SiteTable.from_docs(get_unsimulated_catalog_docs(adsorbate,
+                                                                     vasp_settings=vasp_settings))
+        metrics.count('fetch', len(sites))
+        with metrics.stage('filter'):
+            rows = np.flatnonzero(sites['natoms'] <= max_atoms)
+    else:
+        sites = catalog
+        with metrics.stage('filter'):
+            rows = _get_unattempted_snapshot_rows(catalog, adsorbate, vasp_settings, max_atoms)
+    metrics.count('filter', len(rows))
+    with metrics.stage('sample'):
+        if budget is None:
+            n_draws = min(max(n_calcs, 0) + len(exclude), len(rows))
+            rows_to_run = np.random.choice(rows, size=n_draws, replace=False)
+            docs_to_run = sites.get_docs(rows_to_run)
+        else:
+            costs = cost_model(sites['natoms'][rows])
+            docs_to_run = _sample_within_budget(np.zeros(len(rows)), costs, budget, n_calcs,
+                                                exclude, lambda i: sites.get_doc(rows[i]))
+    with metrics.stage('exclude'):
+        docs_to_run = _drop_excluded_docs(docs_to_run, exclude, n_calcs)
+    metrics.count('sample', len(docs_to_run))
+    return _finish_random_tasks(docs_to_run, adsorbate, vasp_settings, metrics)
 
 
 def low_cov_ads_energies_with_gaussian_noise(adsorbate, energy_target, stdev,
                                              n_calcs=50,
-                                             model_tag=defaults.model(),
+                                             model_tag=None,
                                              max_atoms=80,
-                                             vasp_settings=None):
+                                             vasp_settings=None,
+                                             exclude=None, n_workers=None,
+                                             budget=None, cost_model=None, lpad=None):
     '''
     This task function will use GASpy to calculate adsorption energies for
     various adsorption sites. We choose only sites that we predict to have the
@@ -114,9 +173,10 @@ def low_cov_ads_energies_with_gaussian_noise(adsorbate, energy_target, stdev,
                         trying to target, in eV
         stdev           A float indicating the standard deviation of the Gaussian
                         noise you want to add to the selection.
-        model_tag       A string indicating which surrogate model you want to
-                        use when estimating what you think the adsorption
-                        energy is going to be.
+        model_tag       [optional] A string indicating which surrogate model
+                        you want to use when estimating what you think the
+                        adsorption energy is going to be. Defaults to
+                        `gaspy.defaults.model()`.
         n_calcs         A positive integer indicating how many adsorption
                         energy calculations you want GASpy to perform.
         max_atoms       A positive integer indicating the maximum number of
@@ -129,68 +189,127 @@ def low_cov_ads_energies_with_gaussian_noise(adsorbate, energy_target, stdev,
                         should be obtained (and modified, if necessary) from
                         `gaspy.defaults.adslab_settings()['vasp']`. If `None`,
                         then pulls default settings.
+        exclude         [optional] A set of `hash_site` integers (see
+                        `gaspy_feedback.fingerprints`) of sites that should not
+                        be chosen, e.g., because another campaign already chose
+                        them.
+        n_workers       [optional] A positive integer indicating how many
+                        processes to score the candidates with. If more than
+                        one, then the candidates are sharded by mpid; see
+                        `gaspy_feedback.parallel`. Defaults to the
+                        `GASPY_FEEDBACK_WORKERS` environment variable, or 1.
+        budget          [optional] A float indicating how many core-hours the
+                        chosen calculations may cost in total. If you pass
+                        one, then each site's weight is divided by its
+                        estimated cost and we keep drawing sites (up to
+                        `n_calcs` of them) until the budget is spent.
+                        `max_atoms` is still a hard limit.
+        cost_model      [optional] A function that turns numbers of atoms into
+                        estimated core-hours, e.g., a
+                        `gaspy_feedback.cost.CostModel`. Only used with a
+                        `budget`. Defaults to `CostModel()`.
+        lpad            [optional] A FireWorks LaunchPad to reuse when we
+                        check which sites are already in flight; see
+                        `gaspy_feedback.fingerprints.get_in_flight_sites`. If
+                        `None`, then we open one.
     Returns:
         tasks   A list of the `CalculateAdsorptionEnergy` tasks that we chose
     '''
-    # Python doesn't like mutable default arguments
+    # Python doesn't like mutable default arguments, and we look up the
+    # default model when we are called instead of when we are imported
+    if model_tag is None:
+        model_tag = defaults.model()
     if vasp_settings is None:
         vasp_settings = defaults.adslab_settings()['vasp']
+    if exclude is None:
+        exclude = set()
+    if cost_model is None:
+        cost_model = CostModel()
 
-    # Get the documents for the low-coverage sites while taking out sites that
-    # are too big
-    low_coverage_docs = [doc for doc in get_low_coverage_docs(adsorbate, model_tag)
-                         if (doc['DFT_calculated'] is False and
-                             doc['natoms'] <= max_atoms)]
-
-    # Some calculations/sites result in an adsorbate moving so far that the
-    # fingerprint changes. If we try to calculate the energy for these sites,
-    # GASpy ends up trying to run the same calculation again. We avoid this by
-    # making sure that the site we're trying to submit here doesn't match with
-    # any site that we've tried (as opposed to checking against sites that we
-    # have).
-    attempted_docs = _get_attempted_adsorption_docs(adsorbate, vasp_settings)
-    attempted_fingerprints = set(__fingerprint_doc(doc) for doc in attempted_docs)
-    unattempted_docs = []
-    for doc in low_coverage_docs:
-        if __fingerprint_doc(doc) not in attempted_fingerprints:
-            unattempted_docs.append(doc)
-
-    # Choose the documents with Gaussian noise
-    energies = [doc['energy'] for doc in unattempted_docs]
-    gaussian_distribution = norm(loc=energy_target, scale=stdev)
-    probability_densities = [gaussian_distribution.pdf(energy) for energy in energies]
-    probabilities = probability_densities/sum(probability_densities)
-    docs_to_run = np.random.choice(unattempted_docs, size=n_calcs, replace=False, p=probabilities)
+    metrics = start_metrics('low_cov_ads_energies_with_gaussian_noise')
 
-    # Make the GASpy tasks to do the calculations
-    tasks = []
-    for doc in docs_to_run:
-        task = CalculateAdsorptionEnergy(adsorbate_name=adsorbate,
-                                         adsorption_site=doc['adsorption_site'],
-                                         mpid=doc['mpid'],
-                                         miller_indices=doc['miller'],
-                                         shift=doc['shift'],
-                                         top=doc['top'],
-                                         adslab_vasp_settings=vasp_settings)
-        tasks.append(task)
-    return tasks
+    # Never choose sites that are already waiting or running in FireWorks
+    with metrics.stage('in_flight'):
+        exclude = exclude | set(get_in_flight_sites(adsorbate, lpad=lpad).tolist())
+    metrics.count('in_flight', len(exclude))
+
+    # Fetch the low-coverage sites and the sites we've attempted at the same
+    # time, since both queries spend most of their time waiting on Mongo
+    with metrics.stage('fetch'):
+        low_coverage_docs, attempted_fingerprints = fetch_concurrently(
+            partial(get_low_coverage_docs, adsorbate, model_tag),
+            partial(get_attempted_fingerprints, adsorbate, vasp_settings))
+        sites = SiteTable.from_docs(low_coverage_docs,
+                                    extra_fields={'energy': float, 'DFT_calculated': bool},
+                                    fingerprints=True)
+        del low_coverage_docs
+    metrics.count('fetch', len(sites))
+
+    # Filter, deduplicate, and sample the sites, in shards if we have the
+    # cores for it. Every site's key depends only on the seed and its row, so
+    # the sample does not depend on how many workers drew it.
+    if budget is None:
+        with metrics.stage('sample'):
+            rows, n_candidates = sharded_gaussian_sample(sites, sites['energy'],
+                                                         energy_target, stdev,
+                                                         n_calcs + len(exclude),
+                                                         n_workers=n_workers,
+                                                         max_atoms=max_atoms,
+                                                         skip=sites['DFT_calculated'],
+                                                         attempted_fingerprints=attempted_fingerprints)
+        metrics.count('deduplicate', n_candidates)
+        docs_to_run = sites.get_docs(rows)
 
+    else:
+        # Take out sites that are too big
+        with metrics.stage('filter'):
+            is_candidate = ~sites['DFT_calculated'] & (sites['natoms'] <= max_atoms)
+        metrics.count('filter', np.count_nonzero(is_candidate))
 
-def __fingerprint_doc(doc):
-    fingerprint = (doc['mpid'],
-                   tuple(doc['miller']),
-                   doc['shift'],
-                   doc['top'],
-                   tuple(doc['adsorption_site']),
-                   doc['coordination'],
-                   tuple(doc['neighborcoord']))
-    return fingerprint
+        # Some calculations/sites result in an adsorbate moving so far that
+        # the fingerprint changes. If we try to calculate the energy for these
+        # sites, GASpy ends up trying to run the same calculation again. We
+        # avoid this by making sure that the site we're trying to submit here
+        # doesn't match with any site that we've tried (as opposed to checking
+        # against sites that we have).
+        with metrics.stage('deduplicate'):
+            is_candidate &= ~isin_sorted(sites['fingerprint'], attempted_fingerprints)
+            rows = np.flatnonzero(is_candidate)
+        metrics.count('deduplicate', len(rows))
+
+        # Choose the documents with Gaussian noise per core-hour
+        with metrics.stage('weight'):
+            log_weights = gaussian_log_weights(sites['energy'][rows], energy_target, stdev)
+        with metrics.stage('sample'):
+            costs = cost_model(sites['natoms'][rows])
+            docs_to_run = _sample_within_budget(log_weights, costs, budget, n_calcs,
+                                                exclude, lambda i: sites.get_doc(rows[i]))
+    with metrics.stage('exclude'):
+        docs_to_run = _drop_excluded_docs(docs_to_run, exclude, n_calcs)
+    metrics.count('sample', len(docs_to_run))
+
+    # Make the GASpy tasks to do the calculations
+    with metrics.stage('make_tasks'):
+        tasks = []
+        for doc in docs_to_run:
+            task = CalculateAdsorptionEnergy(adsorbate_name=adsorbate,
+                                             adsorption_site=doc['adsorption_site'],
+                                             mpid=doc['mpid'],
+                                             miller_indices=doc['miller'],
+                                             shift=doc['shift'],
+                                             top=doc['top'],
+                                             adslab_vasp_settings=vasp_settings)
+            tasks.append(task)
+    metrics.finish()
+    return tasks
 
 
 def orr_sites_with_gaussian_noise(adsorbate, orr_target, stdev,
                                   rotations=None, n_calcs=50,
-                                  model_tag=defaults.model(),
-                                  max_atoms=80, vasp_settings=None):
+                                  model_tag=None,
+                                  max_atoms=80, vasp_settings=None,
+                                  catalog=None, exclude=None, n_workers=None,
+                                  budget=None, cost_model=None, lpad=None):
     '''
     This task function will use GASpy to calculate adsorption energies for
     various adsorption sites. We choose sites near a targeted onset potential
@@ -210,9 +329,10 @@ def orr_sites_with_gaussian_noise(adsorbate, orr_target, stdev,
                         rotate the adsorbate after it is placed at the
                         adsorption site. These values will be used for 'phi' in
                         the rotation dictionary.
-        model_tag       A string indicating which surrogate model you want to
-                        use when estimating what you think the adsorption
-                        energy is going to be.
+        model_tag       [optional] A string indicating which surrogate model
+                        you want to use when estimating what you think the
+                        adsorption energy is going to be. Defaults to
+                        `gaspy.defaults.model()`.
         n_calcs         A positive integer indicating how many adsorption
                         energy calculations you want GASpy to perform.
         max_atoms       A positive integer indicating the maximum number of
@@ -225,45 +345,272 @@ def orr_sites_with_gaussian_noise(adsorbate, orr_target, stdev,
                         should be obtained (and modified, if necessary) from
                         `gaspy.defaults.adslab_settings()['vasp']`. If `None`,
                         then pulls default settings.
+        catalog         [optional] A catalog snapshot from
+                        `gaspy_feedback.catalog.get_catalog_snapshot`. If you
+                        pass one, then we select sites from it instead of
+                        querying the catalog in Mongo, and we use the
+                        attempted sites in
+                        `gaspy_feedback.fingerprints.get_attempted_fingerprints`
+                        to decide which sites are unsimulated.
+        exclude         [optional] A set of `hash_site` integers (see
+                        `gaspy_feedback.fingerprints`) of sites that should not
+                        be chosen, e.g., because another campaign already chose
+                        them.
+        n_workers       [optional] A positive integer indicating how many
+                        processes to score the candidates with. If more than
+                        one, then the candidates are sharded by mpid; see
+                        `gaspy_feedback.parallel`. Defaults to the
+                        `GASPY_FEEDBACK_WORKERS` environment variable, or 1.
+        budget          [optional] A float indicating how many core-hours the
+                        chosen calculations may cost in total. If you pass
+                        one, then each site's weight is divided by its
+                        estimated cost and we keep drawing sites (up to
+                        `n_calcs` of them) until the budget is spent.
+                        `max_atoms` is still a hard limit.
+        cost_model      [optional] A function that turns numbers of atoms into
+                        estimated core-hours, e.g., a
+                        `gaspy_feedback.cost.CostModel`. Only used with a
+                        `budget`. Defaults to `CostModel()`.
+        lpad            [optional] A FireWorks LaunchPad to reuse when we
+                        check which sites are already in flight; see
+                        `gaspy_feedback.fingerprints.get_in_flight_sites`. If
+                        `None`, then we open one.
     Returns:
         tasks   A list of the `CalculateAdsorptionEnergy` tasks that we chose
     '''
-    # Python doesn't like mutable default arguments
+    # Python doesn't like mutable default arguments, and we look up the
+    # default model when we are called instead of when we are imported
+    if model_tag is None:
+        model_tag = defaults.model()
     if rotations is None:
         rotations = [0., 90., 180., 270.]
     if vasp_settings is None:
         vasp_settings = defaults.adslab_settings()['vasp']
+    if exclude is None:
+        exclude = set()
+    if cost_model is None:
+        cost_model = CostModel()
+
+    metrics = start_metrics('orr_sites_with_gaussian_noise')
+
+    # Never choose sites that are already waiting or running in FireWorks
+    with metrics.stage('in_flight'):
+        exclude = exclude | set(get_in_flight_sites(adsorbate, lpad=lpad).tolist())
+    metrics.count('in_flight', len(exclude))
 
     # Find all of our unsimulated catalog sites
     rotation_list = [{'phi': rot, 'theta': 0., 'psi': 0.} for rot in rotations]
-    unsim_cat_docs = get_unsimulated_catalog_docs(adsorbate, rotation_list)
-
-    # Get all of our ORR predictions, then push them into our catalog of
-    # unsimulated sites
-    cat_docs = [doc for doc in get_catalog_docs_with_predictions()
-                if doc['natoms'] <= max_atoms]
-    cat_docs_by_mongo_id = {doc['mongo_id']: doc for doc in cat_docs}
-    for doc in unsim_cat_docs:
-        doc['predictions'] = cat_docs_by_mongo_id[doc['mongo_id']]
-
-    # Choose the documents with Gaussian noise
-    potentials = [doc['predictions']['orr_onset_potential_4e'][model_tag]
-                  for doc in unsim_cat_docs]
-    gaussian_distribution = norm(loc=orr_target, scale=stdev)
-    probability_densities = [gaussian_distribution.pdf(potential) for potential in potentials]
-    probabilities = probability_densities/sum(probability_densities)
-    docs_to_run = np.random.choice(unsim_cat_docs, size=n_calcs, replace=False, p=probabilities)
+    if catalog is None:
+        # Get only the ORR predictions we need for the sites that are small
+        # enough. We fetch them at the same time as the unsimulated sites.
+        prediction_field = 'orr_onset_potential_4e.%s' % model_tag
+        with metrics.stage('fetch'):
+            unsim_cat_docs, (mongo_ids, predictions) = fetch_concurrently(
+                partial(get_unsimulated_catalog_docs, adsorbate, rotation_list),
+                partial(get_catalog_predictions, prediction_field, max_atoms=max_atoms))
+            sites = SiteTable.from_docs(unsim_cat_docs)
+            del unsim_cat_docs
+        metrics.count('fetch', len(sites))
+
+        # Join the predictions onto our catalog of unsimulated sites. Sites
+        # that were not found get NaN, which is never chosen.
+        with metrics.stage('filter'):
+            is_matched, potentials = lookup_predictions(sites['mongo_id'], mongo_ids, predictions)
+        metrics.count('filter', np.count_nonzero(is_matched))
+        n_rotations = 1
+
+    # If we have a snapshot, then every unattempted site is a candidate at
+    # every rotation. Candidate `i` is rotation `i % n_rotations` of site
+    # `i // n_rotations`.
+    else:
+        sites = catalog
+        potentials = catalog['orr_onset_potential_4e.%s' % model_tag]
+        n_rotations = len(rotation_list)
+
+    def make_doc(candidate):
+        doc = sites.get_doc(candidate // n_rotations)
+        if catalog is not None:
+            doc['adsorbate_rotation'] = rotation_list[candidate % n_rotations]
+        return doc
+
+    # Score the candidates, in shards if we have the cores for it. Every
+    # candidate's key depends only on the seed and its number, so the sample
+    # does not depend on how many workers drew it.
+    if budget is None:
+        if catalog is not None:
+            sharding_kwargs = {'max_atoms': max_atoms,
+                               'attempted_fingerprints': get_attempted_fingerprints(adsorbate,
+                                                                                    vasp_settings)}
+        else:
+            sharding_kwargs = {}
+        with metrics.stage('sample'):
+            candidates, _ = sharded_gaussian_sample(sites, potentials, orr_target, stdev,
+                                                    n_calcs + len(exclude),
+                                                    n_workers=n_workers,
+                                                    n_repeats=n_rotations,
+                                                    **sharding_kwargs)
+            docs_to_run = [make_doc(candidate) for candidate in candidates]
+
+    else:
+        if catalog is None:
+            candidates = np.flatnonzero(is_matched)
+        else:
+            with metrics.stage('filter'):
+                rows = _get_unattempted_snapshot_rows(catalog, adsorbate, vasp_settings, max_atoms)
+                candidates = (rows[:, np.newaxis] * n_rotations + np.arange(n_rotations)).ravel()
+            metrics.count('filter', len(candidates))
+
+        # Choose the documents with Gaussian noise per core-hour
+        with metrics.stage('weight'):
+            log_weights = gaussian_log_weights(potentials[candidates // n_rotations],
+                                               orr_target, stdev)
+        with metrics.stage('sample'):
+            costs = cost_model(sites['natoms'][candidates // n_rotations])
+            docs_to_run = _sample_within_budget(log_weights, costs, budget, n_calcs,
+                                                exclude, lambda i: make_doc(candidates[i]))
+    with metrics.stage('exclude'):
+        docs_to_run = _drop_excluded_docs(docs_to_run, exclude, n_calcs)
+    metrics.count('sample', len(docs_to_run))
 
     # Make the GASpy tasks to do the calculations
-    tasks = []
-    for doc in docs_to_run:
-        task = CalculateAdsorptionEnergy(adsorbate_name=adsorbate,
-                                         adsorption_site=doc['adsorption_site'],
-                                         rotation=doc['adsorbate_rotation'],
-                                         mpid=doc['mpid'],
-                                         miller_indices=doc['miller'],
-                                         shift=doc['shift'],
-                                         top=doc['top'],
-                                         adslab_vasp_settings=vasp_settings)
-        tasks.append(task)
+    with metrics.stage('make_tasks'):
+        tasks = []
+        for doc in docs_to_run:
+            task = CalculateAdsorptionEnergy(adsorbate_name=adsorbate,
+                                             adsorption_site=doc['adsorption_site'],
+                                             rotation=doc['adsorbate_rotation'],
+                                             mpid=doc['mpid'],
+                                             miller_indices=doc['miller'],
+                                             shift=doc['shift'],
+                                             top=doc['top'],
+                                             adslab_vasp_settings=vasp_settings)
+            tasks.append(task)
+    metrics.finish()
+    return tasks
+
+
+def _get_unattempted_snapshot_rows(catalog, adsorbate, vasp_settings, max_atoms, cache_dir=None):
+    '''
+    Finds the rows of a catalog snapshot that are small enough and that we
+    have not yet attempted to calculate.
+
+    Args:
+        catalog         The output of `gaspy_feedback.catalog.get_catalog_snapshot`
+        adsorbate       A string indicating the adsorbate
+        vasp_settings   An OrderedDict containing the VASP settings
+        max_atoms       A positive integer indicating the maximum number of
+                        atoms that you want in the calculations
+        cache_dir       [optional] A string indicating where the index of
+                        attempted sites is; see
+                        `gaspy_feedback.fingerprints.get_attempted_fingerprints`
+    Returns:
+        rows    A `numpy.ndarray` of integers indicating the rows of the
+                snapshot that are candidates for calculation
+    '''
+    attempted_fingerprints = get_attempted_fingerprints(adsorbate, vasp_settings, cache_dir=cache_dir)
+    is_candidate = ((catalog['natoms'] <= max_atoms) &
+                    ~isin_sorted(catalog['fingerprint'], attempted_fingerprints))
+    return np.flatnonzero(is_candidate)
+
+
+def _sample_within_budget(log_weights, costs, budget, n_calcs, exclude, make_doc):
+    '''
+    Draws candidates with probabilities proportional to their weight per
+    core-hour, then walks through them in the order that they were drawn and
+    keeps the ones that are not excluded and that still fit in the budget.
+
+    Args:
+        log_weights A `numpy.ndarray` of the candidates' log-weights
+        costs       A `numpy.ndarray` of the candidates' estimated costs, in
+                    core-hours
+        budget      A float indicating how many core-hours we may spend
+        n_calcs     An integer indicating the most candidates we may keep
+        exclude     A set of `hash_site` integers of sites not to keep
+        make_doc    A function that turns a candidate's index into a document
+    Returns:
+        docs    A list of the documents of the candidates we kept
+    '''
+    order = weighted_sample(log_weights - np.log(costs), len(costs))
+    costs = costs[order]
+
+    # The cheapest candidate that is left at each point, so that we can stop
+    # as soon as nothing else could fit
+    cheapest_left = np.minimum.accumulate(costs[::-1])[::-1]
+
+    docs = []
+    remaining = budget
+    for position, candidate in enumerate(order):
+        if len(docs) >= n_calcs or cheapest_left[position] > remaining:
+            break
+        if costs[position] > remaining:
+            continue
+        doc = make_doc(candidate)
+        if exclude and hash_site(doc) in exclude:
+            continue
+        docs.append(doc)
+        remaining -= costs[position]
+    return docs
+
+
+def _drop_excluded_docs(docs, exclude, n_calcs):
+    '''
+    Removes the documents whose sites are excluded, then keeps the first
+    `n_calcs` of the rest. Since our samples are drawn in order, this is the
+    same as sampling from only the sites that are not excluded.
+
+    Args:
+        docs        A sequence of dictionaries with the keys needed by
+                    `gaspy_feedback.fingerprints.hash_site`
+        exclude     A set of `hash_site` integers
+        n_calcs     An integer indicating how many documents to keep
+    Returns:
+        docs    A list of at most `n_calcs` documents
+    '''
+    if exclude:
+        docs = [doc for doc in docs if hash_site(doc) not in exclude]
+    return list(docs[:max(n_calcs, 0)])
+
+
+def _stream_random_docs(adsorbate, n_calcs, max_atoms, vasp_settings, exclude):
+    '''
+    Chooses up to `n_calcs` unattempted, unexcluded catalog sites uniformly at
+    random while holding only O(`n_calcs`) catalog documents in memory. We
+    first ask Mongo for a `$sample` with some extras to make up for sites that
+    turn out to be attempted. If the database cannot `$sample`, or if too many
+    of the sampled sites were attempted, then we stream the whole catalog
+    through a reservoir instead.
+    '''
+    n_calcs = max(n_calcs, 0)
+    if n_calcs == 0:
+        return []
+    attempted_fingerprints = get_attempted_fingerprints(adsorbate, vasp_settings)
+
+    def is_candidate(doc):
+        return not isin_sorted(hash_doc(doc), attempted_fingerprints) and hash_site(doc) not in exclude
+
+    # Any subset of a uniform sample is still a uniform sample
+    docs, is_complete = sample_catalog_docs(2 * n_calcs + len(exclude), max_atoms=max_atoms)
+    if docs is not None:
+        docs = [doc for doc in docs if is_candidate(doc)]
+        if is_complete or len(docs) >= n_calcs:
+            return docs[:n_calcs]
+
+    candidates = (doc for doc in iter_catalog_docs(max_atoms=max_atoms) if is_candidate(doc))
+    return reservoir_sample(candidates, n_calcs)
+
+
+def _finish_random_tasks(docs_to_run, adsorbate, vasp_settings, metrics):
+    ''' Parses the documents that `randomly` chose into calculation tasks '''
+    with metrics.stage('make_tasks'):
+        tasks = []
+        for doc in docs_to_run:
+            task = CalculateAdsorptionEnergy(adsorbate_name=adsorbate,
+                                             adsorption_site=doc['adsorption_site'],
+                                             mpid=doc['mpid'],
+                                             miller_indices=doc['miller'],
+                                             shift=doc['shift'],
+                                             top=doc['top'],
+                                             adslab_vasp_settings=vasp_settings)
+            tasks.append(task)
+    metrics.finish()
     return tasks
@@ -0,0 +1,203 @@
+'''
+This submodule estimates how many core-hours a DFT calculation of a site will
+take from how many atoms it has, so that our selectors can trade off how
+useful a site would be against how much it would cost. The cost model is a
+power law that can be fit to the runtimes of our completed FireWorks.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+import os
+import json
+import time
+import numpy as np
+from .catalog import iter_catalog_docs
+from .fingerprints import ADSLAB_CALCULATION_TYPE, get_launchpad, hash_site
+from .utils import get_cache_dir, make_cache_key, atomic_path
+
+
+# The catalog fields that we need to match sites up with FireWorks
+_COST_FIELDS = ('mpid', 'miller', 'shift', 'top', 'adsorption_site', 'natoms')
+
+
+class CostModel(object):
+    '''
+    Estimates the cost of a calculation as `prefactor * natoms ** exponent`
+    core-hours. The defaults are rough; use `fit_cost_model` to fit them to
+    our own cluster.
+    '''
+    def __init__(self, prefactor=0.01, exponent=2.):
+        '''
+        Args:
+            prefactor   A positive float indicating the cost (in core-hours)
+                        of a one-atom calculation
+            exponent    A float indicating how steeply the cost grows with
+                        the number of atoms
+        '''
+        self.prefactor = prefactor
+        self.exponent = exponent
+
+    def __call__(self, natoms):
+        '''
+        Args:
+            natoms  An integer or a sequence of integers indicating how many
+                    atoms are in each calculation
+        Returns:
+            costs   A float or `numpy.ndarray` of floats indicating the
+                    estimated cost of each calculation, in core-hours
+        '''
+        return self.prefactor * np.asarray(natoms, dtype=float) ** self.exponent
+
+    def __repr__(self):
+        return 'CostModel(prefactor=%g, exponent=%g)' % (self.prefactor, self.exponent)
+
+    @classmethod
+    def fit(cls, natoms, core_hours):
+        '''
+        Fits a power law to observed costs with least squares in log-log
+        space.
+
+        Args:
+            natoms      A sequence of integers indicating how many atoms were
+                        in each calculation
+            core_hours  A sequence of floats indicating how many core-hours
+                        each calculation took
+        Returns:
+            cost_model  A `CostModel`
+        '''
+        natoms = np.asarray(natoms, dtype=float)
+        core_hours = np.asarray(core_hours, dtype=float)
+        is_valid = (natoms > 0) & (core_hours > 0) & np.isfinite(core_hours)
+        if len(np.unique(natoms[is_valid])) < 2:
+            raise ValueError('We need calculations of at least two different sizes '
+                             'to fit a cost model.')
+        exponent, log_prefactor = np.polyfit(np.log(natoms[is_valid]),
+                                             np.log(core_hours[is_valid]), 1)
+        return cls(prefactor=float(np.exp(log_prefactor)), exponent=float(exponent))
+
+
+def get_historical_costs(user_name=None, catalog=None, lpad=None, cores_per_job=1):
+    '''
+    Finds how many atoms and core-hours each of our completed adsorption
+    calculations took. Runtimes come from the FireWorks launches, and the
+    number of atoms comes from the catalog site that each FireWork was for.
+
+    Args:
+        user_name       [optional] A string indicating whose FireWorks to
+                        look at. If `None`, then we look at everyone's.
+        catalog         [optional] A catalog snapshot from
+                        `gaspy_feedback.catalog.get_catalog_snapshot` to
+                        reuse. If `None`, then we fetch only the catalog
+                        sites and fields that we need from Mongo.
+        lpad            [optional] A FireWorks LaunchPad to reuse. If `None`,
+                        then we open one with
+                        `gaspy.fireworks_helper_scripts.get_launchpad`.
+        cores_per_job   A positive integer indicating how many cores each
+                        FireWork ran on
+    Returns:
+        natoms      A `numpy.ndarray` of integers
+        core_hours  A `numpy.ndarray` of floats that is parallel to `natoms`
+    '''
+    if lpad is None:
+        lpad = get_launchpad()
+    query = {'state': 'COMPLETED', 'name.calculation_type': ADSLAB_CALCULATION_TYPE}
+    if user_name is not None:
+        query['name.user'] = user_name
+    pipeline = [{'$match': query},
+                {'$project': {'name': 1, 'launches': 1}},
+                {'$lookup': {'from': lpad.launches.name,
+                             'localField': 'launches',
+                             'foreignField': 'launch_id',
+                             'as': 'launch'}},
+                {'$project': {'name': 1, 'runtime_secs': {'$max': '$launch.runtime_secs'}}}]
+    runtimes = {}
+    for doc in lpad.fireworks.aggregate(pipeline, allowDiskUse=True):
+        if doc.get('runtime_secs'):
+            runtimes[hash_site(doc['name'])] = (doc['name']['mpid'], doc['runtime_secs'])
+    if not runtimes:
+        return np.array([], dtype=int), np.array([], dtype=float)
+
+    # Only hash the catalog sites whose bulks we have runtimes for
+    mpids = list(set(mpid for mpid, _ in runtimes.values()))
+    if catalog is None:
+        docs = iter_catalog_docs(mpids=mpids, fields=_COST_FIELDS)
+    else:
+        codes = np.flatnonzero(np.isin(catalog.categories['mpid'], mpids))
+        docs = (catalog.get_doc(row) for row in np.flatnonzero(np.isin(catalog['mpid'], codes)))
+    natoms = []
+    core_hours = []
+    for doc in docs:
+        runtime = runtimes.get(hash_site(doc))
+        if runtime is not None:
+            natoms.append(int(doc['natoms']))
+            core_hours.append(runtime[1] / 3600. * cores_per_job)
+    return np.array(natoms, dtype=int), np.array(core_hours, dtype=float)
+
+
+def fit_cost_model(user_name=None, catalog=None, lpad=None, cores_per_job=1, min_samples=20):
+    '''
+    Fits a `CostModel` to our completed calculations. If there are not enough
+    of them yet, then we fall back to the default `CostModel`.
+
+    Args:
+        user_name       [optional] A string indicating whose FireWorks to
+                        learn from. If `None`, then we learn from everyone's.
+        catalog         [optional] A catalog snapshot; see
+                        `get_historical_costs`
+        lpad            [optional] A FireWorks LaunchPad to reuse
+        cores_per_job   A positive integer indicating how many cores each
+                        FireWork ran on
+        min_samples     An integer indicating how many calculations we need
+                        before we trust a fit
+    Returns:
+        cost_model  A `CostModel`
+    '''
+    natoms, core_hours = get_historical_costs(user_name=user_name, catalog=catalog,
+                                              lpad=lpad, cores_per_job=cores_per_job)
+    if len(natoms) < min_samples:
+        return CostModel()
+    try:
+        return CostModel.fit(natoms, core_hours)
+    except ValueError:
+        return CostModel()
+
+
+def get_cost_model(user_name=None, max_age=86400., lpad=None, cores_per_job=1,
+                   min_samples=20, cache_dir=None):
+    '''
+    Gets a `CostModel` from `fit_cost_model`, but saves the fit in our cache
+    and reuses it until it is older than `max_age`. Use this instead of
+    `fit_cost_model` in scripts that start up often, e.g., from cron.
+
+    Args:
+        user_name       [optional] A string indicating whose FireWorks to
+                        learn from. If `None`, then we learn from everyone's.
+        max_age         A float indicating how old (in seconds) a saved fit
+                        may be before we fit again
+        lpad            [optional] A FireWorks LaunchPad to reuse
+        cores_per_job   A positive integer indicating how many cores each
+                        FireWork ran on
+        min_samples     An integer indicating how many calculations we need
+                        before we trust a fit
+        cache_dir       [optional] A string indicating where to save the fit;
+                        see `gaspy_feedback.utils.get_cache_dir`
+    Returns:
+        cost_model  A `CostModel`
+    '''
+    key = make_cache_key(user_name, cores_per_job, min_samples)
+    file_name = os.path.join(get_cache_dir(cache_dir), 'cost_model_%s.json' % key)
+    if os.path.isfile(file_name):
+        with open(file_name) as file_handle:
+            saved_fit = json.load(file_handle)
+        if time.time() - saved_fit['fitted'] <= max_age:
+            return CostModel(prefactor=saved_fit['prefactor'], exponent=saved_fit['exponent'])
+
+    cost_model = fit_cost_model(user_name=user_name, lpad=lpad,
+                                cores_per_job=cores_per_job, min_samples=min_samples)
+    with atomic_path(file_name) as temp_name:
+        with open(temp_name, 'w') as file_handle:
+            json.dump({'prefactor': cost_model.prefactor,
+                       'exponent': cost_model.exponent,
+                       'fitted': time.time()}, file_handle)
+    return cost_model
@@ -0,0 +1,237 @@
+'''
+This submodule contains a long-running daemon that keeps a user's FireWorks
+queue topped up with calculations chosen by one of our selectors. It holds a
+single LaunchPad connection for its whole lifetime and adapts how often it
+polls the queue to how quickly the queue is draining.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+import time
+import inspect
+from .quota import count_jobs_in_queue, get_launchpad
+from .submission import submit_tasks
+from .utils import accepts_argument
+
+
+def check_selector(selector, selector_kwargs):
+    '''
+    Makes sure that a selector will give us one flat list of tasks when we
+    call it with some arguments, which is what daemons, campaigns, and
+    replays need. Selectors with a `combine` argument (e.g.,
+    `gaspy_feedback.multi_target_sites_with_gaussian_noise`) give one list
+    per spec unless they are told how to combine the specs. We read the
+    default of `combine` from the selector's signature, so partials and
+    `functools.wraps` wrappers of such selectors are checked too. Selectors
+    that hide their arguments are caught by `check_tasks` instead.
+
+    Args:
+        selector        A selector function
+        selector_kwargs A dictionary of the other arguments that will be
+                        passed to the selector
+    '''
+    try:
+        parameters = inspect.signature(selector).parameters
+    except (TypeError, ValueError):
+        return
+    if 'combine' in parameters:
+        combine = selector_kwargs.get('combine', parameters['combine'].default)
+        if combine is None or combine is inspect.Parameter.empty:
+            raise ValueError('%r returns one list of tasks per spec unless it has a `combine` '
+                             'rule, but we need a single list. Pass combine="any" or combine="all".'
+                             % selector)
+
+
+def check_tasks(tasks, selector):
+    '''
+    Makes sure that a selector gave us one flat list of tasks rather than,
+    e.g., one list of tasks per spec.
+
+    Args:
+        tasks       Whatever the selector returned
+        selector    The selector, for the error message
+    Returns:
+        tasks   The same `tasks`
+    '''
+    if not isinstance(tasks, list) or any(isinstance(task, (list, tuple)) for task in tasks):
+        raise ValueError('%r should return one flat list of tasks, but it returned %.200r. '
+                         'If it selects for several specs, pass it a `combine` rule.'
+                         % (selector, tasks))
+    return tasks
+
+
+def create_fireworks_indexes(lpad=None):
+    '''
+    Indexes the FireWorks collection for the queries that daemons make over
+    and over: counting a user's ready/running FireWorks (see
+    `gaspy_feedback.quota.count_jobs_in_queue`) and finding the FireWorks that
+    changed since our in-flight index was last updated (see
+    `gaspy_feedback.fingerprints.get_in_flight_sites`). The collection is
+    shared by everyone on the LaunchPad, so we never do this on our own; call
+    this once when you set up a LaunchPad, or pass `ensure_indexes=True` to
+    `FeedbackDaemon`. It does nothing if the indexes already exist.
+
+    Args:
+        lpad    [optional] A FireWorks LaunchPad to use. If `None`, then we
+                get one from `gaspy_feedback.quota.get_launchpad`.
+    '''
+    if lpad is None:
+        lpad = get_launchpad()
+    lpad.fireworks.create_index([('name.user', 1), ('state', 1)])
+    lpad.fireworks.create_index([('updated_on', 1)])
+
+
+class FeedbackDaemon(object):
+    '''
+    Keeps a FireWorks queue filled with calculations chosen by a selector,
+    e.g., `gaspy_feedback.randomly`. Use `run` to loop forever or `tick` to do
+    a single check-and-submit cycle.
+    '''
+    def __init__(self, selector, user_name, quota=300, low_water=None,
+                 selector_kwargs=None, min_interval=60., max_interval=3600.,
+                 chunk_size=50, workers=1, ensure_indexes=False):
+        '''
+        Args:
+            selector        A function that accepts an `n_calcs` argument and
+                            returns a list of tasks, e.g.,
+                            `gaspy_feedback.orr_sites_with_gaussian_noise`
+            user_name       String indicating your user name in FireWorks
+            quota           Integer indicating the number of jobs you want to
+                            have running/ready in FireWorks at a given time
+            low_water       [optional] An integer indicating the queue size at
+                            or below which we top the queue back up to
+                            `quota`. Defaults to `quota - 1`, i.e., we submit
+                            as soon as any slot opens.
+            selector_kwargs [optional] A dictionary of the other arguments to
+                            pass to the selector, e.g., the adsorbate
+            min_interval    A float indicating the minimum number of seconds
+                            to wait between queue checks
+            max_interval    A float indicating the maximum number of seconds
+                            to wait between queue checks
+            chunk_size      A positive integer that is passed to
+                            `gaspy_feedback.submit_tasks`
+            workers         A positive integer that is passed to
+                            `gaspy_feedback.submit_tasks`
+            ensure_indexes  A Boolean indicating whether to index the shared
+                            FireWorks collection for our queries when we
+                            start; see
+                            `gaspy_feedback.daemon.create_fireworks_indexes`
+        '''
+        if selector is not None:
+            check_selector(selector, selector_kwargs or {})
+        self.selector = selector
+        self.user_name = user_name
+        self.quota = quota
+        self.low_water = quota - 1 if low_water is None else low_water
+        self.selector_kwargs = {} if selector_kwargs is None else selector_kwargs
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.chunk_size = chunk_size
+        self.workers = workers
+
+        # Open the connection once
+        self.lpad = get_launchpad()
+        if ensure_indexes:
+            create_fireworks_indexes(self.lpad)
+
+        # Jobs per second, smoothed over the ticks
+        self.drain_rate = None
+        self._last_count = None
+        self._last_time = None
+        self._interval = None
+
+    def count_jobs_in_queue(self):
+        ''' Counts this user's ready/running FireWorks over our one connection '''
+        return count_jobs_in_queue(self.user_name, lpad=self.lpad)
+
+    def tick(self):
+        '''
+        Checks the queue once, tops it up if it is at or below the low-water
+        mark, and then figures out how long to wait until the next check.
+
+        Returns:
+            interval        A float indicating how many seconds to wait before
+                            the next tick
+            submitted_tasks A list of the tasks that were submitted
+            failed_tasks    A list of `(task, exception)` tuples for the tasks
+                            that could not be submitted
+        '''
+        n_jobs = self.count_jobs_in_queue()
+        self._update_drain_rate(n_jobs)
+
+        submitted_tasks, failed_tasks = [], []
+        if n_jobs <= self.low_water:
+            tasks = self.select(self.quota - n_jobs)
+            submitted_tasks, failed_tasks = submit_tasks(tasks,
+                                                         chunk_size=self.chunk_size,
+                                                         workers=self.workers)
+            n_jobs = self.count_jobs_in_queue()
+        self._last_count = n_jobs
+        self._last_time = time.time()
+
+        interval = self._get_interval(n_jobs)
+        return interval, submitted_tasks, failed_tasks
+
+    def select(self, n_calcs):
+        '''
+        Chooses the calculations to submit. Override this to change how
+        calculations are chosen. If the selector accepts an `lpad`, then we
+        lend it ours so that it can check which sites are in flight.
+
+        Args:
+            n_calcs     An integer indicating how many calculations to choose
+        Returns:
+            tasks   A list of tasks to submit
+        '''
+        selector_kwargs = dict(self.selector_kwargs)
+        if accepts_argument(self.selector, 'lpad'):
+            selector_kwargs.setdefault('lpad', self.lpad)
+        return check_tasks(self.selector(n_calcs=n_calcs, **selector_kwargs), self.selector)
+
+    def run(self, n_ticks=None):
+        '''
+        Calls `tick` repeatedly, sleeping for as long as each tick tells us to.
+
+        Args:
+            n_ticks     [optional] An integer indicating how many ticks to do
+                        before returning. If `None`, then run forever.
+        '''
+        n_done = 0
+        while n_ticks is None or n_done < n_ticks:
+            interval, _, _ = self.tick()
+            n_done += 1
+            if n_ticks is None or n_done < n_ticks:
+                time.sleep(interval)
+
+    def _update_drain_rate(self, n_jobs, smoothing=0.5):
+        '''
+        Estimates how quickly jobs leave the queue using an exponentially
+        weighted average of what we saw between the last tick and this one.
+        '''
+        if self._last_count is None:
+            return
+        elapsed = time.time() - self._last_time
+        if elapsed <= 0:
+            return
+        rate = max(self._last_count - n_jobs, 0) / elapsed
+        if self.drain_rate is None:
+            self.drain_rate = rate
+        else:
+            self.drain_rate = smoothing * rate + (1 - smoothing) * self.drain_rate
+
+    def _get_interval(self, n_jobs):
+        '''
+        Waits for about as long as it should take the queue to drain down to
+        the low-water mark, within our minimum and maximum intervals. If we
+        have not seen the queue drain yet, then we back off geometrically.
+        '''
+        if not self.drain_rate:
+            if self._interval is None:
+                interval = self.min_interval
+            else:
+                interval = 2 * self._interval
+        else:
+            interval = (n_jobs - self.low_water) / self.drain_rate
+        self._interval = min(max(interval, self.min_interval), self.max_interval)
+        return self._interval
@@ -0,0 +1,349 @@
+'''
+This submodule contains functions that fingerprint adsorption sites and that
+keep on-disk indices of the sites that we have already attempted to calculate
+and of the sites that are still in flight in FireWorks. The indices are
+updated incrementally, so each call only needs to pull the documents that were
+added (or changed) since the last call.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+import os
+import hashlib
+import datetime
+import contextlib
+import numpy as np
+from bson import ObjectId
+from .utils import atomic_path, get_cache_dir, get_overlap_id, make_cache_key, lazy_import
+
+
+get_mongo_collection = lazy_import('gaspy.gasdb', 'get_mongo_collection')
+get_launchpad = lazy_import('gaspy.fireworks_helper_scripts', 'get_launchpad')
+
+
+# The FireWorks that calculate adsorption energies, and the states in which
+# they count as in flight
+ADSLAB_CALCULATION_TYPE = 'slab+adsorbate optimization'
+IN_FLIGHT_STATES = ['WAITING', 'READY', 'RESERVED', 'RUNNING']
+
+# When this is a dictionary, `get_attempted_fingerprints` and
+# `get_in_flight_sites` memoize into it
+_shared_fingerprints = None
+
+
+def fingerprint_doc(doc):
+    '''
+    Creates a hashable fingerprint of an adsorption site.
+
+    Args:
+        doc     A dictionary with the 'mpid', 'miller', 'shift', 'top',
+                'adsorption_site', 'coordination', and 'neighborcoord' keys
+    Returns:
+        fingerprint     A tuple of the values of the keys above
+    '''
+    fingerprint = (doc['mpid'],
+                   tuple(doc['miller']),
+                   doc['shift'],
+                   doc['top'],
+                   tuple(doc['adsorption_site']),
+                   doc['coordination'],
+                   tuple(doc['neighborcoord']))
+    return fingerprint
+
+
+def hash_doc(doc):
+    '''
+    Hashes the fingerprint of an adsorption site into a 64-bit integer. Unlike
+    Python's built-in `hash`, this hash is stable across processes, so we can
+    save it to disk.
+
+    Args:
+        doc     A dictionary with the keys needed by `fingerprint_doc`
+    Returns:
+        fingerprint_hash    A non-negative integer less than 2**64
+    '''
+    mpid, miller, shift, top, site, coordination, neighborcoord = fingerprint_doc(doc)
+
+    # Normalize the types so that, e.g., a shift of `0` and `0.` hash the same
+    fingerprint = (str(mpid),
+                   tuple(int(index) for index in miller),
+                   float(shift),
+                   bool(top),
+                   tuple(float(coordinate) for coordinate in site),
+                   str(coordination),
+                   tuple(str(neighbor) for neighbor in neighborcoord))
+    digest = hashlib.blake2b(repr(fingerprint).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def hash_site(doc):
+    '''
+    Hashes only where a calculation would be done---i.e., the surface and the
+    adsorption site---into a 64-bit integer. Unlike `hash_doc`, this does not
+    need the coordination of the site, so it works on both catalog documents
+    and `CalculateAdsorptionEnergy` tasks (see `hash_task`).
+
+    Args:
+        doc     A dictionary with the 'mpid', 'miller', 'shift', 'top', and
+                'adsorption_site' keys
+    Returns:
+        site_hash   A non-negative integer less than 2**64
+    '''
+    site = (str(doc['mpid']),
+            tuple(int(index) for index in doc['miller']),
+            float(doc['shift']),
+            bool(doc['top']),
+            tuple(float(coordinate) for coordinate in doc['adsorption_site']))
+    digest = hashlib.blake2b(repr(site).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def hash_task(task):
+    '''
+    Calculates the `hash_site` of a `CalculateAdsorptionEnergy` task.
+
+    Args:
+        task    A `gaspy.tasks.metadata_calculators.CalculateAdsorptionEnergy`
+                instance
+    Returns:
+        site_hash   A non-negative integer less than 2**64
+    '''
+    doc = {'mpid': task.mpid,
+           'miller': task.miller_indices,
+           'shift': task.shift,
+           'top': task.top,
+           'adsorption_site': task.adsorption_site}
+    return hash_site(doc)
+
+
+def get_attempted_fingerprints(adsorbate, vasp_settings, cache_dir=None):
+    '''
+    Gets the hashed fingerprints of all the adsorption sites that we have
+    attempted to calculate, whether or not they succeeded. We keep an on-disk
+    index of these hashes along with the ID of the newest document we have
+    seen, and so each call only fetches the documents that are newer than
+    that (less a small overlap; see `gaspy_feedback.utils.get_overlap_id`).
+
+    Args:
+        adsorbate       A string indicating the adsorbate
+        vasp_settings   An OrderedDict containing the VASP settings of the
+                        calculations you want to look at; see
+                        `gaspy.defaults.adslab_settings()['vasp']`
+        cache_dir       [optional] A string indicating the directory to store
+                        the index in. See `gaspy_feedback.utils.get_cache_dir`.
+    Returns:
+        fingerprint_hashes  A sorted `numpy.ndarray` of unique `numpy.uint64`
+                            integers, each of which is the `hash_doc` of an
+                            attempted adsorption site. Check membership with
+                            `isin_sorted`.
+    '''
+    file_name = 'attempted_%s_%s.npz' % (adsorbate, make_cache_key(adsorbate, vasp_settings))
+    index_path = os.path.join(get_cache_dir(cache_dir), file_name)
+    if _shared_fingerprints is not None and index_path in _shared_fingerprints:
+        return _shared_fingerprints[index_path]
+    hashes, high_water = _load_fingerprint_index(index_path)
+
+    # Only hash the documents that landed since the last update. Re-reading
+    # the overlap is harmless because the union ignores hashes we have.
+    new_docs = _get_attempted_adsorption_docs_after(adsorbate, vasp_settings, high_water)
+    if new_docs:
+        new_hashes = np.array([hash_doc(doc) for doc in new_docs], dtype=np.uint64)
+        n_hashes = len(hashes)
+        hashes = np.union1d(hashes, new_hashes)
+        newest_id = new_docs[-1]['_id']
+        if high_water is not None:
+            newest_id = max(newest_id, ObjectId(high_water))
+        if len(hashes) > n_hashes or str(newest_id) != high_water:
+            high_water = str(newest_id)
+            _save_fingerprint_index(index_path, hashes, high_water)
+
+    if _shared_fingerprints is not None:
+        _shared_fingerprints[index_path] = hashes
+    return hashes
+
+
+def get_in_flight_sites(adsorbate, lpad=None, cache_dir=None):
+    '''
+    Gets the hashed sites of all the adsorption calculations that are still
+    in flight in FireWorks---i.e., that have been submitted but that have not
+    finished, and so are not in our adsorption collection yet. We keep an
+    on-disk index of these FireWorks along with the latest `updated_on` time
+    that we have seen, and so each call only fetches the FireWorks that were
+    added or that changed state since then.
+
+    Args:
+        adsorbate   A string indicating the adsorbate
+        lpad        [optional] A FireWorks LaunchPad to reuse. If `None`, then
+                    we open one with
+                    `gaspy.fireworks_helper_scripts.get_launchpad`.
+        cache_dir   [optional] A string indicating the directory to store the
+                    index in. See `gaspy_feedback.utils.get_cache_dir`.
+    Returns:
+        site_hashes     A sorted `numpy.ndarray` of unique `numpy.uint64`
+                        integers, each of which is the `hash_site` of an
+                        in-flight calculation
+    '''
+    if lpad is None:
+        lpad = get_launchpad()
+    launchpad_key = make_cache_key(adsorbate, getattr(lpad, 'host', None), getattr(lpad, 'name', None))
+    file_name = 'in_flight_%s_%s.npz' % (adsorbate, launchpad_key)
+    index_path = os.path.join(get_cache_dir(cache_dir), file_name)
+    if _shared_fingerprints is not None and index_path in _shared_fingerprints:
+        return _shared_fingerprints[index_path]
+    fw_ids, hashes, high_water = _load_in_flight_index(index_path)
+
+    # Forget every FireWork that changed since the last update, then add back
+    # the ones that are still in flight. FireWorks stores `updated_on` as an
+    # ISO string when it inserts a FireWork but as a datetime when it changes
+    # its state, and Mongo never compares the two types, so we ask for both.
+    query = {'name.calculation_type': ADSLAB_CALCULATION_TYPE, 'name.adsorbate': adsorbate}
+    if high_water is not None:
+        query['$or'] = [{'updated_on': {'$gte': high_water}},
+                        {'updated_on': {'$gte': high_water.isoformat()}}]
+    projection = {'fw_id': 1, 'state': 1, 'updated_on': 1,
+                  'name.mpid': 1, 'name.miller': 1, 'name.shift': 1, 'name.top': 1,
+                  'name.adsorption_site': 1}
+    changed_docs = {doc['fw_id']: doc for doc in lpad.fireworks.find(query, projection)}
+    if changed_docs:
+        is_unchanged = ~np.isin(fw_ids, np.fromiter(changed_docs, dtype=np.int64,
+                                                    count=len(changed_docs)))
+        in_flight_docs = [doc for doc in changed_docs.values() if doc['state'] in IN_FLIGHT_STATES]
+        fw_ids = np.concatenate([fw_ids[is_unchanged],
+                                 np.array([doc['fw_id'] for doc in in_flight_docs], dtype=np.int64)])
+        hashes = np.concatenate([hashes[is_unchanged],
+                                 np.array([hash_site(doc['name']) for doc in in_flight_docs],
+                                          dtype=np.uint64)])
+        high_water = max(_parse_updated_on(doc['updated_on']) for doc in changed_docs.values())
+        _save_in_flight_index(index_path, fw_ids, hashes, high_water)
+
+    site_hashes = np.unique(hashes)
+    if _shared_fingerprints is not None:
+        _shared_fingerprints[index_path] = site_hashes
+    return site_hashes
+
+
+def isin_sorted(hashes, sorted_hashes):
+    '''
+    Checks hashes against a sorted array of hashes, e.g., the output of
+    `get_attempted_fingerprints`, with a binary search instead of a set.
+
+    Args:
+        hashes          An integer or a `numpy.ndarray` of integers
+        sorted_hashes   A sorted `numpy.ndarray` of `numpy.uint64` integers
+    Returns:
+        is_in   A Boolean (or a Boolean `numpy.ndarray` that is parallel to
+                `hashes`) indicating which hashes are in `sorted_hashes`
+    '''
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    if len(sorted_hashes) == 0:
+        return np.zeros(hashes.shape, dtype=bool)[()]
+    positions = np.minimum(np.searchsorted(sorted_hashes, hashes), len(sorted_hashes) - 1)
+    return sorted_hashes[positions] == hashes
+
+
+@contextlib.contextmanager
+def sharing_attempted_fingerprints():
+    '''
+    Within this context, `get_attempted_fingerprints` and
+    `get_in_flight_sites` query Mongo at most once per adsorbate (and set of
+    VASP settings), and every caller gets the same array. This lets several
+    selectors share one update of each index, e.g., within one tick of
+    `gaspy_feedback.campaigns.CampaignScheduler`.
+    '''
+    global _shared_fingerprints
+    previous = _shared_fingerprints
+    if previous is None:
+        _shared_fingerprints = {}
+    try:
+        yield
+    finally:
+        _shared_fingerprints = previous
+
+
+def _load_fingerprint_index(index_path):
+    '''
+    Reads an index that was saved by `_save_fingerprint_index`. Returns an
+    empty index if there is none yet.
+    '''
+    if not os.path.isfile(index_path):
+        return np.array([], dtype=np.uint64), None
+    with np.load(index_path) as index:
+        hashes = index['hashes']
+        high_water = str(index['high_water']) or None
+    return hashes, high_water
+
+
+def _save_fingerprint_index(index_path, hashes, high_water):
+    '''
+    Atomically saves an index of fingerprint hashes along with the ID of the
+    newest document that went into it.
+    '''
+    with atomic_path(index_path) as temp_path:
+        np.savez(temp_path, hashes=hashes, high_water=np.array(high_water or ''))
+
+
+def _load_in_flight_index(index_path):
+    '''
+    Reads an index that was saved by `_save_in_flight_index`. Returns an empty
+    index if there is none yet.
+    '''
+    if not os.path.isfile(index_path):
+        return np.array([], dtype=np.int64), np.array([], dtype=np.uint64), None
+    with np.load(index_path) as index:
+        fw_ids = index['fw_ids']
+        hashes = index['hashes']
+        high_water = str(index['high_water']) or None
+    if high_water is not None:
+        high_water = datetime.datetime.fromisoformat(high_water)
+    return fw_ids, hashes, high_water
+
+
+def _save_in_flight_index(index_path, fw_ids, hashes, high_water):
+    '''
+    Atomically saves an index of in-flight FireWorks along with the latest
+    `updated_on` time that went into it.
+    '''
+    with atomic_path(index_path) as temp_path:
+        np.savez(temp_path, fw_ids=fw_ids, hashes=hashes,
+                 high_water=np.array(high_water.isoformat() if high_water is not None else ''))
+
+
+def _parse_updated_on(updated_on):
+    '''
+    Turns the `updated_on` field of a FireWork into a `datetime.datetime`,
+    whether FireWorks saved it as one or as an ISO string.
+    '''
+    if isinstance(updated_on, str):
+        return datetime.datetime.fromisoformat(updated_on)
+    return updated_on
+
+
+def _get_attempted_adsorption_docs_after(adsorbate, vasp_settings, high_water=None):
+    '''
+    Fetches the fingerprints of attempted adsorption calculations, just like
+    `gaspy.gasdb._get_attempted_adsorption_docs`, but only for documents whose
+    `_id` is at least `gaspy_feedback.utils.get_overlap_id(high_water)`.
+    Documents are sorted by `_id` so that the last one is the new high-water
+    mark.
+    '''
+    filters = {'adsorbate': adsorbate}
+    for setting, value in vasp_settings.items():
+        filters['vasp_settings.%s' % setting] = value
+    if high_water is not None:
+        filters['_id'] = {'$gte': get_overlap_id(ObjectId(high_water))}
+
+    fingerprints = {'_id': 1,
+                    'mpid': '$mpid',
+                    'miller': '$miller',
+                    'shift': '$shift',
+                    'top': '$top',
+                    'adsorption_site': '$adsorption_site',
+                    'coordination': '$fp_init.coordination',
+                    'neighborcoord': '$fp_init.neighborcoord'}
+    pipeline = [{'$match': filters},
+                {'$sort': {'_id': 1}},
+                {'$project': fingerprints}]
+    with get_mongo_collection('adsorption') as collection:
+        docs = list(collection.aggregate(pipeline, allowDiskUse=True))
+    return docs
@@ -0,0 +1,209 @@
+'''
+This submodule records how long each stage of a selector takes (e.g.,
+fetching, filtering, deduplicating, weighting, sampling, and making tasks) and
+how many documents each stage handled. Recording is off unless you register a
+sink with `add_metrics_sink` or use `collecting_metrics`; when it is off, each
+stage costs one attribute lookup and an empty `with` block.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+import json
+import time
+import contextlib
+from collections import OrderedDict
+from .utils import atomic_path
+
+
+_sinks = []
+
+
+class SelectionMetrics(object):
+    '''
+    The durations and document counts of each stage of one selector call.
+
+    Attributes:
+        selector    A string indicating which selector was called
+        started     A float indicating when the call started (Unix time)
+        stages      An OrderedDict whose keys are stage names and whose values
+                    are dictionaries with the 'seconds' and (optionally)
+                    'n_docs' keys
+        total       A float indicating how many seconds the whole call took
+    '''
+    enabled = True
+
+    def __init__(self, selector):
+        self.selector = selector
+        self.started = time.time()
+        self.stages = OrderedDict()
+        self.total = None
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Times the code inside a `with` block as a stage.
+
+        Args:
+            name    A string indicating the name of the stage
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = self.stages.setdefault(name, {'seconds': 0.})
+            record['seconds'] += time.perf_counter() - start
+
+    def count(self, name, n_docs):
+        '''
+        Records how many documents a stage left us with.
+
+        Args:
+            name    A string indicating the name of the stage
+            n_docs  An integer indicating the number of documents
+        '''
+        self.stages.setdefault(name, {'seconds': 0.})['n_docs'] = int(n_docs)
+
+    def finish(self):
+        ''' Stops the clock and hands these metrics to every sink '''
+        self.total = time.perf_counter() - self._start
+        for sink in list(_sinks):
+            sink(self)
+
+    def to_dict(self):
+        ''' Turns these metrics into a JSON-serializable dictionary '''
+        return {'selector': self.selector,
+                'started': self.started,
+                'total_seconds': self.total,
+                'stages': self.stages}
+
+
+class _NullMetrics(object):
+    ''' Stands in for `SelectionMetrics` when nothing is listening '''
+    enabled = False
+
+    def stage(self, name):
+        return _NULL_CONTEXT
+
+    def count(self, name, n_docs):
+        pass
+
+    def finish(self):
+        pass
+
+
+class _NullContext(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_CONTEXT = _NullContext()
+_NULL_METRICS = _NullMetrics()
+
+
+def start_metrics(selector):
+    '''
+    Starts recording the metrics of a selector call. Selectors should call
+    this once at the start and `finish` on the result at the end.
+
+    Args:
+        selector    A string indicating which selector is being called
+    Returns:
+        metrics     A `SelectionMetrics` instance if any sinks are registered,
+                    or a no-op stand-in otherwise
+    '''
+    if not _sinks:
+        return _NULL_METRICS
+    return SelectionMetrics(selector)
+
+
+def add_metrics_sink(sink):
+    '''
+    Registers a sink for our metrics.
+
+    Args:
+        sink    A function that accepts a `SelectionMetrics` instance, e.g., a
+                `JSONLinesSink` or a `PrometheusTextSink`
+    '''
+    _sinks.append(sink)
+
+
+def remove_metrics_sink(sink):
+    ''' Unregisters a sink that was registered with `add_metrics_sink` '''
+    _sinks.remove(sink)
+
+
+@contextlib.contextmanager
+def collecting_metrics():
+    '''
+    Collects the metrics of every selector call made inside a `with` block,
+    e.g.,
+
+        with collecting_metrics() as metrics:
+            tasks = randomly('CO')
+        print(metrics[0].stages)
+
+    Yields:
+        metrics     A list that each call's `SelectionMetrics` is appended to
+    '''
+    metrics = []
+    add_metrics_sink(metrics.append)
+    try:
+        yield metrics
+    finally:
+        remove_metrics_sink(metrics.append)
+
+
+class JSONLinesSink(object):
+    ''' Appends each selector call's metrics to a JSON lines file '''
+    def __init__(self, path):
+        '''
+        Args:
+            path    A string indicating the file to append to
+        '''
+        self.path = path
+
+    def __call__(self, metrics):
+        with open(self.path, 'a') as file_handle:
+            file_handle.write(json.dumps(metrics.to_dict()) + '\n')
+
+
+class PrometheusTextSink(object):
+    '''
+    Keeps a file in Prometheus' text exposition format up to date with the
+    latest metrics of each selector, e.g., for node_exporter's textfile
+    collector.
+    '''
+    def __init__(self, path):
+        '''
+        Args:
+            path    A string indicating the file to write
+        '''
+        self.path = path
+        self.latest = OrderedDict()
+
+    def __call__(self, metrics):
+        self.latest[metrics.selector] = metrics
+
+        # Group the samples by metric family, as the format requires
+        totals = ['# TYPE gaspy_feedback_selection_seconds gauge']
+        seconds = ['# TYPE gaspy_feedback_stage_seconds gauge']
+        docs = ['# TYPE gaspy_feedback_stage_docs gauge']
+        for selector, selector_metrics in self.latest.items():
+            totals.append('gaspy_feedback_selection_seconds{selector="%s"} %f'
+                          % (selector, selector_metrics.total))
+            for stage, record in selector_metrics.stages.items():
+                labels = 'selector="%s",stage="%s"' % (selector, stage)
+                seconds.append('gaspy_feedback_stage_seconds{%s} %f' % (labels, record['seconds']))
+                if 'n_docs' in record:
+                    docs.append('gaspy_feedback_stage_docs{%s} %d' % (labels, record['n_docs']))
+        lines = totals + seconds + docs
+
+        # Write atomically so that the collector never reads half a file
+        with atomic_path(self.path) as temp_path:
+            with open(temp_path, 'w') as file_handle:
+                file_handle.write('\n'.join(lines) + '\n')
@@ -0,0 +1,192 @@
+'''
+This submodule scores candidate sites across a pool of processes. The
+candidates are sorted by mpid and split into shards that never split a bulk;
+each worker filters, deduplicates, weights, and keys its own shards, and then
+we merge the per-shard winners into one sample. The columns that the workers
+need are put into shared memory once instead of being pickled for each shard.
+
+Because every candidate's key comes from `counter_gumbel_keys`, a candidate
+gets the same key in every shard layout, so the merged sample is exactly the
+one that a single process would draw with the same seed.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from .fingerprints import isin_sorted
+from .sampling import gaussian_log_weights, counter_gumbel_keys, top_k
+
+
+# The arrays that each worker process attached to when it started
+_worker_arrays = {}
+
+
+def get_n_workers(n_workers=None):
+    '''
+    Figures out how many processes to score candidates with. Set the
+    `GASPY_FEEDBACK_WORKERS` environment variable to change the default.
+
+    Args:
+        n_workers   [optional] A positive integer. If `None`, then we use the
+                    environment variable, or 1 if that is not set either.
+    Returns:
+        n_workers   A positive integer, capped at the number of CPUs
+    '''
+    if n_workers is None:
+        n_workers = int(os.environ.get('GASPY_FEEDBACK_WORKERS', 1))
+    return max(min(int(n_workers), os.cpu_count() or 1), 1)
+
+
+def sharded_gaussian_sample(sites, values, target, stdev, k, n_workers=None,
+                            max_atoms=None, skip=None, attempted_fingerprints=None,
+                            n_repeats=1, seed=None):
+    '''
+    Draws `k` candidates without replacement with Gaussian weights centered
+    at `target`, scoring shards of the candidates in parallel.
+
+    Args:
+        sites                   A `gaspy_feedback.sites.SiteTable`
+        values                  A `numpy.ndarray` of floats that is parallel to
+                                `sites`, e.g., predicted adsorption energies.
+                                NaNs are never chosen.
+        target                  A float indicating the center of the Gaussian
+        stdev                   A float indicating the standard deviation of
+                                the Gaussian
+        k                       An integer indicating how many candidates to
+                                draw
+        n_workers               [optional] A positive integer indicating how
+                                many processes to use; see `get_n_workers`
+        max_atoms               [optional] An integer indicating the maximum
+                                number of atoms that a site may have
+        skip                    [optional] A Boolean `numpy.ndarray` that is
+                                parallel to `sites` and that is `True` for
+                                sites that should never be chosen
+        attempted_fingerprints  [optional] A sorted `numpy.ndarray` of
+                                `hash_doc` integers, e.g., from
+                                `gaspy_feedback.fingerprints.get_attempted_fingerprints`.
+                                If given, then sites whose 'fingerprint' is in
+                                it are never chosen.
+        n_repeats               An integer indicating how many candidates
+                                each site stands for (e.g., one per adsorbate
+                                rotation). Every repeat of a site has the same
+                                weight.
+        seed                    [optional] An integer to seed the keys with.
+                                If `None`, then we draw one from the global
+                                `numpy.random` state.
+    Returns:
+        candidates      A `numpy.ndarray` of integers indicating the chosen
+                        candidates, in the order that they were drawn. Site
+                        `i`'s repeats are the candidates `i * n_repeats`
+                        through `i * n_repeats + n_repeats - 1`.
+        n_candidates    An integer indicating how many candidates were left
+                        after filtering and deduplicating
+    '''
+    if seed is None:
+        seed = int(np.random.randint(2**62))
+    n_workers = get_n_workers(n_workers)
+
+    arrays = {'order': np.argsort(sites['mpid'], kind='stable'),
+              'values': np.asarray(values, dtype=float)}
+    if max_atoms is not None:
+        arrays['natoms'] = np.asarray(sites['natoms'])
+    if skip is not None:
+        arrays['skip'] = np.asarray(skip, dtype=bool)
+    if attempted_fingerprints is not None:
+        arrays['fingerprint'] = np.asarray(sites['fingerprint'])
+        arrays['attempted'] = np.asarray(attempted_fingerprints, dtype=np.uint64)
+    parameters = {'target': target, 'stdev': stdev, 'k': max(int(k), 0),
+                  'max_atoms': max_atoms, 'n_repeats': n_repeats, 'seed': seed}
+
+    if n_workers <= 1 or len(sites) == 0:
+        results = [_score_rows(arrays, arrays['order'], **parameters)]
+    else:
+        shards = _split_by_group(sites['mpid'][arrays['order']], 4 * n_workers)
+        results = _score_shards_in_parallel(arrays, shards, parameters, n_workers)
+
+    # The best k of the shards' best k are the best k overall
+    candidates = np.concatenate([result[0] for result in results])
+    keys = np.concatenate([result[1] for result in results])
+    n_candidates = sum(result[2] for result in results)
+    return candidates[top_k(keys, k)], n_candidates
+
+
+def _score_rows(arrays, rows, target, stdev, k, max_atoms, n_repeats, seed):
+    '''
+    Filters, deduplicates, weights, and keys some rows, then keeps the best
+    `k` of them.
+
+    Returns:
+        candidates      A `numpy.ndarray` of the best candidates' IDs
+        keys            A `numpy.ndarray` of their keys
+        n_candidates    An integer indicating how many candidates there were
+    '''
+    is_candidate = np.ones(len(rows), dtype=bool)
+    if 'natoms' in arrays:
+        is_candidate &= arrays['natoms'][rows] <= max_atoms
+    if 'skip' in arrays:
+        is_candidate &= ~arrays['skip'][rows]
+    if 'attempted' in arrays:
+        is_candidate &= ~isin_sorted(arrays['fingerprint'][rows], arrays['attempted'])
+    rows = rows[is_candidate]
+
+    log_weights = np.repeat(gaussian_log_weights(arrays['values'][rows], target, stdev), n_repeats)
+    candidates = (rows[:, np.newaxis] * n_repeats + np.arange(n_repeats)).ravel()
+    keys = counter_gumbel_keys(log_weights, candidates, seed)
+    best = top_k(keys, k)
+    return candidates[best], keys[best], len(candidates)
+
+
+def _split_by_group(sorted_codes, n_shards):
+    '''
+    Splits a sorted array into about `n_shards` contiguous pieces of similar
+    size without splitting any run of equal codes.
+
+    Returns:
+        shards  A list of `(start, stop)` tuples
+    '''
+    n_rows = len(sorted_codes)
+    targets = np.linspace(0, n_rows, n_shards + 1).astype(int)[1:-1]
+    targets = targets[targets < n_rows]
+    bounds = np.searchsorted(sorted_codes, sorted_codes[targets], side='left')
+    bounds = np.unique(np.concatenate([[0], bounds, [n_rows]]))
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def _score_shards_in_parallel(arrays, shards, parameters, n_workers):
+    ''' Copies the arrays into shared memory and scores each shard in a pool '''
+    blocks = []
+    try:
+        specs = {}
+        for name, array in arrays.items():
+            block = SharedMemory(create=True, size=max(array.nbytes, 1))
+            blocks.append(block)
+            np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+            specs[name] = (block.name, array.shape, array.dtype.str)
+
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 initializer=_attach_arrays,
+                                 initargs=(specs,)) as executor:
+            futures = [executor.submit(_score_shard, start, stop, parameters)
+                       for start, stop in shards]
+            return [future.result() for future in futures]
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+
+def _attach_arrays(specs):
+    ''' Runs once in each worker to attach to the shared arrays '''
+    for name, (block_name, shape, dtype) in specs.items():
+        block = SharedMemory(name=block_name)
+        _worker_arrays[name] = (block, np.ndarray(shape, dtype, buffer=block.buf))
+
+
+def _score_shard(start, stop, parameters):
+    ''' Runs in a worker to score the rows in one shard '''
+    arrays = {name: array for name, (_, array) in _worker_arrays.items()}
+    return _score_rows(arrays, arrays['order'][start:stop], **parameters)
@@ -0,0 +1,78 @@
+'''
+This submodule figures out whether our FireWorks queue has room for more
+calculations. It only needs a LaunchPad, so cron-launched runs can check the
+queue (and exit early if it is full) without importing the catalog, sampling,
+or task machinery.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+from .utils import lazy_import
+
+
+get_launchpad = lazy_import('gaspy.fireworks_helper_scripts', 'get_launchpad')
+
+
+def get_n_jobs_to_submit(user_name, quota=300, lpad=None):
+    '''
+    This function helps you figure out how many jobs you should submit by
+    calculating the difference between your quota of jobs in queue and the
+    number of jobs you actually have in queue.
+
+    Args:
+        user_name   String indicating your user name in FireWorks
+        quota       Integer indicating the number of jobs you want to
+                    have running/ready in FireWorks at a given time.
+        lpad        [optional] A FireWorks LaunchPad to reuse. If `None`, then
+                    we open one with `gaspy.fireworks_helper_scripts.get_launchpad`.
+    Returns:
+        n_jobs_to_submit    The integer difference between the number of jobs
+                            you have running and the number you want running.
+    '''
+    n_jobs_running = count_jobs_in_queue(user_name, lpad=lpad)
+    n_jobs_to_submit = quota - n_jobs_running
+    return n_jobs_to_submit
+
+
+def count_jobs_in_queue(user_name, lpad=None):
+    '''
+    Counts how many of a user's FireWorks are either ready or running.
+
+    Args:
+        user_name   String indicating your user name in FireWorks
+        lpad        [optional] A FireWorks LaunchPad to reuse. If `None`, then
+                    we open one with `gaspy.fireworks_helper_scripts.get_launchpad`.
+    Returns:
+        n_jobs  An integer indicating the number of ready/running FireWorks
+    '''
+    if lpad is None:
+        lpad = get_launchpad()
+    query = {'name.user': user_name, 'state': {'$in': ['READY', 'RUNNING']}}
+    n_jobs = lpad.fireworks.count_documents(query)
+    return n_jobs
+
+
+def has_room_in_queue(user_name, quota=300, low_water=None, lpad=None):
+    '''
+    Checks whether a user's queue has drained enough to be worth topping up.
+    This is the cheap check to run before importing or calling any selector.
+
+    Args:
+        user_name   String indicating your user name in FireWorks
+        quota       Integer indicating the number of jobs you want to have
+                    running/ready in FireWorks at a given time
+        low_water   [optional] An integer indicating the queue size at or
+                    below which the queue should be topped up. Defaults to
+                    `quota - 1`, i.e., any open slot counts as room.
+        lpad        [optional] A FireWorks LaunchPad to reuse
+    Returns:
+        n_jobs_to_submit    An integer indicating how many jobs to submit,
+                            which is zero if the queue is above `low_water`
+    '''
+    if low_water is None:
+        low_water = quota - 1
+    n_jobs = count_jobs_in_queue(user_name, lpad=lpad)
+    if n_jobs > low_water:
+        return 0
+    return quota - n_jobs
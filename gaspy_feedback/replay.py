@@ -0,0 +1,509 @@
+'''
+This submodule replays our feedback loop offline so that we can compare
+selection strategies (and tune their targets and standard deviations) in
+minutes instead of in weeks of cluster time. We export the catalog sites whose
+DFT results we already know, along with their predictions, and then simulate
+feedback ticks against an in-process stand-in for our databases: each tick
+calls a real selector, "calculates" the sites it chose by revealing their
+known results, and charges them core-hours with a `gaspy_feedback.cost`
+model.
+
+Note that a replay can only choose from sites whose results we already know,
+and that predictions do not change as results come in, since we do not retrain
+the surrogate models between ticks.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+import os
+import json
+import time
+import tempfile
+import itertools
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .catalog import CATALOG_FIELDS, _get_field, _latest_prediction
+from .cost import CostModel, fit_cost_model
+from .daemon import check_selector, check_tasks
+from .fingerprints import hash_doc, hash_site, hash_task
+from .parallel import get_n_workers
+from .utils import accepts_argument, atomic_path, lazy_import
+
+
+defaults = lazy_import('gaspy.defaults')
+get_mongo_collection = lazy_import('gaspy.gasdb', 'get_mongo_collection')
+
+# The data that each worker process loaded when it started
+_worker_data = None
+
+
+class ReplayLaunchPad(object):
+    ''' An in-process stand-in for a FireWorks LaunchPad '''
+    def __init__(self, fireworks_collection):
+        self.fireworks = fireworks_collection
+        self.host = 'localhost'
+        self.name = 'replay_fireworks'
+
+
+class ReplayDatabase(object):
+    '''
+    An in-process stand-in for the parts of `gaspy.gasdb` and of our FireWorks
+    LaunchPad that our selectors use. The `catalog`, `adsorption`, and
+    `fireworks` collections are served by `mongomock`, and the aggregating
+    functions are reimplemented over plain lists. Use `installed` to point
+    our selectors at it.
+    '''
+    def __init__(self, catalog_docs, adsorption_docs=None, fireworks_docs=None):
+        '''
+        Args:
+            catalog_docs    A list of raw catalog documents, with their '_id'
+                            and 'predictions'
+            adsorption_docs [optional] A list of raw adsorption documents of
+                            the calculations that were already attempted.
+                            Those with an 'adsorption_energy' count as DFT
+                            results in `get_low_coverage_docs`.
+            fireworks_docs  [optional] A list of FireWorks documents
+        '''
+        import mongomock
+
+        self.catalog_docs = catalog_docs
+        client = mongomock.MongoClient()
+        self.collections = {'catalog': client.db.catalog,
+                            'adsorption': client.db.adsorption}
+        if catalog_docs:
+            self.collections['catalog'].insert_many(catalog_docs)
+        self.lpad = ReplayLaunchPad(client.fireworks.fireworks)
+        if fireworks_docs:
+            self.lpad.fireworks.insert_many([dict(doc) for doc in fireworks_docs])
+
+        # Flatten the catalog the same way `gaspy.gasdb` does
+        self.unsimulated_docs = []
+        self._unsimulated_hashes = []
+        for doc in catalog_docs:
+            flat_doc = {key: value for key, value in doc.items() if key not in ('_id', 'predictions')}
+            flat_doc['mongo_id'] = doc['_id']
+            self.unsimulated_docs.append(flat_doc)
+            self._unsimulated_hashes.append(hash_doc(flat_doc))
+        self._dft_energies = {}
+        self.record_calculations(adsorption_docs or [])
+
+    @contextlib.contextmanager
+    def get_mongo_collection(self, collection_tag):
+        ''' Mimics `gaspy.gasdb.get_mongo_collection` '''
+        yield self.collections[collection_tag]
+
+    def get_launchpad(self):
+        ''' Mimics `gaspy.fireworks_helper_scripts.get_launchpad` '''
+        return self.lpad
+
+    def get_unsimulated_catalog_docs(self, adsorbate, rotation_list=None, vasp_settings=None):
+        ''' Mimics `gaspy.gasdb.get_unsimulated_catalog_docs` '''
+        if rotation_list is None:
+            rotation_list = [{'phi': 0., 'theta': 0., 'psi': 0.}]
+        docs = []
+        for rotation in rotation_list:
+            for doc in self.unsimulated_docs:
+                doc = dict(doc)
+                doc['adsorbate_rotation'] = rotation
+                docs.append(doc)
+        return docs
+
+    def get_low_coverage_docs(self, adsorbate, model_tag):
+        '''
+        Mimics `gaspy.gasdb.get_low_coverage_docs`: the lowest-energy site of
+        each surface, where sites that we have DFT results for use those
+        instead of their predictions.
+        '''
+        path = 'predictions.adsorption_energy.%s.%s' % (adsorbate, model_tag)
+        lowest_docs = {}
+        for doc in self.catalog_docs:
+            energy = _latest_prediction(_get_field(doc, path))
+            is_calculated = False
+            if self._dft_energies:
+                dft_energy = self._dft_energies.get((adsorbate, hash_doc(doc)))
+                if dft_energy is not None:
+                    energy, is_calculated = dft_energy, True
+
+            surface = (doc['mpid'], tuple(doc['miller']), doc['shift'], doc['top'])
+            if surface not in lowest_docs or energy < lowest_docs[surface]['energy']:
+                flat_doc = {key: value for key, value in doc.items() if key not in ('_id', 'predictions')}
+                flat_doc['mongo_id'] = doc['_id']
+                flat_doc['energy'] = energy
+                flat_doc['DFT_calculated'] = is_calculated
+                lowest_docs[surface] = flat_doc
+        return list(lowest_docs.values())
+
+    def record_calculations(self, adsorption_docs):
+        '''
+        Adds finished calculations to the `adsorption` collection, as if
+        GASpy had just parsed them, and takes their sites out of the
+        unsimulated ones.
+
+        Args:
+            adsorption_docs A list of raw adsorption documents
+        '''
+        if not adsorption_docs:
+            return
+        new_docs = [{key: value for key, value in doc.items() if key != '_id'}
+                    for doc in adsorption_docs]
+        self.collections['adsorption'].insert_many(new_docs)
+
+        attempted_hashes = set()
+        for doc in adsorption_docs:
+            fingerprint_hash = hash_doc(_to_fingerprint_doc(doc))
+            attempted_hashes.add(fingerprint_hash)
+            if doc.get('adsorption_energy') is not None:
+                self._dft_energies[(doc['adsorbate'], fingerprint_hash)] = doc['adsorption_energy']
+        is_unsimulated = [fingerprint_hash not in attempted_hashes
+                          for fingerprint_hash in self._unsimulated_hashes]
+        self.unsimulated_docs = list(itertools.compress(self.unsimulated_docs, is_unsimulated))
+        self._unsimulated_hashes = list(itertools.compress(self._unsimulated_hashes, is_unsimulated))
+
+    def patches(self):
+        '''
+        Lists the module attributes that need to point at this stand-in.
+
+        Returns:
+            patches     A list of `(module, attribute name, value)` tuples
+        '''
+        from . import core, catalog, fingerprints
+
+        return [(core, 'get_unsimulated_catalog_docs', self.get_unsimulated_catalog_docs),
+                (core, 'get_low_coverage_docs', self.get_low_coverage_docs),
+                (catalog, 'get_mongo_collection', self.get_mongo_collection),
+                (fingerprints, 'get_mongo_collection', self.get_mongo_collection),
+                (fingerprints, 'get_launchpad', self.get_launchpad)]
+
+    def installed(self):
+        ''' Within this context, our selectors read from this stand-in '''
+        return _patched(self.patches())
+
+
+class ReplayTask(object):
+    '''
+    A stand-in for `gaspy.tasks.metadata_calculators.CalculateAdsorptionEnergy`
+    that just holds its arguments, so that replays do not need luigi.
+    '''
+    def __init__(self, adsorbate_name, adsorption_site, mpid, miller_indices, shift, top,
+                 adslab_vasp_settings, rotation=None):
+        self.adsorbate_name = adsorbate_name
+        self.adsorption_site = adsorption_site
+        self.mpid = mpid
+        self.miller_indices = miller_indices
+        self.shift = shift
+        self.top = top
+        self.adslab_vasp_settings = adslab_vasp_settings
+        self.rotation = rotation
+
+
+def export_replay_data(directory, adsorbate, prediction_fields, vasp_settings=None,
+                       value_field='adsorption_energy', cost_model=None):
+    '''
+    Exports what a replay needs from our live databases: every adsorption
+    calculation with a result, the catalog sites that they were for (along
+    with their predictions), and a cost model.
+
+    Args:
+        directory           A string indicating where to save the data
+        adsorbate           A string indicating the adsorbate
+        prediction_fields   A list of strings indicating which paths inside
+                            the `predictions` field of the catalog documents
+                            to keep, e.g., 'adsorption_energy.CO.model0'
+        vasp_settings       [optional] An OrderedDict containing the VASP
+                            settings of the calculations to export. Defaults
+                            to `gaspy.defaults.adslab_settings()['vasp']`.
+        value_field         A string indicating the (dotted) field of the
+                            adsorption documents that replays should count
+                            hits with
+        cost_model          [optional] A `gaspy_feedback.cost.CostModel`.
+                            Defaults to one from
+                            `gaspy_feedback.cost.fit_cost_model`.
+    '''
+    if vasp_settings is None:
+        vasp_settings = defaults.adslab_settings()['vasp']
+    if cost_model is None:
+        cost_model = fit_cost_model()
+
+    query = {'adsorbate': adsorbate}
+    for setting, value in vasp_settings.items():
+        query['vasp_settings.%s' % setting] = value
+    projection = {'mpid': 1, 'miller': 1, 'shift': 1, 'top': 1, 'adsorption_site': 1,
+                  'adsorbate': 1, 'fp_init.coordination': 1, 'fp_init.neighborcoord': 1,
+                  value_field: 1}
+    with get_mongo_collection('adsorption') as collection:
+        result_docs = [doc for doc in collection.find(query, projection).sort('_id', 1)
+                       if _get_field(doc, value_field) is not None]
+    fingerprint_hashes = set(hash_doc(_to_fingerprint_doc(doc)) for doc in result_docs)
+
+    # We can only replay the catalog sites whose outcomes we know
+    projection = {path: 1 for path in CATALOG_FIELDS.values()}
+    for field in prediction_fields:
+        projection['predictions.%s' % field] = 1
+    with get_mongo_collection('catalog') as collection:
+        catalog_docs = [doc for doc in collection.find(projection=projection).sort('_id', 1)
+                        if hash_doc(doc) in fingerprint_hashes]
+
+    metadata = {'adsorbate': adsorbate,
+                'vasp_settings': vasp_settings,
+                'prediction_fields': prediction_fields,
+                'value_field': value_field,
+                'cost_model': {'prefactor': cost_model.prefactor,
+                               'exponent': cost_model.exponent},
+                'exported': time.time()}
+    save_replay_data(directory, catalog_docs, result_docs, metadata)
+
+
+def save_replay_data(directory, catalog_docs, result_docs, metadata):
+    '''
+    Saves replay data as JSON lines, using `bson.json_util` so that IDs and
+    dates survive the round trip.
+
+    Args:
+        directory       A string indicating where to save the data
+        catalog_docs    A list of raw catalog documents
+        result_docs     A list of raw adsorption documents, oldest first
+        metadata        A dictionary with the 'adsorbate', 'vasp_settings',
+                        'value_field', and 'cost_model' keys; see
+                        `export_replay_data`
+    '''
+    from bson import json_util
+
+    os.makedirs(directory, exist_ok=True)
+    for name, docs in [('catalog', catalog_docs), ('results', result_docs)]:
+        path = os.path.join(directory, '%s.jsonl' % name)
+        with atomic_path(path) as temp_path:
+            with open(temp_path, 'w') as file_handle:
+                for doc in docs:
+                    file_handle.write(json_util.dumps(doc) + '\n')
+    with open(os.path.join(directory, 'replay.json'), 'w') as file_handle:
+        json.dump(metadata, file_handle, indent=2)
+
+
+def load_replay_data(directory):
+    '''
+    Reads replay data that was saved by `save_replay_data`.
+
+    Args:
+        directory   A string indicating where the data were saved
+    Returns:
+        data    A `(catalog_docs, result_docs, metadata)` tuple
+    '''
+    from bson import json_util
+
+    docs = {}
+    for name in ['catalog', 'results']:
+        with open(os.path.join(directory, '%s.jsonl' % name)) as file_handle:
+            docs[name] = [json_util.loads(line) for line in file_handle if line.strip()]
+    with open(os.path.join(directory, 'replay.json')) as file_handle:
+        metadata = json.load(file_handle)
+    return docs['catalog'], docs['results'], metadata
+
+
+def replay_selector(data, selector, hit_target, hit_tolerance=0.1, selector_kwargs=None,
+                    n_ticks=10, quota=50, n_initial=0, seed=0):
+    '''
+    Simulates our feedback loop with one selector. Every tick asks the
+    selector for `quota` calculations, reveals the known results of the sites
+    it chose, and adds them to the stand-in database before the next tick.
+
+    Args:
+        data            The output of `load_replay_data`
+        selector        A selector function, e.g.,
+                        `gaspy_feedback.low_cov_ads_energies_with_gaussian_noise`.
+                        If it accepts the 'adsorbate', 'vasp_settings', or
+                        'n_workers' arguments and you do not pass them, then
+                        we pass the exported adsorbate and VASP settings and
+                        one worker.
+        hit_target      A float indicating the result that counts as a hit
+        hit_tolerance   A float indicating how far from `hit_target` a result
+                        may be and still count as a hit
+        selector_kwargs [optional] A dictionary of the other arguments to pass
+                        to the selector
+        n_ticks         A positive integer indicating how many ticks to
+                        simulate
+        quota           A positive integer indicating how many calculations
+                        to ask for on each tick
+        n_initial       A non-negative integer indicating how many of the
+                        oldest results were already known before the first
+                        tick
+        seed            An integer to seed `numpy.random` with
+    Returns:
+        result  A dictionary with the 'selector', 'selector_kwargs', 'seed',
+                'n_calcs', 'n_hits', 'core_hours', 'hits_per_core_hour',
+                'mean_latency', and 'max_latency' keys, plus a 'ticks' list
+                of per-tick dictionaries. Latencies are in seconds.
+    '''
+    catalog_docs, result_docs, metadata = data
+    kwargs = dict(selector_kwargs or {})
+    check_selector(selector, kwargs)
+    for name, value in [('adsorbate', metadata['adsorbate']),
+                        ('vasp_settings', metadata['vasp_settings']),
+                        ('n_workers', 1)]:
+        if accepts_argument(selector, name):
+            kwargs.setdefault(name, value)
+    cost_model = CostModel(**metadata['cost_model'])
+
+    # Index what we know about each site
+    natoms = {hash_site(doc): doc['natoms'] for doc in catalog_docs}
+    results = {}
+    for doc in result_docs:
+        results.setdefault(hash_site(doc), doc)
+    database = ReplayDatabase(catalog_docs, result_docs[:n_initial])
+
+    from . import acquisition, core, candidate_queue
+    task_patches = [(core, 'CalculateAdsorptionEnergy', ReplayTask),
+                    (candidate_queue, 'CalculateAdsorptionEnergy', ReplayTask),
+                    (acquisition, 'CalculateAdsorptionEnergy', ReplayTask)]
+    np.random.seed(seed)
+    ticks = []
+    with tempfile.TemporaryDirectory() as cache_dir, \
+            _environment_variable('GASPY_FEEDBACK_CACHE', cache_dir), \
+            database.installed(), _patched(task_patches):
+        for _ in range(n_ticks):
+            start = time.perf_counter()
+            tasks = check_tasks(selector(n_calcs=quota, **kwargs), selector)
+            latency = time.perf_counter() - start
+
+            # "Run" the calculations
+            site_hashes = [hash_task(task) for task in tasks]
+            new_docs = [results[site_hash] for site_hash in dict.fromkeys(site_hashes)
+                        if site_hash in results]
+            values = np.array([_get_field(doc, metadata['value_field']) for doc in new_docs],
+                              dtype=float)
+            n_hits = int(np.count_nonzero(np.abs(values - hit_target) <= hit_tolerance))
+            core_hours = float(np.sum(cost_model([natoms[site_hash] for site_hash in site_hashes
+                                                  if site_hash in natoms])))
+            database.record_calculations(new_docs)
+            ticks.append({'n_calcs': len(tasks), 'n_hits': n_hits,
+                          'core_hours': core_hours, 'latency': latency})
+            if not tasks:
+                break
+
+    core_hours = sum(tick['core_hours'] for tick in ticks)
+    n_hits = sum(tick['n_hits'] for tick in ticks)
+    latencies = [tick['latency'] for tick in ticks]
+    return {'selector': getattr(selector, '__name__', type(selector).__name__),
+            'selector_kwargs': dict(selector_kwargs or {}),
+            'seed': seed,
+            'n_calcs': sum(tick['n_calcs'] for tick in ticks),
+            'n_hits': n_hits,
+            'core_hours': core_hours,
+            'hits_per_core_hour': n_hits / core_hours if core_hours > 0 else 0.,
+            'mean_latency': float(np.mean(latencies)) if latencies else 0.,
+            'max_latency': max(latencies, default=0.),
+            'ticks': ticks}
+
+
+def make_replay_grid(selector, seeds=(0,), **parameter_lists):
+    '''
+    Makes one replay run for every combination of some selector parameters
+    and random seeds.
+
+    Args:
+        selector        A selector function
+        seeds           A sequence of integers to seed each combination with
+        parameter_lists Keyword arguments whose values are lists of the values
+                        to try for that selector argument, e.g.,
+                        `stdev=[0.05, 0.1, 0.2]`
+    Returns:
+        runs    A list of dictionaries with the 'selector', 'selector_kwargs',
+                and 'seed' keys, which you can pass to `replay_grid`
+    '''
+    names = sorted(parameter_lists)
+    runs = []
+    for values in itertools.product(*[parameter_lists[name] for name in names]):
+        for seed in seeds:
+            runs.append({'selector': selector,
+                         'selector_kwargs': dict(zip(names, values)),
+                         'seed': seed})
+    return runs
+
+
+def replay_grid(directory, runs, hit_target, hit_tolerance=0.1, n_ticks=10, quota=50,
+                n_initial=0, n_workers=None):
+    '''
+    Calls `replay_selector` for many runs (e.g., from `make_replay_grid`) in a pool of
+    processes, each of which loads the replay data once.
+
+    Args:
+        directory       A string indicating where the replay data were saved
+        runs            A list of dictionaries with the 'selector' key and,
+                        optionally, the 'selector_kwargs' and 'seed' keys. The
+                        selectors must be picklable, e.g., module-level
+                        functions.
+        hit_target      Passed to `replay_selector`
+        hit_tolerance   Passed to `replay_selector`
+        n_ticks         Passed to `replay_selector`
+        quota           Passed to `replay_selector`
+        n_initial       Passed to `replay_selector`
+        n_workers       [optional] A positive integer indicating how many
+                        processes to use. Defaults to one per CPU.
+    Returns:
+        results     A list of the outputs of `replay_selector`, in the same order as
+                    `runs`
+    '''
+    settings = {'hit_target': hit_target, 'hit_tolerance': hit_tolerance,
+                'n_ticks': n_ticks, 'quota': quota, 'n_initial': n_initial}
+    n_workers = get_n_workers(os.cpu_count() if n_workers is None else n_workers)
+    if n_workers <= 1 or len(runs) <= 1:
+        data = load_replay_data(directory)
+        return [_replay_run(data, run, settings) for run in runs]
+
+    with ProcessPoolExecutor(max_workers=min(n_workers, len(runs)),
+                             initializer=_load_worker_data,
+                             initargs=(directory,)) as executor:
+        futures = [executor.submit(_replay_in_worker, run, settings) for run in runs]
+        return [future.result() for future in futures]
+
+
+def _replay_run(data, run, settings):
+    ''' Unpacks one of the runs of `replay_grid` into a call to `replay_selector` '''
+    return replay_selector(data, run['selector'], selector_kwargs=run.get('selector_kwargs'),
+                           seed=run.get('seed', 0), **settings)
+
+
+def _load_worker_data(directory):
+    ''' Runs once in each worker to load the replay data '''
+    global _worker_data
+    _worker_data = load_replay_data(directory)
+
+
+def _replay_in_worker(run, settings):
+    ''' Runs in a worker to replay one run '''
+    return _replay_run(_worker_data, run, settings)
+
+
+def _to_fingerprint_doc(adsorption_doc):
+    ''' Flattens a raw adsorption document into what `hash_doc` needs '''
+    doc = dict(adsorption_doc)
+    doc.update(adsorption_doc['fp_init'])
+    return doc
+
+
+@contextlib.contextmanager
+def _patched(patches):
+    ''' Temporarily sets module attributes, e.g., from `ReplayDatabase.patches` '''
+    originals = [(module, name, getattr(module, name)) for module, name, _ in patches]
+    try:
+        for module, name, value in patches:
+            setattr(module, name, value)
+        yield
+    finally:
+        for module, name, value in reversed(originals):
+            setattr(module, name, value)
+
+
+@contextlib.contextmanager
+def _environment_variable(name, value):
+    ''' Temporarily sets an environment variable '''
+    original = os.environ.get(name)
+    os.environ[name] = value
+    try:
+        yield
+    finally:
+        if original is None:
+            del os.environ[name]
+        else:
+            os.environ[name] = original
@@ -0,0 +1,179 @@
+'''
+This submodule contains the array-based machinery that our selectors use to
+choose sites. Everything here works on plain `numpy` arrays of scores and
+returns indices, so any selection strategy can reuse it regardless of where
+its candidates come from.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+from itertools import islice
+import numpy as np
+
+
+def gaussian_log_weights(values, target, stdev):
+    '''
+    Calculates the unnormalized, natural logarithm of a Gaussian probability
+    density for each value. We work in log space so that values far away from
+    the target do not underflow to zero (and then to NaN once normalized).
+
+    Args:
+        values  A sequence of floats, e.g., predicted adsorption energies
+        target  A float indicating the center of the Gaussian
+        stdev   A float indicating the standard deviation of the Gaussian
+    Returns:
+        log_weights     A `numpy.ndarray` of floats with the same shape as
+                        `values`. NaN values are given a weight of `-inf`, which
+                        means that they will never be chosen.
+    '''
+    values = np.asarray(values, dtype=float)
+    log_weights = -0.5 * np.square((values - target) / stdev)
+    log_weights[np.isnan(log_weights)] = -np.inf
+    return log_weights
+
+
+def gumbel_keys(log_weights, random_state=None):
+    '''
+    Perturbs each log-weight with Gumbel noise. Taking the `k` largest keys is
+    equivalent to drawing `k` items without replacement with probabilities
+    proportional to `exp(log_weights)`, which is what `numpy.random.choice`
+    does when given `replace=False`.
+
+    Args:
+        log_weights     A sequence of floats indicating the unnormalized
+                        log-probabilities of each item
+        random_state    [optional] A `numpy.random.RandomState` or
+                        `numpy.random.Generator` to draw the noise from. If
+                        `None`, then uses the global `numpy.random` state.
+    Returns:
+        keys    A `numpy.ndarray` of floats with the same shape as
+                `log_weights`. Items with a weight of zero get a key of `-inf`.
+    '''
+    if random_state is None:
+        random_state = np.random
+    log_weights = np.asarray(log_weights, dtype=float)
+    keys = log_weights + random_state.gumbel(size=log_weights.shape)
+    keys[~np.isfinite(log_weights)] = -np.inf
+    return keys
+
+
+def top_k(keys, k):
+    '''
+    Finds the indices of the `k` largest, finite keys in O(n + k log k) time.
+
+    Args:
+        keys    A sequence of floats, e.g., the output of `gumbel_keys`
+        k       An integer indicating how many indices you want
+    Returns:
+        indices     A `numpy.ndarray` of integers indicating the positions of
+                    the largest keys, sorted from largest to smallest key. If
+                    there are fewer than `k` finite keys, then all of them are
+                    returned.
+    '''
+    keys = np.asarray(keys, dtype=float)
+    candidates = np.flatnonzero(np.isfinite(keys))
+    k = min(max(int(k), 0), len(candidates))
+    if k == 0:
+        return np.array([], dtype=int)
+
+    # Partition to find the top k in linear time, then sort only those k
+    candidate_keys = keys[candidates]
+    if k < len(candidates):
+        partition = np.argpartition(-candidate_keys, k - 1)[:k]
+    else:
+        partition = np.arange(len(candidates))
+    order = partition[np.argsort(-candidate_keys[partition], kind='stable')]
+    return candidates[order]
+
+
+def weighted_sample(log_weights, k, random_state=None):
+    '''
+    Draws `k` items without replacement with probabilities proportional to
+    `exp(log_weights)` using the Gumbel-top-k trick.
+
+    Args:
+        log_weights     A sequence of floats indicating the unnormalized
+                        log-probabilities of each item
+        k               An integer indicating how many items you want to draw
+        random_state    [optional] A `numpy.random.RandomState` or
+                        `numpy.random.Generator` to draw with. If `None`, then
+                        uses the global `numpy.random` state.
+    Returns:
+        indices     A `numpy.ndarray` of integers indicating which items were
+                    chosen, in the order that they were drawn. If there are
+                    fewer than `k` items with nonzero weight, then all of them
+                    are returned.
+    '''
+    keys = gumbel_keys(log_weights, random_state=random_state)
+    return top_k(keys, k)
+
+
+def counter_gumbel_keys(log_weights, counters, seed):
+    '''
+    Like `gumbel_keys`, except that the noise of each item is a pure function
+    of `seed` and that item's counter (e.g., its global row number), via the
+    SplitMix64 hash. This means that a candidate gets the same key no matter
+    which shard or process scores it, so shards can be sampled independently
+    and merged afterwards.
+
+    Args:
+        log_weights A sequence of floats indicating the unnormalized
+                    log-probabilities of each item
+        counters    A sequence of non-negative integers that uniquely identify
+                    each item and that are parallel to `log_weights`
+        seed        A non-negative integer
+    Returns:
+        keys    A `numpy.ndarray` of floats with the same shape as
+                `log_weights`. Items with a weight of zero get a key of `-inf`.
+    '''
+    log_weights = np.asarray(log_weights, dtype=float)
+    state = np.asarray(counters, dtype=np.uint64) + np.uint64(1)
+    with np.errstate(over='ignore'):
+        state = state * np.uint64(0x9E3779B97F4A7C15) + np.uint64(seed & 0xFFFFFFFFFFFFFFFF)
+        state = (state ^ (state >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        state = (state ^ (state >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        state = state ^ (state >> np.uint64(31))
+
+    # Use the top 53 bits for a uniform number in (0, 1), then make it Gumbel
+    uniforms = ((state >> np.uint64(11)).astype(float) + 0.5) / 2.**53
+    keys = log_weights - np.log(-np.log(uniforms))
+    keys[~np.isfinite(log_weights)] = -np.inf
+    return keys
+
+
+def reservoir_sample(items, k, random_state=None):
+    '''
+    Draws `k` items uniformly without replacement from an iterable of unknown
+    length in a single pass, holding only `k` items at a time. This is
+    Li's "Algorithm L", which skips ahead geometrically instead of drawing a
+    random number for every item.
+
+    Args:
+        items           An iterable of anything, e.g., a Mongo cursor
+        k               An integer indicating how many items you want to draw
+        random_state    [optional] A `numpy.random.RandomState` or
+                        `numpy.random.Generator` to draw with. If `None`, then
+                        uses the global `numpy.random` state.
+    Returns:
+        sample  A list of the chosen items in random order. If there are
+                fewer than `k` items, then all of them are returned.
+    '''
+    if random_state is None:
+        random_state = np.random
+    k = max(int(k), 0)
+    items = iter(items)
+    reservoir = list(islice(items, k))
+
+    exhausted = object()
+    if k > 0 and len(reservoir) == k:
+        threshold = np.exp(np.log(random_state.uniform()) / k)
+        while threshold < 1.:
+            n_skipped = int(np.log(random_state.uniform()) / np.log1p(-threshold))
+            item = next(islice(items, n_skipped, None), exhausted)
+            if item is exhausted:
+                break
+            reservoir[min(int(random_state.uniform() * k), k - 1)] = item
+            threshold *= np.exp(np.log(random_state.uniform()) / k)
+
+    return [reservoir[i] for i in random_state.permutation(len(reservoir))]
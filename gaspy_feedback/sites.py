@@ -0,0 +1,310 @@
+'''
+This submodule contains `SiteTable`, a compact, column-oriented table of
+adsorption sites. Our selectors use it instead of lists of Mongo documents so
+that filtering and scoring are vectorized, and so that we only build full
+documents (and tasks) for the handful of sites that we actually choose.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+import os
+import json
+import shutil
+import tempfile
+from array import array
+import numpy as np
+from bson import ObjectId
+from .fingerprints import hash_doc
+
+
+# Columns whose values we store as integer codes into a list of categories
+CATEGORICAL_COLUMNS = ('mpid', 'adsorbate_rotation')
+
+
+class SiteTable(object):
+    '''
+    A struct-of-arrays table of adsorption sites. Every column is a `numpy`
+    array with one row per site:
+
+        mpid                Integer codes into `categories['mpid']`
+        miller              An (n x 3) array of 8-bit integers
+        shift               Floats
+        top                 Booleans
+        adsorption_site     An (n x 3) array of floats
+        natoms              32-bit integers
+        mongo_id            [optional] 12-byte strings of the documents' `_id`
+        fingerprint         [optional] The `hash_doc` of each site
+        adsorbate_rotation  [optional] Integer codes into
+                            `categories['adsorbate_rotation']`
+
+    Any other columns (e.g., predictions) are arrays of whatever type they
+    were made with. Columns can be read with `table['natoms']`.
+    '''
+    def __init__(self, columns, categories=None, metadata=None):
+        '''
+        Args:
+            columns     A dictionary whose keys are column names and whose
+                        values are `numpy` arrays of equal length
+            categories  [optional] A dictionary whose keys are the names of
+                        categorical columns and whose values are the sequences
+                        that their codes index into
+            metadata    [optional] A JSON-serializable dictionary of anything
+                        else worth keeping with the table, e.g., when it was
+                        made
+        '''
+        self.columns = columns
+        self.categories = {} if categories is None else categories
+        self.metadata = {} if metadata is None else metadata
+
+    def __len__(self):
+        return len(self.columns['natoms'])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def keys(self):
+        return self.columns.keys()
+
+    def take(self, rows):
+        '''
+        Makes a new table out of some of the rows of this one.
+
+        Args:
+            rows    An array of integer indices or a Boolean mask
+        Returns:
+            table   A new `SiteTable`
+        '''
+        columns = {name: values[rows] for name, values in self.columns.items()}
+        return SiteTable(columns, self.categories, dict(self.metadata))
+
+    def get_doc(self, row):
+        '''
+        Turns one row back into a document that looks like the ones that
+        `gaspy.gasdb` gives us, so that we can make a task out of it.
+
+        Args:
+            row     An integer indicating which row you want
+        Returns:
+            doc     A dictionary with the 'mpid', 'miller', 'shift', 'top',
+                    'adsorption_site', and 'natoms' keys, plus a key for every
+                    optional and extra column
+        '''
+        doc = {}
+        for name, values in self.columns.items():
+            value = values[row]
+            if name in self.categories:
+                value = self.categories[name][value]
+                doc[name] = dict(value) if isinstance(value, dict) else str(value)
+            elif name == 'mongo_id':
+                doc[name] = ObjectId(bytes(value).ljust(12, b'\x00'))
+            elif name == 'fingerprint':
+                doc[name] = int(value)
+            elif isinstance(value, np.ndarray):
+                doc[name] = value.tolist()
+            else:
+                doc[name] = value.item()
+        return doc
+
+    def get_docs(self, rows):
+        ''' Calls `get_doc` on each of several rows '''
+        return [self.get_doc(row) for row in rows]
+
+    def save(self, directory):
+        '''
+        Saves each column to its own `.npy` file and the categories and
+        metadata to `table.json`. We write into a uniquely named, temporary
+        directory and then swap it in so that readers never see a partial
+        table and so that several processes can save the same table at once.
+
+        Args:
+            directory   A string indicating the directory to save to
+        '''
+        parent, table_name = os.path.split(os.path.abspath(directory))
+        os.makedirs(parent, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(dir=parent, prefix='.%s.tmp.' % table_name)
+        try:
+            for name, values in self.columns.items():
+                np.save(os.path.join(temp_dir, '%s.npy' % name), values)
+            categories = {name: [value if isinstance(value, dict) else str(value) for value in values]
+                          for name, values in self.categories.items()}
+            with open(os.path.join(temp_dir, 'table.json'), 'w') as file_handle:
+                json.dump({'columns': list(self.columns),
+                           'categories': categories,
+                           'metadata': self.metadata}, file_handle)
+        except BaseException:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+        # Directories cannot be replaced in one step, so we move the old one
+        # out of the way first. If another process swaps its table in between
+        # our two moves, then we keep theirs, which is just as new.
+        old_dir = tempfile.mkdtemp(dir=parent, prefix='.%s.old.' % table_name)
+        os.rmdir(old_dir)
+        try:
+            os.rename(directory, old_dir)
+        except FileNotFoundError:
+            pass
+        try:
+            os.rename(temp_dir, directory)
+        except OSError:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory, mmap_mode=None):
+        '''
+        Reads a table that was saved with `save`.
+
+        Args:
+            directory   A string indicating the directory to read from
+            mmap_mode   [optional] Passed to `numpy.load`, e.g., 'r' to
+                        memory-map the columns read-only
+        Returns:
+            table   A `SiteTable`, or `None` if there is none in `directory`
+        '''
+        table_path = os.path.join(directory, 'table.json')
+        if not os.path.isfile(table_path):
+            return None
+        with open(table_path) as file_handle:
+            saved = json.load(file_handle)
+        columns = {name: np.load(os.path.join(directory, '%s.npy' % name), mmap_mode=mmap_mode)
+                   for name in saved['columns']}
+        categories = saved['categories']
+        if 'mpid' in categories:
+            categories['mpid'] = np.array(categories['mpid'], dtype=str)
+        return cls(columns, categories, saved['metadata'])
+
+    @classmethod
+    def from_docs(cls, docs, extra_fields=None, fingerprints=False):
+        '''
+        Packs documents into a table in a single pass, without holding onto
+        the documents themselves.
+
+        Args:
+            docs            An iterable of dictionaries with the 'mpid',
+                            'miller', 'shift', 'top', 'adsorption_site', and
+                            'natoms' keys. If the first document has the
+                            'mongo_id' or 'adsorbate_rotation' keys, then we
+                            also make those columns. If there are no
+                            documents, then we make an empty 'mongo_id'
+                            column.
+            extra_fields    [optional] A dictionary whose keys are other keys
+                            of the documents that you want columns for and
+                            whose values are the `numpy` dtypes to store them
+                            as. Missing float values become NaN.
+            fingerprints    A Boolean indicating whether to make the
+                            'fingerprint' column, which needs the
+                            'coordination' and 'neighborcoord' keys
+        Returns:
+            table   A `SiteTable`
+        '''
+        extra_fields = {} if extra_fields is None else extra_fields
+        codes = {name: array('l') for name in CATEGORICAL_COLUMNS}
+        vocabularies = {name: {} for name in CATEGORICAL_COLUMNS}
+        categories = {name: [] for name in CATEGORICAL_COLUMNS}
+        miller = array('b')
+        shift = array('d')
+        top = array('b')
+        site = array('d')
+        natoms = array('l')
+        mongo_ids = bytearray()
+        hashes = array('Q')
+        extras = {name: [] for name in extra_fields}
+
+        optional_columns = None
+        for doc in docs:
+            if optional_columns is None:
+                optional_columns = {'mongo_id': 'mongo_id' in doc,
+                                    'adsorbate_rotation': 'adsorbate_rotation' in doc}
+
+            for name in CATEGORICAL_COLUMNS:
+                if name == 'adsorbate_rotation' and not optional_columns[name]:
+                    continue
+                value = doc[name]
+                key = tuple(sorted(value.items())) if isinstance(value, dict) else value
+                code = vocabularies[name].get(key)
+                if code is None:
+                    code = vocabularies[name][key] = len(categories[name])
+                    categories[name].append(value)
+                codes[name].append(code)
+            miller.extend(doc['miller'])
+            shift.append(doc['shift'])
+            top.append(bool(doc['top']))
+            site.extend(doc['adsorption_site'])
+            natoms.append(doc['natoms'])
+            if optional_columns['mongo_id']:
+                mongo_ids += ObjectId(doc['mongo_id']).binary
+            if fingerprints:
+                hashes.append(hash_doc(doc))
+            for name in extra_fields:
+                extras[name].append(doc.get(name))
+
+        columns = {'mpid': np.array(codes['mpid'], dtype=np.int32),
+                   'miller': np.array(miller, dtype=np.int8).reshape(-1, 3),
+                   'shift': np.array(shift, dtype=float),
+                   'top': np.array(top, dtype=bool),
+                   'adsorption_site': np.array(site, dtype=float).reshape(-1, 3),
+                   'natoms': np.array(natoms, dtype=np.int32)}
+        # With no documents, we cannot tell whether they would have had IDs,
+        # so we make an empty ID column that callers can still join on
+        if optional_columns is None:
+            optional_columns = {'mongo_id': True}
+        if optional_columns.get('mongo_id'):
+            columns['mongo_id'] = np.frombuffer(bytes(mongo_ids), dtype='S12').copy()
+        if fingerprints:
+            columns['fingerprint'] = np.array(hashes, dtype=np.uint64)
+        if optional_columns.get('adsorbate_rotation'):
+            columns['adsorbate_rotation'] = np.array(codes['adsorbate_rotation'], dtype=np.int32)
+        for name, dtype in extra_fields.items():
+            values = extras[name]
+            if np.dtype(dtype).kind == 'f':
+                values = [np.nan if value is None else value for value in values]
+            columns[name] = np.array(values, dtype=dtype)
+
+        categories = {name: vocabulary for name, vocabulary in categories.items() if name in columns}
+        if 'mpid' in categories:
+            categories['mpid'] = np.array(categories['mpid'], dtype=str)
+        return cls(columns, categories)
+
+    @classmethod
+    def concatenate(cls, tables):
+        '''
+        Stacks tables that have the same columns on top of each other,
+        merging the categories of their categorical columns.
+
+        Args:
+            tables  A sequence of `SiteTable` instances
+        Returns:
+            table   A new `SiteTable`
+        '''
+        first = tables[0]
+        columns = {}
+        categories = {}
+        for name in first.columns:
+            if name not in first.categories:
+                columns[name] = np.concatenate([table[name] for table in tables])
+                continue
+
+            # Re-code every table's categories into one merged list
+            merged = []
+            vocabulary = {}
+            codes = []
+            for table in tables:
+                mapping = []
+                for value in table.categories[name]:
+                    key = tuple(sorted(value.items())) if isinstance(value, dict) else str(value)
+                    if key not in vocabulary:
+                        vocabulary[key] = len(merged)
+                        merged.append(value)
+                    mapping.append(vocabulary[key])
+                codes.append(np.array(mapping, dtype=np.int32)[table[name]] if mapping
+                             else np.array([], dtype=np.int32))
+            columns[name] = np.concatenate(codes)
+            if isinstance(first.categories[name], np.ndarray):
+                merged = np.array(merged, dtype=str)
+            categories[name] = merged
+        return cls(columns, categories, dict(first.metadata))
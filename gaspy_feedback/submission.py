@@ -0,0 +1,95 @@
+'''
+This submodule contains functions that hand the tasks we chose over to GASpy
+(and therefore to luigi and FireWorks) in batches.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+from .utils import lazy_import
+
+
+luigi = lazy_import('luigi')
+execution_summary = lazy_import('luigi.execution_summary')
+read_rc = lazy_import('gaspy.utils', 'read_rc')
+
+# The statuses in luigi's execution summary that mean that a task (or one of
+# the tasks it needs) could not be scheduled or run
+FAILED_STATUSES = ('failed', 'scheduling_error', 'upstream_failure',
+                   'upstream_scheduling_error', 'not_run')
+
+
+def submit_tasks(tasks, chunk_size=50, workers=1, local_scheduler=False, scheduler_host=None):
+    '''
+    Schedules many tasks with as few luigi scheduling passes as possible.
+    Tasks are built in chunks, the same way that `gaspy.tasks.schedule_tasks`
+    builds them (i.e., on the luigi host in our `.gaspyrc.json`), except that
+    we keep luigi's summary of each build so that we can tell which tasks
+    failed. (`luigi.build` reports failed tasks instead of raising.) If a
+    build raises anyway---e.g., because we could not reach the central
+    scheduler---then we report that chunk as failed and move on to the next
+    one.
+
+    Args:
+        tasks           A list of luigi tasks, e.g., the
+                        `CalculateAdsorptionEnergy` tasks that our selectors
+                        return
+        chunk_size      A positive integer indicating how many tasks to
+                        schedule in each call to `luigi.build`
+        workers         A positive integer indicating how many luigi workers
+                        to schedule each chunk with
+        local_scheduler A Boolean indicating whether to use a local luigi
+                        scheduler instead of the central one
+        scheduler_host  [optional] A string indicating the host of the central
+                        luigi scheduler. Defaults to the 'luigi_host' in our
+                        `.gaspyrc.json`, just like `gaspy.tasks.schedule_tasks`.
+    Returns:
+        submitted_tasks A list of the tasks that were scheduled successfully
+        failed_tasks    A list of `(task, exception)` tuples for the tasks that
+                        could not be scheduled
+    '''
+    chunk_size = max(int(chunk_size), 1)
+    build_kwargs = {'workers': workers, 'local_scheduler': local_scheduler,
+                    'detailed_summary': True}
+    if not local_scheduler:
+        build_kwargs['scheduler_host'] = read_rc('luigi_host') if scheduler_host is None else scheduler_host
+
+    submitted_tasks = []
+    failed_tasks = []
+    for i in range(0, len(tasks), chunk_size):
+        chunk = tasks[i:i + chunk_size]
+        try:
+            result = luigi.build(chunk, **build_kwargs)
+
+        # Something went wrong with luigi itself, so none of this chunk went
+        # through. The scheduler may be back by the next chunk.
+        except Exception as error:
+            failed_tasks.extend((task, error) for task in chunk)
+            continue
+
+        statuses = _get_task_statuses(result.worker)
+        for task in chunk:
+            status = statuses.get(task)
+            if status is None:
+                submitted_tasks.append(task)
+            else:
+                failed_tasks.append((task, RuntimeError('luigi reported the task as %s' % status)))
+    return submitted_tasks, failed_tasks
+
+
+def _get_task_statuses(worker):
+    '''
+    Finds which tasks failed in a luigi build.
+
+    Args:
+        worker  The `luigi.worker.Worker` of a `luigi.interface.LuigiRunResult`
+    Returns:
+        statuses    A dictionary whose keys are the tasks that failed and
+                    whose values are their statuses in `FAILED_STATUSES`
+    '''
+    summary = execution_summary._summary_dict(worker)
+    statuses = {}
+    for status in reversed(FAILED_STATUSES):
+        for task in summary.get(status, ()):
+            statuses[task] = status
+    return statuses
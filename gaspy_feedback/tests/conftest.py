@@ -0,0 +1,136 @@
+'''
+Fixtures for the benchmarks in this testing submodule
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+import os
+import gc
+import json
+import time
+import resource
+import pytest
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_PATH = os.environ.get('GASPY_FEEDBACK_BENCHMARK_BASELINE',
+                               os.path.join(TESTS_DIR, 'benchmark_baseline.json'))
+RESULTS_PATH = os.environ.get('GASPY_FEEDBACK_BENCHMARK_RESULTS',
+                              os.path.join(TESTS_DIR, 'benchmark_results.json'))
+TOLERANCE = float(os.environ.get('GASPY_FEEDBACK_BENCHMARK_TOLERANCE', 1.5))
+# Regressions smaller than this many seconds are timing noise, not slowdowns
+FLOOR = float(os.environ.get('GASPY_FEEDBACK_BENCHMARK_FLOOR', 0.05))
+SIZES = [int(float(size)) for size in
+         os.environ.get('GASPY_FEEDBACK_BENCHMARK_SIZES', '1e4,1e5').split(',')]
+
+
+def pytest_generate_tests(metafunc):
+    ''' Runs every benchmark that asks for `n_sites` at each catalog size '''
+    if 'n_sites' in metafunc.fixturenames:
+        metafunc.parametrize('n_sites', SIZES, scope='session')
+
+
+class BenchmarkRecorder(object):
+    '''
+    Times functions, records their wall time, peak RSS, and throughput, and
+    compares the wall times against a saved baseline.
+    '''
+    def __init__(self):
+        self.results = {}
+        self.baseline = {}
+        if os.path.isfile(BASELINE_PATH):
+            with open(BASELINE_PATH) as file_handle:
+                self.baseline = json.load(file_handle)
+
+    def measure(self, name, n_docs, function, *args, **kwargs):
+        '''
+        Calls a function once and records how it performed.
+
+        Args:
+            name        A string to record the results under, e.g.,
+                        'randomly[10000]'
+            n_docs      An integer indicating how many documents the function
+                        processes; used to calculate the throughput
+            function    The function to call
+            args        The arguments of the function
+            kwargs      The keyword arguments of the function
+        Returns:
+            output  Whatever the function returned
+        '''
+        gc.collect()
+        _reset_peak_rss()
+        start = time.perf_counter()
+        output = function(*args, **kwargs)
+        wall_time = time.perf_counter() - start
+        self.results[name] = {'wall_time': wall_time,
+                              'peak_rss_mb': _get_peak_rss_mb(),
+                              'docs_per_second': n_docs / wall_time if wall_time > 0 else float('inf'),
+                              'n_docs': n_docs}
+
+        # Fail if we got noticeably slower than the baseline
+        baseline = self.baseline.get(name)
+        if baseline is not None:
+            allowed_time = max(TOLERANCE * baseline['wall_time'], baseline['wall_time'] + FLOOR)
+            assert wall_time <= allowed_time, \
+                ('%s took %.3f s, but its baseline is %.3f s'
+                 % (name, wall_time, baseline['wall_time']))
+        return output
+
+    def save(self):
+        ''' Saves the results and starts a baseline if there is none yet '''
+        with open(RESULTS_PATH, 'w') as file_handle:
+            json.dump(self.results, file_handle, indent=2, sort_keys=True)
+        if not os.path.isfile(BASELINE_PATH) and self.results:
+            with open(BASELINE_PATH, 'w') as file_handle:
+                json.dump(self.results, file_handle, indent=2, sort_keys=True)
+
+    def report(self):
+        ''' Formats the results as a table '''
+        lines = ['%-50s %10s %12s %14s' % ('benchmark', 'wall [s]', 'peak RSS [MB]', 'docs/s')]
+        for name, result in sorted(self.results.items()):
+            lines.append('%-50s %10.3f %12.1f %14.0f' % (name,
+                                                         result['wall_time'],
+                                                         result['peak_rss_mb'],
+                                                         result['docs_per_second']))
+        return '\n'.join(lines)
+
+
+@pytest.fixture(scope='session')
+def benchmark_recorder():
+    recorder = BenchmarkRecorder()
+    yield recorder
+    recorder.save()
+    print('\n' + recorder.report())
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    ''' Keeps the on-disk caches of each test separate '''
+    monkeypatch.setenv('GASPY_FEEDBACK_CACHE', str(tmp_path))
+    return str(tmp_path)
+
+
+def _reset_peak_rss():
+    ''' Resets the peak RSS of this process, if the kernel lets us '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as file_handle:
+            file_handle.write('5')
+    except OSError:
+        pass
+
+
+def _get_peak_rss_mb():
+    '''
+    Reads the peak RSS of this process since the last `_reset_peak_rss`. If
+    we cannot read `/proc`, then we fall back to the peak over the whole life
+    of the process.
+    '''
+    try:
+        with open('/proc/self/status') as file_handle:
+            for line in file_handle:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
@@ -0,0 +1,149 @@
+'''
+This submodule makes synthetic catalog, prediction, and attempted-site
+documents and serves them through an in-process stand-in for `gaspy.gasdb`
+(see `gaspy_feedback.replay.ReplayDatabase`), so that we can exercise (and
+time) our selectors without a real database.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+import datetime
+from collections import OrderedDict
+import numpy as np
+from bson import ObjectId
+from gaspy_feedback.replay import ReplayDatabase
+
+
+ADSORBATE = 'CO'
+MODEL_TAG = 'model0'
+VASP_SETTINGS = OrderedDict([('gga', 'RP'), ('encut', 350), ('pp_version', '5.4')])
+
+
+def make_catalog_docs(n_sites, model_tags=(MODEL_TAG,), seed=42):
+    '''
+    Makes raw catalog documents that look like the ones in our `catalog`
+    collection.
+
+    Args:
+        n_sites     An integer indicating how many sites to make
+        model_tags  A sequence of strings indicating which models to make
+                    predictions for
+        seed        An integer to seed the random number generator with
+    Returns:
+        docs    A list of dictionaries, sorted by their '_id'
+    '''
+    rng = np.random.RandomState(seed)
+    n_bulks = max(n_sites // 50, 1)
+    mpids = rng.randint(n_bulks, size=n_sites)
+    millers = rng.randint(-2, 3, size=(n_sites, 3))
+    shifts = np.round(rng.rand(n_sites), 2)
+    tops = rng.rand(n_sites) < 0.5
+    sites = np.round(rng.rand(n_sites, 3) * 10, 3)
+    natoms = rng.randint(10, 150, size=n_sites)
+    energies = {tag: rng.normal(-0.5, 0.5, size=n_sites) for tag in model_tags}
+    potentials = {tag: rng.normal(0.8, 0.3, size=n_sites) for tag in model_tags}
+
+    docs = []
+    for i in range(n_sites):
+        doc = {'_id': ObjectId(b'%012d' % i),
+               'mpid': 'mp-%d' % mpids[i],
+               'miller': millers[i].tolist(),
+               'shift': float(shifts[i]),
+               'top': bool(tops[i]),
+               'adsorption_site': sites[i].tolist(),
+               'natoms': int(natoms[i]),
+               'coordination': 'Cu-Pt',
+               'neighborcoord': ['Cu:Cu-Pt', 'Pt:Cu-Cu'],
+               'predictions': {'adsorption_energy': {ADSORBATE: {tag: float(energies[tag][i])
+                                                                 for tag in model_tags}},
+                               'orr_onset_potential_4e': {tag: float(potentials[tag][i])
+                                                          for tag in model_tags}}}
+        docs.append(doc)
+    return docs
+
+
+def make_attempted_docs(catalog_docs, fraction=0.05, seed=42):
+    '''
+    Makes raw adsorption documents for a random subset of catalog sites, as if
+    we had already tried to calculate them.
+
+    Args:
+        catalog_docs    The output of `make_catalog_docs`
+        fraction        A float indicating what fraction of the sites to mark
+                        as attempted
+        seed            An integer to seed the random number generator with
+    Returns:
+        docs    A list of dictionaries that look like the ones in our
+                `adsorption` collection
+    '''
+    rng = np.random.RandomState(seed)
+    n_attempted = int(len(catalog_docs) * fraction)
+    indices = np.sort(rng.choice(len(catalog_docs), size=n_attempted, replace=False))
+
+    docs = []
+    for i in indices:
+        catalog_doc = catalog_docs[i]
+        doc = {key: catalog_doc[key] for key in ['mpid', 'miller', 'shift', 'top', 'adsorption_site']}
+        doc['adsorbate'] = ADSORBATE
+        doc['fp_init'] = {'coordination': catalog_doc['coordination'],
+                          'neighborcoord': catalog_doc['neighborcoord']}
+        doc['vasp_settings'] = dict(VASP_SETTINGS)
+        docs.append(doc)
+    return docs
+
+
+def make_fireworks(catalog_docs, fraction=0.02, seed=43):
+    '''
+    Makes FireWorks documents for a random subset of catalog sites, as if we
+    had submitted them and were waiting for them to finish.
+
+    Args:
+        catalog_docs    The output of `make_catalog_docs`
+        fraction        A float indicating what fraction of the sites to make
+                        FireWorks for
+        seed            An integer to seed the random number generator with
+    Returns:
+        docs    A list of dictionaries that look like the ones in the
+                `fireworks` collection of a FireWorks LaunchPad. Like
+                FireWorks does when it inserts them, their 'updated_on'
+                fields are ISO strings.
+    '''
+    rng = np.random.RandomState(seed)
+    n_fireworks = int(len(catalog_docs) * fraction)
+    indices = np.sort(rng.choice(len(catalog_docs), size=n_fireworks, replace=False))
+    states = ['READY', 'RUNNING', 'COMPLETED', 'FIZZLED']
+    start = datetime.datetime(2018, 1, 1)
+
+    docs = []
+    for fw_id, i in enumerate(indices):
+        catalog_doc = catalog_docs[i]
+        name = {key: catalog_doc[key] for key in ['mpid', 'miller', 'shift', 'top', 'adsorption_site']}
+        name['calculation_type'] = 'slab+adsorbate optimization'
+        name['adsorbate'] = ADSORBATE
+        docs.append({'fw_id': fw_id,
+                     'name': name,
+                     'state': states[rng.randint(len(states))],
+                     'updated_on': (start + datetime.timedelta(minutes=fw_id)).isoformat()})
+    return docs
+
+
+class FakeGasdb(ReplayDatabase):
+    '''
+    The `gaspy_feedback.replay.ReplayDatabase` stand-in for `gaspy.gasdb`,
+    seeded with synthetic documents and installed with `pytest`'s
+    `monkeypatch`.
+    '''
+    def __init__(self, catalog_docs, attempted_docs, fireworks_docs=None):
+        super(FakeGasdb, self).__init__(catalog_docs, attempted_docs, fireworks_docs)
+        self.attempted_docs = attempted_docs
+
+    def install(self, monkeypatch):
+        '''
+        Points our selectors at this stand-in instead of the real database.
+
+        Args:
+            monkeypatch     The `monkeypatch` fixture from `pytest`
+        '''
+        for module, name, value in self.patches():
+            monkeypatch.setattr(module, name, value)
@@ -0,0 +1,327 @@
+'''
+Benchmarks for our selection pipeline over synthetic catalogs of various
+sizes. These are marked as `baseline`, so they are skipped by default; run
+them with `pytest -m baseline`. See this submodule's README for details.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+import sys
+import json
+import subprocess
+import pytest
+import numpy as np
+from gaspy.tasks.metadata_calculators import CalculateAdsorptionEnergy
+from gaspy_feedback import (CandidateQueue,
+                            randomly,
+                            low_cov_ads_energies_with_gaussian_noise,
+                            orr_sites_with_gaussian_noise)
+from gaspy_feedback.acquisition import (get_spec_fields,
+                                        score_specs,
+                                        multi_target_sites_with_gaussian_noise)
+from gaspy_feedback.catalog import (get_catalog_snapshot,
+                                    get_catalog_predictions,
+                                    lookup_predictions)
+from gaspy_feedback.fingerprints import (IN_FLIGHT_STATES,
+                                         get_attempted_fingerprints,
+                                         get_in_flight_sites,
+                                         hash_doc,
+                                         hash_site,
+                                         hash_task,
+                                         isin_sorted)
+from gaspy_feedback.parallel import get_n_workers, sharded_gaussian_sample
+from gaspy_feedback.replay import make_replay_grid, replay_grid, save_replay_data
+from gaspy_feedback.sampling import gaussian_log_weights, weighted_sample
+from gaspy_feedback.sites import SiteTable
+from .synthetic import (ADSORBATE, MODEL_TAG, VASP_SETTINGS,
+                        FakeGasdb, make_catalog_docs, make_attempted_docs, make_fireworks)
+
+pytestmark = pytest.mark.baseline
+N_CALCS = 300
+ORR_FIELD = 'orr_onset_potential_4e.%s' % MODEL_TAG
+
+
+@pytest.fixture(scope='session')
+def fake_gasdb(n_sites):
+    pytest.importorskip('mongomock')
+    catalog_docs = make_catalog_docs(n_sites)
+    return FakeGasdb(catalog_docs, make_attempted_docs(catalog_docs), make_fireworks(catalog_docs))
+
+
+@pytest.fixture
+def gasdb(fake_gasdb, monkeypatch):
+    fake_gasdb.install(monkeypatch)
+    return fake_gasdb
+
+
+# Modules that cron-launched runs should not pay for unless they submit
+HEAVY_MODULES = ['scipy', 'luigi', 'fireworks', 'gaspy.gasdb', 'gaspy.tasks',
+                 'gaspy.fireworks_helper_scripts', 'gaspy.defaults']
+
+
+def test_import_time(benchmark_recorder):
+    def list_imported_modules(statement):
+        code = '%s; import sys, json; print(json.dumps(sorted(sys.modules)))' % statement
+        output = subprocess.check_output([sys.executable, '-c', code])
+        return json.loads(output.decode().splitlines()[-1])
+
+    modules = benchmark_recorder.measure('import/gaspy_feedback', 1, list_imported_modules,
+                                         'import gaspy_feedback')
+    assert not [module for module in modules if module.startswith('gaspy_feedback.')]
+
+    # Checking the queue should not load GASpy's task machinery
+    modules = benchmark_recorder.measure('import/has_room_in_queue', 1, list_imported_modules,
+                                         'from gaspy_feedback import has_room_in_queue')
+    modules += benchmark_recorder.measure('import/selectors', 1, list_imported_modules,
+                                          'from gaspy_feedback import FeedbackDaemon, randomly, '
+                                          'orr_sites_with_gaussian_noise')
+    assert not [module for module in modules
+                if any(module == heavy or module.startswith(heavy + '.') for heavy in HEAVY_MODULES)]
+
+
+def test_randomly(gasdb, n_sites, benchmark_recorder):
+    tasks = benchmark_recorder.measure('randomly[%i]' % n_sites, n_sites,
+                                       randomly, ADSORBATE,
+                                       n_calcs=N_CALCS,
+                                       vasp_settings=VASP_SETTINGS)
+    assert len(tasks) == N_CALCS
+
+
+def test_randomly_streaming(gasdb, n_sites, benchmark_recorder):
+    tasks = benchmark_recorder.measure('randomly/stream[%i]' % n_sites, n_sites,
+                                       randomly, ADSORBATE,
+                                       n_calcs=N_CALCS,
+                                       vasp_settings=VASP_SETTINGS,
+                                       stream=True)
+    assert len(tasks) == N_CALCS
+
+    # Asking for more sites than are left should give us all of them
+    tasks = randomly(ADSORBATE, n_calcs=n_sites, max_atoms=15,
+                     vasp_settings=VASP_SETTINGS, stream=True)
+    assert 0 < len(tasks) < n_sites
+
+
+def test_low_cov_ads_energies_with_gaussian_noise(gasdb, n_sites, benchmark_recorder):
+    tasks = benchmark_recorder.measure('low_cov_ads_energies_with_gaussian_noise[%i]' % n_sites,
+                                       n_sites,
+                                       low_cov_ads_energies_with_gaussian_noise,
+                                       ADSORBATE, energy_target=-0.67, stdev=0.1,
+                                       n_calcs=N_CALCS,
+                                       model_tag=MODEL_TAG,
+                                       vasp_settings=VASP_SETTINGS)
+    assert 0 < len(tasks) <= N_CALCS
+
+
+def test_orr_sites_with_gaussian_noise(gasdb, n_sites, benchmark_recorder):
+    tasks = benchmark_recorder.measure('orr_sites_with_gaussian_noise[%i]' % n_sites, n_sites,
+                                       orr_sites_with_gaussian_noise,
+                                       ADSORBATE, orr_target=1.23, stdev=0.2,
+                                       n_calcs=N_CALCS,
+                                       model_tag=MODEL_TAG,
+                                       vasp_settings=VASP_SETTINGS)
+    assert len(tasks) == N_CALCS
+
+
+def test_catalog_snapshot(gasdb, n_sites, benchmark_recorder):
+    name = 'get_catalog_snapshot/%s[%i]'
+    benchmark_recorder.measure(name % ('build', n_sites), n_sites,
+                               get_catalog_snapshot, [ORR_FIELD])
+    benchmark_recorder.measure(name % ('load', n_sites), n_sites,
+                               get_catalog_snapshot, [ORR_FIELD], max_age=float('inf'))
+    catalog = benchmark_recorder.measure(name % ('refresh', n_sites), n_sites,
+                                         get_catalog_snapshot, [ORR_FIELD], max_age=0.)
+    assert len(catalog['mongo_id']) == n_sites
+
+    tasks = benchmark_recorder.measure('randomly/snapshot[%i]' % n_sites, n_sites,
+                                       randomly, ADSORBATE,
+                                       n_calcs=N_CALCS,
+                                       vasp_settings=VASP_SETTINGS,
+                                       catalog=catalog)
+    assert len(tasks) == N_CALCS
+    tasks = benchmark_recorder.measure('orr_sites_with_gaussian_noise/snapshot[%i]' % n_sites,
+                                       n_sites,
+                                       orr_sites_with_gaussian_noise,
+                                       ADSORBATE, orr_target=1.23, stdev=0.2,
+                                       n_calcs=N_CALCS,
+                                       model_tag=MODEL_TAG,
+                                       vasp_settings=VASP_SETTINGS,
+                                       catalog=catalog)
+    assert len(tasks) == N_CALCS
+
+
+def test_candidate_queue(gasdb, n_sites, benchmark_recorder):
+    queue = CandidateQueue(ADSORBATE, target=1.23, stdev=0.2, model_tag=MODEL_TAG,
+                           vasp_settings=VASP_SETTINGS)
+    name = 'CandidateQueue/%s[%i]'
+    tasks = benchmark_recorder.measure(name % ('build', n_sites), n_sites,
+                                       queue, n_calcs=N_CALCS)
+    assert len(tasks) == N_CALCS
+    tasks = benchmark_recorder.measure(name % ('top_up', n_sites), 5, queue, n_calcs=5)
+    assert len(tasks) == 5
+
+
+def test_multi_target_sites_with_gaussian_noise(n_sites, monkeypatch, benchmark_recorder):
+    pytest.importorskip('mongomock')
+    model_tags = ['model0', 'model1', 'model2']
+    catalog_docs = make_catalog_docs(n_sites, model_tags=model_tags)
+    FakeGasdb(catalog_docs, make_attempted_docs(catalog_docs)).install(monkeypatch)
+
+    # One spec per model and target, plus an ensemble that explores where the
+    # models disagree
+    specs = [{'model_tag': model_tag, 'target': target, 'stdev': 0.2}
+             for model_tag in model_tags for target in (0.8, 1.23)]
+    specs.append({'prediction': 'adsorption_energy.%s' % ADSORBATE, 'model_tag': model_tags,
+                  'ensemble': 'spread', 'target': -0.67, 'stdev': 0.1})
+    name = 'multi_target_sites_with_gaussian_noise/%s[%i]'
+    selections = benchmark_recorder.measure(name % ('%i_specs' % len(specs), n_sites), n_sites,
+                                            multi_target_sites_with_gaussian_noise,
+                                            ADSORBATE, specs, n_calcs=N_CALCS // len(specs),
+                                            vasp_settings=VASP_SETTINGS)
+    assert [len(tasks) for tasks in selections] == [N_CALCS // len(specs)] * len(specs)
+    # No two specs should choose the same site
+    sites = [set(hash_task(task) for task in tasks) for tasks in selections]
+    assert len(set.union(*sites)) == sum(len(spec_sites) for spec_sites in sites)
+
+    tasks = benchmark_recorder.measure(name % ('combined', n_sites), n_sites,
+                                       multi_target_sites_with_gaussian_noise,
+                                       ADSORBATE, specs, n_calcs=N_CALCS, combine='any',
+                                       vasp_settings=VASP_SETTINGS)
+    assert len(tasks) == N_CALCS
+
+    # Scoring one spec should match the single-target weights
+    catalog = get_catalog_snapshot(get_spec_fields(specs))
+    log_weights = score_specs(catalog, specs)
+    assert log_weights.shape == (len(specs), n_sites)
+    assert np.array_equal(log_weights[0], gaussian_log_weights(catalog[ORR_FIELD], 0.8, 0.2))
+
+
+def test_replay_grid(tmp_path, benchmark_recorder):
+    pytest.importorskip('mongomock')
+
+    # Pretend that we know the DFT energies of half of a small catalog
+    catalog_docs = make_catalog_docs(2000)
+    result_docs = make_attempted_docs(catalog_docs, fraction=0.5)
+    catalog_docs = {hash_site(doc): doc for doc in catalog_docs}
+    noise = np.random.RandomState(42).normal(0., 0.1, size=len(result_docs))
+    for doc, error in zip(result_docs, noise):
+        predictions = catalog_docs[hash_site(doc)]['predictions']
+        doc['adsorption_energy'] = predictions['adsorption_energy'][ADSORBATE][MODEL_TAG] + error
+    catalog_docs = [catalog_docs[hash_site(doc)] for doc in result_docs]
+    metadata = {'adsorbate': ADSORBATE,
+                'vasp_settings': VASP_SETTINGS,
+                'prediction_fields': ['adsorption_energy.%s.%s' % (ADSORBATE, MODEL_TAG)],
+                'value_field': 'adsorption_energy',
+                'cost_model': {'prefactor': 0.01, 'exponent': 2.}}
+    save_replay_data(str(tmp_path), catalog_docs, result_docs, metadata)
+
+    specs = [{'prediction': 'adsorption_energy.%s' % ADSORBATE, 'model_tag': MODEL_TAG,
+              'target': -0.67, 'stdev': 0.1}]
+    runs = (make_replay_grid(randomly, seeds=[0, 1])
+            + make_replay_grid(low_cov_ads_energies_with_gaussian_noise, seeds=[0, 1],
+                               energy_target=[-0.67], stdev=[0.1], model_tag=[MODEL_TAG])
+            + make_replay_grid(multi_target_sites_with_gaussian_noise, seeds=[0],
+                               specs=[specs], combine=['any']))
+    results = benchmark_recorder.measure('replay_grid[%i]' % len(runs), len(runs),
+                                         replay_grid, str(tmp_path), runs,
+                                         hit_target=-0.67, hit_tolerance=0.1,
+                                         n_ticks=5, quota=20, n_workers=2)
+    assert [result['selector'] for result in results] == [run['selector'].__name__ for run in runs]
+    assert all(result['n_calcs'] == 100 and result['core_hours'] > 0 for result in results)
+
+    # Aiming at the target should find more hits than picking at random
+    random_hits = sum(result['n_hits'] for result in results[:2])
+    targeted_hits = sum(result['n_hits'] for result in results[2:4])
+    assert targeted_hits > random_hits
+
+
+def test_stage_attempted_fingerprints(gasdb, n_sites, benchmark_recorder):
+    n_attempted = len(gasdb.attempted_docs)
+    name = 'stage/get_attempted_fingerprints/%s[%i]'
+    cold = benchmark_recorder.measure(name % ('cold', n_sites), n_attempted,
+                                      get_attempted_fingerprints, ADSORBATE, VASP_SETTINGS)
+    warm = benchmark_recorder.measure(name % ('incremental', n_sites), n_attempted,
+                                      get_attempted_fingerprints, ADSORBATE, VASP_SETTINGS)
+    assert np.array_equal(cold, warm)
+
+
+def test_stage_in_flight_sites(gasdb, n_sites, benchmark_recorder):
+    n_fireworks = gasdb.lpad.fireworks.count_documents({})
+    name = 'stage/get_in_flight_sites/%s[%i]'
+    cold = benchmark_recorder.measure(name % ('cold', n_sites), n_fireworks,
+                                      get_in_flight_sites, ADSORBATE)
+    warm = benchmark_recorder.measure(name % ('incremental', n_sites), n_fireworks,
+                                      get_in_flight_sites, ADSORBATE)
+    expected = set(hash_site(doc['name']) for doc in
+                   gasdb.lpad.fireworks.find({'state': {'$in': IN_FLIGHT_STATES}}))
+    assert set(cold.tolist()) == set(warm.tolist()) == expected
+
+
+def test_stage_deduplication(gasdb, n_sites, benchmark_recorder):
+    docs = gasdb.get_unsimulated_catalog_docs(ADSORBATE)
+    attempted_fingerprints = get_attempted_fingerprints(ADSORBATE, VASP_SETTINGS)
+
+    def deduplicate():
+        hashes = np.array([hash_doc(doc) for doc in docs], dtype=np.uint64)
+        is_attempted = isin_sorted(hashes, attempted_fingerprints)
+        return [doc for doc, attempted in zip(docs, is_attempted) if not attempted]
+    unattempted_docs = benchmark_recorder.measure('stage/deduplication[%i]' % n_sites,
+                                                  len(docs), deduplicate)
+    assert len(unattempted_docs) == len(docs)
+
+
+def test_stage_prediction_join(gasdb, n_sites, benchmark_recorder):
+    docs = gasdb.get_unsimulated_catalog_docs(ADSORBATE)
+    mongo_ids, predictions = benchmark_recorder.measure('stage/get_catalog_predictions[%i]' % n_sites,
+                                                        n_sites,
+                                                        get_catalog_predictions, ORR_FIELD,
+                                                        max_atoms=80)
+    sites = benchmark_recorder.measure('stage/site_table[%i]' % n_sites, len(docs),
+                                       SiteTable.from_docs, docs)
+    is_matched, _ = benchmark_recorder.measure('stage/lookup_predictions[%i]' % n_sites,
+                                               len(sites),
+                                               lookup_predictions, sites['mongo_id'],
+                                               mongo_ids, predictions)
+    assert is_matched.any() and (sites['natoms'][is_matched] <= 80).all()
+
+
+def test_stage_weighting_and_sampling(n_sites, benchmark_recorder):
+    values = np.random.RandomState(42).normal(0.8, 0.3, size=n_sites)
+    log_weights = benchmark_recorder.measure('stage/gaussian_log_weights[%i]' % n_sites, n_sites,
+                                             gaussian_log_weights, values, 1.23, 0.2)
+    indices = benchmark_recorder.measure('stage/weighted_sample[%i]' % n_sites, n_sites,
+                                         weighted_sample, log_weights, N_CALCS)
+    assert len(indices) == N_CALCS
+
+
+def test_stage_sharded_sampling(gasdb, n_sites, benchmark_recorder):
+    sites = SiteTable.from_docs(gasdb.unsimulated_docs, fingerprints=True)
+    attempted_fingerprints = get_attempted_fingerprints(ADSORBATE, VASP_SETTINGS)
+    values = np.random.RandomState(42).normal(0.8, 0.3, size=len(sites))
+    for n_workers in sorted({1, get_n_workers()}):
+        name = 'stage/sharded_gaussian_sample/%i_workers[%i]' % (n_workers, n_sites)
+        candidates, _ = benchmark_recorder.measure(name, len(sites),
+                                                   sharded_gaussian_sample,
+                                                   sites, values, 1.23, 0.2, N_CALCS,
+                                                   n_workers=n_workers,
+                                                   max_atoms=80,
+                                                   attempted_fingerprints=attempted_fingerprints,
+                                                   seed=42)
+        assert len(candidates) == N_CALCS
+
+
+def test_stage_task_construction(gasdb, n_sites, benchmark_recorder):
+    docs = gasdb.unsimulated_docs[:N_CALCS]
+
+    def make_tasks():
+        return [CalculateAdsorptionEnergy(adsorbate_name=ADSORBATE,
+                                          adsorption_site=doc['adsorption_site'],
+                                          mpid=doc['mpid'],
+                                          miller_indices=doc['miller'],
+                                          shift=doc['shift'],
+                                          top=doc['top'],
+                                          adslab_vasp_settings=VASP_SETTINGS)
+                for doc in docs]
+    tasks = benchmark_recorder.measure('stage/task_construction[%i]' % n_sites, len(docs),
+                                       make_tasks)
+    assert len(tasks) == len(docs)
@@ -0,0 +1,326 @@
+'''
+Unit tests of our selection pipeline. Unlike the benchmarks in
+`test_benchmarks.py`, these are not timed, use small synthetic catalogs, and
+run by default. See this submodule's README for details.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+import os
+import datetime
+import functools
+from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor
+import pytest
+import numpy as np
+from bson import ObjectId
+from gaspy_feedback import (CampaignScheduler,
+                            CandidateQueue,
+                            FeedbackDaemon,
+                            cost,
+                            daemon,
+                            submission,
+                            randomly,
+                            low_cov_ads_energies_with_gaussian_noise,
+                            orr_sites_with_gaussian_noise)
+from gaspy_feedback.acquisition import multi_target_sites_with_gaussian_noise
+from gaspy_feedback.catalog import get_catalog_snapshot
+from gaspy_feedback.daemon import check_selector, check_tasks
+from gaspy_feedback.fingerprints import (IN_FLIGHT_STATES,
+                                         get_attempted_fingerprints,
+                                         get_in_flight_sites,
+                                         hash_site,
+                                         hash_task,
+                                         isin_sorted,
+                                         _save_fingerprint_index)
+from gaspy_feedback.parallel import sharded_gaussian_sample
+from gaspy_feedback.sites import SiteTable
+from .synthetic import (ADSORBATE, MODEL_TAG, VASP_SETTINGS,
+                        FakeGasdb, make_catalog_docs, make_attempted_docs, make_fireworks)
+
+N_SITES = 1000
+ORR_FIELD = 'orr_onset_potential_4e.%s' % MODEL_TAG
+
+
+@pytest.fixture(scope='module')
+def fake_gasdb():
+    pytest.importorskip('mongomock')
+    catalog_docs = make_catalog_docs(N_SITES)
+    return FakeGasdb(catalog_docs, make_attempted_docs(catalog_docs), make_fireworks(catalog_docs))
+
+
+@pytest.fixture
+def gasdb(fake_gasdb, monkeypatch):
+    fake_gasdb.install(monkeypatch)
+    return fake_gasdb
+
+
+def test_indices_catch_late_documents(tmp_path, monkeypatch):
+    pytest.importorskip('mongomock')
+    catalog_docs = make_catalog_docs(1000)
+    attempted_docs = make_attempted_docs(catalog_docs)
+    gasdb = FakeGasdb(catalog_docs, attempted_docs[:-2])
+    gasdb.install(monkeypatch)
+    get_attempted_fingerprints(ADSORBATE, VASP_SETTINGS)
+    catalog = get_catalog_snapshot([ORR_FIELD])
+
+    # Documents whose IDs were made before the newest one we have seen can
+    # still land afterwards, e.g., when several workers insert at once
+    newest_id = gasdb.collections['adsorption'].find_one(sort=[('_id', -1)])['_id']
+    for minutes, doc in zip([1, 2], attempted_docs[-2:]):
+        late_id = ObjectId.from_datetime(newest_id.generation_time - datetime.timedelta(minutes=minutes))
+        gasdb.collections['adsorption'].insert_one(dict(doc, _id=late_id))
+    fingerprints = get_attempted_fingerprints(ADSORBATE, VASP_SETTINGS)
+    assert np.array_equal(fingerprints, get_attempted_fingerprints(ADSORBATE, VASP_SETTINGS,
+                                                                   cache_dir=str(tmp_path / 'cold')))
+
+    late_doc = dict(catalog_docs[0], _id=ObjectId(b'00000000000.'), shift=0.123)
+    gasdb.collections['catalog'].insert_one(late_doc)
+    refreshed = get_catalog_snapshot([ORR_FIELD], max_age=0.)
+    assert len(refreshed) == len(catalog) + 1
+    assert refreshed.get_doc(0)['mongo_id'] == late_doc['_id']
+
+
+def _save_repeatedly(directory):
+    ''' Saves the same table and index over and over, like a busy daemon would '''
+    table = SiteTable({'natoms': np.arange(1000)})
+    for _ in range(20):
+        table.save(os.path.join(directory, 'table'))
+        _save_fingerprint_index(os.path.join(directory, 'index.npz'),
+                                np.arange(100, dtype=np.uint64), None)
+
+
+def test_concurrent_saves(tmp_path):
+    # Daemons with the same adsorbate and settings share their caches
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        list(executor.map(_save_repeatedly, [str(tmp_path)] * 4))
+    assert sorted(os.listdir(str(tmp_path))) == ['index.npz', 'table']
+    assert len(SiteTable.load(str(tmp_path / 'table'))) == 1000
+
+
+def test_in_flight_sites_with_mixed_dates(monkeypatch):
+    pytest.importorskip('mongomock')
+    catalog_docs = make_catalog_docs(1000)
+    fireworks_docs = make_fireworks(catalog_docs, fraction=0.1)
+    gasdb = FakeGasdb(catalog_docs, make_attempted_docs(catalog_docs), fireworks_docs)
+    gasdb.install(monkeypatch)
+    get_in_flight_sites(ADSORBATE)
+
+    # FireWorks inserts new FireWorks with string dates but changes their
+    # states with datetimes, so the index has to follow both
+    fireworks = gasdb.lpad.fireworks
+    later = datetime.datetime(2030, 1, 1)
+    fw_id = fireworks.find_one({'state': 'READY'})['fw_id']
+    fireworks.update_one({'fw_id': fw_id}, {'$set': {'state': 'COMPLETED', 'updated_on': later}})
+    new_doc = dict(fireworks_docs[0], fw_id=len(fireworks_docs), state='READY',
+                   updated_on=later.isoformat())
+    new_doc['name'] = dict(new_doc['name'], shift=new_doc['name']['shift'] + 0.5)
+    new_doc.pop('_id', None)
+    fireworks.insert_one(new_doc)
+
+    expected = set(hash_site(doc['name']) for doc in
+                   fireworks.find({'state': {'$in': IN_FLIGHT_STATES}}))
+    assert hash_site(new_doc['name']) in expected
+    assert set(get_in_flight_sites(ADSORBATE).tolist()) == expected
+
+
+def test_cost_model_is_cached(gasdb, tmp_path, monkeypatch):
+    import mongomock
+    client = mongomock.MongoClient()
+    lpad = SimpleNamespace(fireworks=client.fw.fireworks, launches=client.fw.launches)
+    for fw_id, doc in enumerate(gasdb.catalog_docs[:100]):
+        name = {key: doc[key] for key in ['mpid', 'miller', 'shift', 'top', 'adsorption_site']}
+        name['calculation_type'] = 'slab+adsorbate optimization'
+        lpad.fireworks.insert_one({'name': name, 'state': 'COMPLETED', 'launches': [fw_id]})
+        lpad.launches.insert_one({'launch_id': fw_id, 'runtime_secs': 0.36 * doc['natoms'] ** 2})
+
+    # Costs are joined without a snapshot unless we are handed one
+    natoms, core_hours = cost.get_historical_costs(lpad=lpad)
+    assert len(natoms) == 100
+    assert np.allclose(core_hours, 1e-4 * natoms ** 2)
+    snapshot = get_catalog_snapshot(cache_dir=str(tmp_path))
+    assert sorted(cost.get_historical_costs(lpad=lpad, catalog=snapshot)[0]) == sorted(natoms)
+
+    # Fits are saved and reused until they are too old
+    fits = []
+    fit_cost_model = cost.fit_cost_model
+    monkeypatch.setattr(cost, 'fit_cost_model', lambda **kwargs: fits.append(1) or fit_cost_model(**kwargs))
+    cost_model = cost.get_cost_model(lpad=lpad, cache_dir=str(tmp_path))
+    assert np.isclose(cost_model.exponent, 2.)
+    assert repr(cost.get_cost_model(lpad=lpad, cache_dir=str(tmp_path))) == repr(cost_model)
+    assert len(fits) == 1
+    cost.get_cost_model(lpad=lpad, max_age=0., cache_dir=str(tmp_path))
+    assert len(fits) == 2
+
+
+def test_submit_tasks_reports_failures(monkeypatch):
+    luigi = pytest.importorskip('luigi')
+
+    class Calculation(luigi.Task):
+        index = luigi.IntParameter()
+        succeeds = luigi.BoolParameter()
+
+        def complete(self):
+            return False
+
+        def run(self):
+            if not self.succeeds:
+                raise RuntimeError('The FireWork could not be submitted')
+
+    # luigi does not raise when a task fails, so we have to read its summary
+    tasks = [Calculation(index=i, succeeds=bool(i % 2)) for i in range(6)]
+    submitted_tasks, failed_tasks = submission.submit_tasks(tasks, chunk_size=4, local_scheduler=True)
+    assert submitted_tasks == tasks[1::2]
+    assert [task for task, _ in failed_tasks] == tasks[::2]
+
+    # If luigi itself fails, then only that chunk fails
+    def build(chunk, **kwargs):
+        builds.append(kwargs)
+        if tasks[2] in chunk:
+            raise ConnectionError('The scheduler is down')
+        local_kwargs = {key: value for key, value in kwargs.items() if key != 'scheduler_host'}
+        return luigi.build(chunk, **dict(local_kwargs, local_scheduler=True))
+    builds = []
+    monkeypatch.setattr(submission, 'luigi', SimpleNamespace(build=build))
+    monkeypatch.setattr(submission, 'read_rc', lambda key: 'luigi.example.com')
+    tasks = [Calculation(index=i, succeeds=True) for i in range(6, 12)]
+    submitted_tasks, failed_tasks = submission.submit_tasks(tasks, chunk_size=2)
+    assert submitted_tasks == tasks[:2] + tasks[4:]
+    assert [(task, type(error)) for task, error in failed_tasks] == [(tasks[2], ConnectionError),
+                                                                     (tasks[3], ConnectionError)]
+
+    # We build on GASpy's luigi host unless we are told otherwise
+    assert [kwargs['scheduler_host'] for kwargs in builds] == ['luigi.example.com'] * 3
+    submission.submit_tasks(tasks[:1], scheduler_host='localhost')
+    assert builds[-1]['scheduler_host'] == 'localhost'
+
+
+def test_check_selector():
+    specs = [{'model_tag': MODEL_TAG, 'target': 1.23, 'stdev': 0.2}]
+    check_selector(multi_target_sites_with_gaussian_noise, {'specs': specs, 'combine': 'any'})
+    check_selector(functools.partial(multi_target_sites_with_gaussian_noise, combine='all'),
+                   {'specs': specs})
+
+    # Daemons need one list of tasks, so they need a combine rule, however the
+    # selector is wrapped
+    @functools.wraps(multi_target_sites_with_gaussian_noise)
+    def wrapper(*args, **kwargs):
+        return multi_target_sites_with_gaussian_noise(*args, **kwargs)
+
+    for selector in [multi_target_sites_with_gaussian_noise,
+                     functools.partial(multi_target_sites_with_gaussian_noise, max_atoms=60),
+                     wrapper]:
+        with pytest.raises(ValueError):
+            check_selector(selector, {'specs': specs})
+    with pytest.raises(ValueError):
+        CampaignScheduler([{'selector': multi_target_sites_with_gaussian_noise,
+                            'adsorbate': ADSORBATE, 'specs': specs}], user_name='user')
+
+
+def test_check_tasks():
+    tasks = [SimpleNamespace(), SimpleNamespace()]
+    assert check_tasks(tasks, randomly) is tasks
+    assert check_tasks([], randomly) == []
+    for not_flat in [[tasks, tasks], (tasks[0],), None]:
+        with pytest.raises(ValueError):
+            check_tasks(not_flat, randomly)
+
+
+def test_daemon_indexes_only_when_asked(gasdb, monkeypatch):
+    monkeypatch.setattr(daemon, 'get_launchpad', lambda: gasdb.lpad)
+    fireworks = gasdb.lpad.fireworks
+    indexes = sorted(fireworks.index_information())
+
+    # The FireWorks collection is shared, so we leave it alone by default
+    FeedbackDaemon(randomly, user_name='user', selector_kwargs={'adsorbate': ADSORBATE})
+    assert sorted(fireworks.index_information()) == indexes
+    FeedbackDaemon(randomly, user_name='user', selector_kwargs={'adsorbate': ADSORBATE},
+                   ensure_indexes=True)
+    assert len(fireworks.index_information()) == len(indexes) + 2
+
+
+def test_sharded_sample_does_not_depend_on_workers(gasdb, monkeypatch):
+    monkeypatch.setattr(os, 'cpu_count', lambda: 4)
+    sites = SiteTable.from_docs(gasdb.unsimulated_docs, fingerprints=True)
+    attempted_fingerprints = get_attempted_fingerprints(ADSORBATE, VASP_SETTINGS)
+    values = np.random.RandomState(42).normal(0.8, 0.3, size=len(sites))
+    samples = [sharded_gaussian_sample(sites, values, 1.23, 0.2, 50, n_workers=n_workers,
+                                       max_atoms=80, attempted_fingerprints=attempted_fingerprints,
+                                       seed=42)[0]
+               for n_workers in [1, 2, 4]]
+    assert len(samples[0]) == 50
+    assert all(np.array_equal(samples[0], sample) for sample in samples[1:])
+
+
+@pytest.mark.parametrize('select', [
+    lambda: randomly(ADSORBATE, vasp_settings=VASP_SETTINGS),
+    lambda: randomly(ADSORBATE, vasp_settings=VASP_SETTINGS, stream=True),
+    lambda: randomly(ADSORBATE, vasp_settings=VASP_SETTINGS, budget=10.),
+    lambda: randomly(ADSORBATE, vasp_settings=VASP_SETTINGS,
+                     catalog=get_catalog_snapshot([ORR_FIELD])),
+    lambda: low_cov_ads_energies_with_gaussian_noise(ADSORBATE, -0.67, 0.1, model_tag=MODEL_TAG,
+                                                     vasp_settings=VASP_SETTINGS),
+    lambda: low_cov_ads_energies_with_gaussian_noise(ADSORBATE, -0.67, 0.1, model_tag=MODEL_TAG,
+                                                     vasp_settings=VASP_SETTINGS, budget=10.),
+    lambda: orr_sites_with_gaussian_noise(ADSORBATE, 1.23, 0.2, model_tag=MODEL_TAG,
+                                          vasp_settings=VASP_SETTINGS),
+    lambda: orr_sites_with_gaussian_noise(ADSORBATE, 1.23, 0.2, model_tag=MODEL_TAG,
+                                          vasp_settings=VASP_SETTINGS, budget=10.),
+    lambda: orr_sites_with_gaussian_noise(ADSORBATE, 1.23, 0.2, model_tag=MODEL_TAG,
+                                          vasp_settings=VASP_SETTINGS,
+                                          catalog=get_catalog_snapshot([ORR_FIELD])),
+    lambda: multi_target_sites_with_gaussian_noise(
+        ADSORBATE, [{'model_tag': MODEL_TAG, 'target': 1.23, 'stdev': 0.2}],
+        combine='any', vasp_settings=VASP_SETTINGS),
+    lambda: CandidateQueue(ADSORBATE, 1.23, 0.2, model_tag=MODEL_TAG,
+                           vasp_settings=VASP_SETTINGS)(),
+])
+def test_selectors_with_empty_catalog(select, monkeypatch):
+    pytest.importorskip('mongomock')
+    FakeGasdb([], [], []).install(monkeypatch)
+    assert select() == []
+
+
+def test_isin_sorted():
+    sorted_hashes = np.array([3, 2**63 + 5, 2**64 - 1], dtype=np.uint64)
+    hashes = np.array([0, 3, 4, 2**63 + 5, 2**64 - 1], dtype=np.uint64)
+    assert isin_sorted(hashes, sorted_hashes).tolist() == [False, True, False, True, True]
+    assert isin_sorted(2**64 - 1, sorted_hashes) and not isin_sorted(4, sorted_hashes)
+    assert not isin_sorted(hashes, np.array([], dtype=np.uint64)).any()
+
+
+def test_candidate_queue_keeps_to_its_cache_dir(gasdb, cache_dir):
+    queue_dir = os.path.join(cache_dir, 'queue')
+    queue = CandidateQueue(ADSORBATE, target=1.23, stdev=0.2, model_tag=MODEL_TAG,
+                           vasp_settings=VASP_SETTINGS, cache_dir=queue_dir)
+    assert len(queue(n_calcs=5)) == 5
+    assert len(queue(n_calcs=5)) == 5
+    assert os.listdir(cache_dir) == ['queue']
+
+
+@pytest.mark.parametrize('select', [
+    lambda n_workers: low_cov_ads_energies_with_gaussian_noise(ADSORBATE, -0.67, 0.1, n_calcs=20,
+                                                               model_tag=MODEL_TAG,
+                                                               vasp_settings=VASP_SETTINGS,
+                                                               n_workers=n_workers),
+    lambda n_workers: orr_sites_with_gaussian_noise(ADSORBATE, 1.23, 0.2, n_calcs=20,
+                                                    model_tag=MODEL_TAG,
+                                                    vasp_settings=VASP_SETTINGS,
+                                                    n_workers=n_workers),
+    lambda n_workers: orr_sites_with_gaussian_noise(ADSORBATE, 1.23, 0.2, n_calcs=20,
+                                                    model_tag=MODEL_TAG,
+                                                    vasp_settings=VASP_SETTINGS,
+                                                    catalog=get_catalog_snapshot([ORR_FIELD]),
+                                                    n_workers=n_workers),
+])
+def test_selections_do_not_depend_on_workers(select, gasdb, monkeypatch):
+    # Use a process pool even on machines with fewer cores
+    monkeypatch.setattr(os, 'cpu_count', lambda: 4)
+    selections = []
+    for n_workers in [1, 2, 4]:
+        np.random.seed(42)
+        selections.append([(hash_task(task), getattr(task, 'rotation', None))
+                           for task in select(n_workers)])
+    assert len(selections[0]) == 20
+    assert selections[0] == selections[1] == selections[2]
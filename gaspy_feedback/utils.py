@@ -0,0 +1,196 @@
+'''
+This submodule contains various helper functions that the rest of
+GASpy_feedback uses to manage its local, on-disk caches and to defer importing
+GASpy's heavier modules until they are needed.
+'''
+
+__authors__ = ['Kevin Tran', 'Zachary W. Ulissi']
+__emails__ = ['ktran@andrew.cmu.edu', 'zulissi@andrew.cmu.edu']
+
+import os
+import json
+import inspect
+import hashlib
+import datetime
+import tempfile
+import importlib
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+# How long after an ObjectId is made we still expect its document might land
+ID_OVERLAP = datetime.timedelta(minutes=10)
+
+
+def get_cache_dir(cache_dir=None):
+    '''
+    Finds (and makes, if needed) the directory where GASpy_feedback keeps its
+    local caches.
+
+    Args:
+        cache_dir   [optional] A string indicating the directory you want to
+                    use. If `None`, then we use the `GASPY_FEEDBACK_CACHE`
+                    environment variable, or `~/.gaspy_feedback` if that is not
+                    set either.
+    Returns:
+        cache_dir   A string indicating the cache directory
+    '''
+    if cache_dir is None:
+        cache_dir = os.environ.get('GASPY_FEEDBACK_CACHE',
+                                   os.path.join(os.path.expanduser('~'), '.gaspy_feedback'))
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def make_cache_key(*args):
+    '''
+    Turns a set of JSON-serializable arguments (e.g., an adsorbate and a
+    dictionary of VASP settings) into a short, stable string that we can use
+    in file names.
+
+    Args:
+        args    Any number of JSON-serializable objects
+    Returns:
+        key     A 16-character hexadecimal string
+    '''
+    serialized = json.dumps(args, sort_keys=True, default=str)
+    return hashlib.blake2b(serialized.encode(), digest_size=8).hexdigest()
+
+
+@contextlib.contextmanager
+def atomic_path(path):
+    '''
+    Gives you a unique, temporary path to write to next to `path`, and then
+    moves what you wrote onto `path` in one step once you are done. Readers
+    never see a partial file, and several processes that write the same file
+    at once (e.g., daemons that share a cache) do not trip over each other.
+
+    Args:
+        path    A string indicating the file you want to write
+    Yields:
+        temp_path   A string indicating where to write instead. It has the
+                    same extension as `path`, so `numpy.save` and
+                    `numpy.savez` do not add another one.
+    '''
+    directory, file_name = os.path.split(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.%s.' % file_name,
+                                         suffix=os.path.splitext(file_name)[1])
+    os.close(handle)
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def get_overlap_id(high_water, overlap=ID_OVERLAP):
+    '''
+    Backs an ObjectId high-water mark up by some time. ObjectIds are made by
+    whichever client inserts a document (e.g., one of many FireWorks workers),
+    so a document can land after another one with a larger ID. Incremental
+    queries that start here instead of at the mark itself still see those
+    documents, as long as they landed within `overlap` of getting their IDs.
+
+    Args:
+        high_water  A `bson.ObjectId` of the newest document we have seen
+        overlap     [optional] A `datetime.timedelta` indicating how far back
+                    to start
+    Returns:
+        start   A `bson.ObjectId` to query from, inclusively
+    '''
+    from bson import ObjectId
+    return ObjectId.from_datetime(high_water.generation_time - overlap)
+
+
+def get_max_concurrent_queries():
+    '''
+    Figures out how many database queries we are allowed to run at once. Set
+    the `GASPY_FEEDBACK_MAX_QUERIES` environment variable to change it.
+
+    Returns:
+        max_queries     A positive integer (defaults to 4)
+    '''
+    return max(int(os.environ.get('GASPY_FEEDBACK_MAX_QUERIES', 4)), 1)
+
+
+def fetch_concurrently(*functions, max_workers=None):
+    '''
+    Calls several independent functions (e.g., database queries that spend
+    most of their time waiting on the network) at the same time in a thread
+    pool and waits for all of them to finish.
+
+    Args:
+        functions   Any number of functions that take no arguments, e.g.,
+                    `functools.partial` objects
+        max_workers [optional] A positive integer indicating how many of the
+                    functions may run at once. Defaults to
+                    `get_max_concurrent_queries()`.
+    Returns:
+        results     A list of what each function returned, in the same order
+                    as `functions`. If any function raised an exception, then
+                    it is re-raised here.
+    '''
+    if max_workers is None:
+        max_workers = get_max_concurrent_queries()
+    if max_workers <= 1 or len(functions) <= 1:
+        return [function() for function in functions]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(functions))) as executor:
+        futures = [executor.submit(function) for function in functions]
+        return [future.result() for future in futures]
+
+
+def accepts_argument(function, argument):
+    '''
+    Checks whether a function (or any other callable, e.g., a
+    `gaspy_feedback.candidate_queue.CandidateQueue`) has an argument with a
+    particular name.
+
+    Args:
+        function    A callable
+        argument    A string indicating the name of the argument
+    Returns:
+        accepts     A Boolean
+    '''
+    return argument in inspect.signature(function).parameters
+
+
+def lazy_import(module_name, name=None):
+    '''
+    Makes a stand-in for a module, or for a function or class inside of one,
+    that only imports the module the first time that it is used. Importing
+    `gaspy.tasks` or `gaspy.fireworks_helper_scripts` pulls in luigi and
+    FireWorks, so we use this to keep `import gaspy_feedback` cheap for
+    cron-launched runs that may not end up choosing anything.
+
+    Args:
+        module_name A string indicating the module to import, e.g.,
+                    'gaspy.gasdb'
+        name        [optional] A string indicating the function or class
+                    inside of the module that you want a stand-in for
+    Returns:
+        stand_in    If `name` is `None`, then an object whose attributes are
+                    looked up in the module. Otherwise, a function that passes
+                    its arguments to `module.name`.
+    '''
+    if name is None:
+        return _LazyModule(module_name)
+
+    def stand_in(*args, **kwargs):
+        return getattr(importlib.import_module(module_name), name)(*args, **kwargs)
+    stand_in.__name__ = stand_in.__qualname__ = name
+    stand_in.__doc__ = 'Imports and then calls `%s.%s`' % (module_name, name)
+    return stand_in
+
+
+class _LazyModule(object):
+    ''' A module that is not imported until one of its attributes is used '''
+    def __init__(self, module_name):
+        self._module_name = module_name
+
+    def __getattr__(self, name):
+        return getattr(importlib.import_module(self._module_name), name)
+
+    def __repr__(self):
+        return '<lazily imported module %r>' % self._module_name